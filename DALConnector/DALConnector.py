@@ -3,9 +3,11 @@ from __future__ import absolute_import, print_function, unicode_literals
 from ableton.v2.base import const, inject, listens
 from ableton.v2.control_surface import ControlSurface
 
-from .config import WATCH_FOR_NEW_SAVES
+from .config import WATCH_FOR_NEW_SAVES, LOAD_TIME_PER_TICK
 from .fetcher import ThreadShare
+from .loader import LoadState, Target, NOTES_PER_OP, clipsbyslot, addednotes, notetuples
 from .local import propername, displayname
+from .stats import LoadStats, recording, tally
 
 from time import sleep
 import Live
@@ -18,6 +20,7 @@ logger = logging.getLogger(__name__)
 
 class DALConnector(ControlSurface):
     WATCH_INTERVAL_SLEEP = 10  # Wait time between polling, 20 is 2 seconds
+    EXPECT_TIMEOUT = 60        # Seconds to wait for a requested song before giving up
 
     def __init__(self, *a, **k):
         super(DALConnector, self).__init__(*a, **k)
@@ -26,6 +29,8 @@ class DALConnector(ControlSurface):
             self.eventloopstarted = False
 
             self.ts = None
+            self.skippedcalls = 0
+            self.targets = []          # Every dc: track we're looking after, see loader.Target
             logger.info(u'--- DAL Connector Started ---')
 
             self.__on_selected_track_name_changed.subject = self.song.view
@@ -45,51 +50,55 @@ class DALConnector(ControlSurface):
     @listens(u'selected_track.name')
     def __on_selected_track_name_changed(self):
         track = self.song.view.selected_track
-
-        if self.targettrack and track != self.targettrack:
-            return
+        target = self._target(track)
 
         if not track.name.lower().startswith('dc:'):
-            if self.targettrack and track == self.targettrack:
-                self._resetvars()
+            if target is not None:
+                self._droptarget(target)
 
             return
 
         if track.name.endswith(']'):
             return
 
-        self.targettrack = track
-
-        self.schedule_message(1, self.handletrackchange)
+        # Every dc: track is a target of its own, the others carry on as they were
+        if target is None:
+            target = Target(track, LOAD_TIME_PER_TICK / 1000)
+            self.targets.append(target)
 
-    def handletrackchange(self):
-        view = self.song.view
-        track = view.selected_track
+        self.schedule_message(1, lambda: self.handletrackchange(target))
 
-        num = re.search(r'^dc: *(\d+[a-z]*)', track.name, re.IGNORECASE)
+    def handletrackchange(self, target):
+        num = re.search(r'^dc: *(\d+[a-z]*)', target.track.name, re.IGNORECASE)
         if not num:
             # logger.info(u'ERR!  Invalid song number specified')
             return
         else:
-            self.delugesong = propername(num.groups()[0])
+            target.delugesong = propername(num.groups()[0])
 
-        # logger.info(f'Deluge song is {self.delugesong}')
+        # logger.info(f'Deluge song is {target.delugesong}')
 
         if self.ts is None:
             self.ts = ThreadShare()
 
+        # The load of the song the track was named for before would only overwrite [fetching...]
+        # and then call itself [synced] while the new song is still on its way
+        target.scheduler.cancel()
+        target.watchmsg = None
 
-        self.ts.fetchsong(self.delugesong)
+        target.requestid = self.ts.fetchsong(target.delugesong, target.id)
 
-        self._addtrackmsg(f'[fetching...]')
+        self._addtrackmsg(target, f'[fetching...]')
 
-        self.expectsong = self.delugesong
+        target.expectid = target.requestid
+        target.expectsince = time.time()
 
         if not self.eventloopstarted:
             self.eventloopstarted = True
-            self.schedule_message(10, self.eventloop)
+            self.schedule_message(1, self.eventloop)
 
 
+    # Runs every tick: picks up whatever the fetcher thread sent and applies the next slice of each load
     def eventloop(self):
         if self.finished:
             return
@@ -98,64 +107,104 @@ class DALConnector(ControlSurface):
             if self.ts is None:
                 return
 
-            if self.expectsong is None:
-                if not WATCH_FOR_NEW_SAVES:
-                    return
+            for event in self.ts.getevents():
+                self._handleevent(event)
 
-                nextsongdata = self.ts.getnextsongdata()
+            self._prunetargets()
 
-                if nextsongdata is not None:
-                    self.delugesong = nextsongdata['delugesong']
-                    # logger.info(f'[EVENT LOOP]: LOADING NEXT SONG!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-                    self.loadsong(nextsongdata['songhsh'])
+            # Loads share the tick, and take turns at going first
+            busy = [target for target in self.targets if target.scheduler.busy]
+            share = LOAD_TIME_PER_TICK / 1000 / max(1, len(busy))
 
-                value = self.ts.getwatchmsg()
-                if value:
-                    self._addtrackmsg(f'[{value}]')
+            for target in list(self.targets):
+                self._targettick(target, share)
 
-                return
+            if len(busy) > 1:
+                self.targets.append(self.targets.pop(0))
+
+        finally:
+            self.schedule_message(1, self.eventloop)
 
-            value = self.ts.getwatchmsg()
-            if value:
-                self._addtrackmsg(f'[{value}]')
+    def _targettick(self, target, share):
+        if target.expectid is not None and time.time() - target.expectsince > self.EXPECT_TIMEOUT:
+            target.expectid = None
 
-            self.expecttries += 1
+            self._addtrackmsg(target, '[error 5]')
+            logger.info(f'Expected song never showed up!')
 
-            if self.expecttries > 60:
-                self.expecttries = 0
-                self.expectsong = None
+        if target.scheduler.busy:
+            target.scheduler.budget = share
 
-                self._addtrackmsg('[error 5]')
-                logger.info(f'Expected song never showed up!')
-                return
+            with recording(target.loadstats):
+                tally('ticks')
+                done = target.scheduler.run()
 
-            result = self.ts.getresult(self.expectsong)
+            if not done:
+                self._addtrackmsg(target, f'[loading {int(target.scheduler.progress() * 100)}%]')
+            return
 
-            if result is not None:
-                self.expecttries = 0
-                self.expectsong = None
+        # Load progress has the track name while a load runs, the message waits until it's done
+        if target.watchmsg:
+            self._addtrackmsg(target, f'[{target.watchmsg}]')
+            target.watchmsg = None
 
-                if result['error']:
-                    self._addtrackmsg('[error 2]')
-                    return
+    def _handleevent(self, event):
+        # Anything from a request we've since replaced, or for a track that's gone, is stale
+        target = next((t for t in self.targets if t.requestid == event.requestid), None)
+        if target is None:
+            return
 
-                self.loadsong(result['songhsh'])
+        if event.kind == ThreadShare.WATCH:
+            if WATCH_FOR_NEW_SAVES or target.expectid is not None:
+                target.watchmsg = event.message
 
-                if not WATCH_FOR_NEW_SAVES:
-                    self._addtrackmsg('[synced]')
+        elif event.kind == ThreadShare.RESULT:
+            target.expectid = None
 
+            if event.error:
+                self._addtrackmsg(target, '[error 2]')
                 return
 
-        finally:
-            self.schedule_message(10, self.eventloop)
+            self.loadsong(target, event.songhsh, event.stats)
 
-    def _addtrackmsg(self, msg):
-        if self.targettrack is None:
-            return
+        elif event.kind == ThreadShare.NEXTSONG:
+            if not WATCH_FOR_NEW_SAVES or target.expectid is not None:
+                return
+
+            target.delugesong = event.delugesong
+            # logger.info(f'[EVENT LOOP]: LOADING NEXT SONG!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+            self.loadsong(target, event.songhsh, event.stats)
+
+    def _addtrackmsg(self, target, msg):
+        name = f'dc: {displayname(target.delugesong)} {msg.strip()}'
+
+        target.track.name = name
+
+
+    def _target(self, track):
+        for target in self.targets:
+            if target.track == track:
+                return target
+
+        return None
+
+
+    def _droptarget(self, target):
+        target.scheduler.cancel()
+        self.targets.remove(target)
+
+        if self.ts:
+            self.ts.drop(target.id)
 
-        name = f'dc: {displayname(self.delugesong)} {msg.strip()}'
 
-        self.targettrack.name = name
+    def _prunetargets(self):
+        """Forget targets whose track was deleted"""
+        if not self.targets:
+            return
+
+        tracks = list(self.song.tracks)
+        for target in [t for t in self.targets if t.track not in tracks]:
+            self._droptarget(target)
 
 
     def _ensureenoughscenes(self, numscenes):
@@ -166,117 +215,235 @@ class DALConnector(ControlSurface):
 
         for i in range(0, numscenes - len(self.song.scenes)):
             self.song.create_scene(-1)
+            tally('create_scene')
 
 
-    def _ensureenoughtracks(self, numtracks):
-        tracks = self.song.visible_tracks
-
-        index = list(tracks).index(self.targettrack)
+    def _ensureenoughtracks(self, target, numtracks):
+        tracks = self._blocktracks(target)
 
-        allslots = []
         count = 0
-        for i in range(index, len(tracks)):
-            track = tracks[i]
-
+        for track in tracks:
             if track.has_midi_input:
                 count += 1
-
-                # CLEAR THE SLOTS
-                for s in range(0, len(self.song.scenes)):
-                    slot = track.clip_slots[s]
-
-                    if not slot.has_clip:
-                        continue
-
-                    allslots.append(slot)
-                    slot.clip.remove_notes_extended(from_time = 0, from_pitch = 0, time_span = slot.clip.loop_end, pitch_span = 128)
             else:
                 break
 
         if count < numtracks:
+            # With another dc: track below, new tracks have to go in above it rather than at the end
+            index = -1
+            if self._blockends(target):
+                index = list(self.song.tracks).index(tracks[max(0, count - 1)]) + 1
+
             for i in range(0, numtracks - count):
-                self.song.create_midi_track()
+                if index < 0:
+                    self.song.create_midi_track()
+                else:
+                    self.song.create_midi_track(index)
+                tally('create_midi_track')
 
-        return allslots
 
+    def _existingclips(self, tracks):
+        """Slots under the target track that hold a clip, as (trackidx, sceneidx)"""
+        result = []
+        for trackidx, track in enumerate(tracks):
+            for sceneidx in range(0, len(self.song.scenes)):
+                if track.clip_slots[sceneidx].has_clip:
+                    result.append((trackidx, sceneidx))
 
-    def loadsong(self, songhsh):
-        bpm = songhsh['bpm']
-        numscenes = songhsh['numscenes']
-        maxtrackid = songhsh['maxtrackid']
-        clipmap = songhsh['clipmap']
+        return result
 
-        self.song.tempo = bpm
 
-        self._ensureenoughscenes(numscenes)              # We need this many scenes
-        allslots = self._ensureenoughtracks(maxtrackid)  # We need this many midi tracks
+    def loadsong(self, target, songhsh, stats = None):
+        """Queue the Live operations that turn what's loaded under target into songhsh.  eventloop
+        runs a slice of them per tick, and a newer song replaces whatever is still queued."""
+        target.loadskipped = 0
+        target.loadchanged = 0
 
-        tracks = self._addressabletracks()
+        # Carries on from what the fetcher recorded while getting the song
+        target.loadstats = stats or LoadStats()
+        if target.loadstats.sent is not None:
+            target.loadstats.add('handover', time.time() - target.loadstats.sent)
 
-        for cliphsh in clipmap:
+        target.scheduler.start(self._loadops(target, songhsh), lambda: self._loaded(target),
+                               lambda e: self._loadfailed(target, e))
 
-            trackidx = cliphsh['trackidx']
-            track = tracks[trackidx]
 
-            sceneidx = cliphsh['sceneidx']
-            length = cliphsh['length']
+    def _loaded(self, target):
+        self.skippedcalls += target.loadskipped
+        logger.info(f'Loaded song, {target.loadchanged} clips changed, '
+                    f'{target.loadskipped} Live API calls skipped ({self.skippedcalls} in total)')
 
-            # logger.info(f'CREATE CLIP: SCENEIDX: {sceneidx}  TrackIDX: {trackidx}')
+        target.loadstats.report(song = target.delugesong, changed = target.loadchanged, skipped = target.loadskipped,
+                                targets = len(self.targets))
 
-            slot = track.clip_slots[sceneidx]
-            if slot.has_clip:
-                if slot.clip.length != length:
-                    slot.delete_clip()
-                    slot.create_clip(length)
+        self._addtrackmsg(target, '[synced]')
+
+
+    def _loadfailed(self, target, e):
+        # Whatever was applied stays, but it no longer matches what the load state says
+        target.loadstate = None
+        target.watchmsg = None
+
+        # Like a failed fetch, stop watching until the track is renamed, so the error stays up
+        if self.ts:
+            self.ts.jobs.clear(target.id)
+
+        target.loadstats.report(song = target.delugesong, error = str(e), targets = len(self.targets))
+
+        self._addtrackmsg(target, '[error 6]')
+
+
+    def _loadops(self, target, songhsh):
+        def tempo():
+            self.song.tempo = songhsh['bpm']
+            tally('set_tempo')
+
+        def scenes():
+            self._ensureenoughscenes(songhsh['numscenes'])     # We need this many scenes
+
+        def tracks():
+            self._ensureenoughtracks(target, songhsh['maxtrackid'])    # We need this many midi tracks
+
+        # The clips can only be worked out once the tracks are there
+        return [tempo, scenes, tracks, lambda: self._clipops(target, songhsh)]
+
+
+    def _clipops(self, target, songhsh):
+        tracks = self._addressabletracks(target)
+        slots = clipsbyslot(songhsh)
+
+        # Only diff against what we loaded ourselves into this same track, anything else gets rebuilt
+        state = target.loadstate
+        if state is None or state.track != target.track:
+            state = LoadState(target.track, self._existingclips(tracks))
+            target.loadstate = state
+
+        changed, unchanged, removed = state.diff(slots)
+
+        for key in unchanged:
+            slot = tracks[key[0]].clip_slots[key[1]]
+
+            # Clip was deleted or resized in Live since, so it isn't what we loaded any more
+            if not slot.has_clip or slot.clip.length != slots[key]['length']:
+                changed[key] = slots[key]
+                continue
+
+            target.loadskipped += 2      # remove_notes_extended and add_new_notes
+
+        target.loadchanged = len(changed)
+
+        ops = []
+        for key in sorted(changed):
+            slot = tracks[key[0]].clip_slots[key[1]]
+            ops.append(self._clipop(target, state, slot, key, changed[key]))
+
+        # If we didn't use the clip, remove it
+        for key in removed:
+            slot = tracks[key[0]].clip_slots[key[1]]
+            ops.append(self._removeop(state, slot, key))
+
+        return ops
+
+
+    def _clipop(self, target, state, slot, key, clip):
+        """Operation that readies one clip and returns the operations adding its notes"""
+        previous = state.slots.get(key)
+
+        def begin():
+            state.starting(key)
+
+            length = clip['length']
+            notes = None
+
+            if slot.has_clip and slot.clip.length == length:
+                notes = addednotes(previous, clip)
+
+                # Notes were only added, leave the ones already in the clip alone
+                if notes is not None:
+                    target.loadskipped += 1 if notes else 2
+                else:
+                    slot.clip.remove_notes_extended(from_time = 0, from_pitch = 0, time_span = slot.clip.loop_end, pitch_span = 128)
+                    tally('remove_notes_extended')
             else:
+                if slot.has_clip:
+                    slot.delete_clip()
+                    tally('delete_clip')
                 slot.create_clip(length)
+                tally('create_clip')
 
-            notes = cliphsh['notes']
+            if notes is None:
+                notes = notetuples(clip)
 
-            result = []
-            for hsh in notes:
+            ops = []
+            for i in range(0, len(notes), NOTES_PER_OP):
+                chunk = notes[i:i + NOTES_PER_OP]
+                ops.append(lambda chunk = chunk: self._addnotes(slot, chunk))
 
-                result.append(Live.Clip.MidiNoteSpecification(
-                    pitch = hsh['pitch'],
-                    start_time = hsh['starttime'],
-                    duration = hsh['duration'],
-                    velocity = hsh['velocity'],
-                    mute = 0,
-                    probability = hsh['probability']
-                    ))
+            ops.append(lambda: state.loaded(key, clip))
+            return ops
 
-            slot.clip.add_new_notes(result)
+        return begin
 
-            # We used the clip
-            if slot in allslots:
-                allslots.remove(slot)
 
+    def _addnotes(self, slot, notes):
+        slot.clip.add_new_notes(self._notespecs(notes))
+        tally('add_new_notes')
+        tally('notes', len(notes))
 
-        # If we didn't use the clip, remove it
-        for slot in allslots:
-            slot.delete_clip()
 
+    def _removeop(self, state, slot, key):
+        def remove():
+            if slot.has_clip:
+                slot.delete_clip()
+                tally('delete_clip')
+
+            state.cleared(key)
 
-    def _addressabletracks(self):
-        tracks = self.song.visible_tracks
+        return remove
 
-        index = list(tracks).index(self.targettrack)
 
+    def _notespecs(self, notes):
         result = []
-        for i in range(index, len(tracks)):
-            if not tracks[i].has_midi_input:
-                continue
+        for pitch, starttime, duration, velocity, probability in notes:
 
-            result.append(tracks[i])
+            result.append(Live.Clip.MidiNoteSpecification(
+                pitch = pitch,
+                start_time = starttime,
+                duration = duration,
+                velocity = velocity,
+                mute = 0,
+                probability = probability
+                ))
 
         return result
 
 
+    def _addressabletracks(self, target):
+        return [track for track in self._blocktracks(target) if track.has_midi_input]
+
+
+    def _blocktracks(self, target):
+        """Visible tracks from target's dc: track down to the next dc: track"""
+        tracks = list(self.song.visible_tracks)
+
+        index = tracks.index(target.track)
+
+        end = index + 1
+        while end < len(tracks) and not tracks[end].name.lower().startswith('dc:'):
+            end += 1
+
+        return tracks[index:end]
+
+
+    def _blockends(self, target):
+        """True if another dc: track comes after target's block"""
+        tracks = list(self.song.visible_tracks)
+        return len(self._blocktracks(target)) < len(tracks) - tracks.index(target.track)
+
+
     def _resetvars(self):
-        self.delugesong = None      # SONG000.XML
-        self.targettrack = None     # Which track is titled dc:
-        self.watchfor = None        # The name of the new save we're watching for
+        for target in self.targets:
+            target.scheduler.cancel()
 
-        self.expecttries = 0
-        self.expectsong = None
+        self.targets = []
 
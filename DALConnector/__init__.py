@@ -1,6 +1,8 @@
 from __future__ import absolute_import, print_function, unicode_literals
-from .DALConnector import DALConnector
 
 def create_instance(c_instance):
+    # Imported here so the fetcher, codec and converter can be used outside of Live
+    from .DALConnector import DALConnector
+
     return DALConnector(c_instance = c_instance)
 
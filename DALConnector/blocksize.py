@@ -0,0 +1,163 @@
+from . import config
+from .config import READ_BLOCK_SIZE, READ_BLOCK_SIZE_MIN, READ_BLOCK_SIZE_MAX
+
+import logging
+import json
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BlockSizer(object):
+    """Picks the read block size for a device from how well the last blocks went.
+
+    Full, error free blocks grow the size once throughput stops improving at the current one.
+    Errors, timeouts and short reads shrink it, and a size that never worked caps how far it may
+    grow again.  A bigger size that turned out slower is only held off for a while, since round
+    trip times are noisy.  The size and the cap from errors are remembered per device so the next
+    Live session starts where this one ended.
+    """
+
+    GROW_AFTER = 8            # Good blocks in a row before trying a bigger size
+    SMOOTHING = 0.25          # Weight of the newest sample in the throughput average
+    MARGIN = 1.1              # How much faster the smaller size has to be before stepping back to it
+    REPROBE_AFTER = 16        # Good runs of GROW_AFTER blocks before a slower size is tried again
+
+    FILENAME = 'blocksizes.json'
+
+    _lock = threading.Lock()
+
+    def __init__(self, device):
+        self.device = device
+
+        self.size = READ_BLOCK_SIZE
+        self.ceiling = READ_BLOCK_SIZE_MAX     # From errors, kept between sessions
+        self.cap = READ_BLOCK_SIZE_MAX         # From throughput, this session only
+        self.capped = 0                        # Good runs since the cap was lowered
+
+        self.good = 0             # Largest size that has managed GROW_AFTER blocks in a row
+        self.streak = 0
+        self.batchstart = 0
+        self.batchbytes = 0
+        self.throughput = {}      # size -> smoothed bytes/sec
+
+        self._load()
+
+    def record(self, requested, received, rtt):
+        """Feed back one read.  received is the byte count that came back, 0 on error or timeout."""
+        # Asked for before the size last went down, whatever went wrong has been dealt with
+        if received < requested and requested > self.size:
+            return
+
+        if received <= 0:
+            self._shrink('error')
+            return
+
+        if received < requested:
+            self._shrink('short read')
+            return
+
+        # Tail blocks and blocks asked for before the last size change say nothing about this size
+        if requested != self.size:
+            return
+
+        # Throughput is measured over a run of blocks, not per block, so it means the same thing
+        # whether one read is in flight or a whole window of them
+        now = time.time()
+        if self.streak == 0:
+            self.batchstart = now - rtt
+            self.batchbytes = 0
+
+        self.batchbytes += received
+        self.streak += 1
+        if self.streak < self.GROW_AFTER:
+            return
+
+        self.streak = 0
+        self.good = max(self.good, self.size)
+
+        if now > self.batchstart:
+            sample = self.batchbytes / (now - self.batchstart)
+            previous = self.throughput.get(self.size)
+            if previous is None:
+                self.throughput[self.size] = sample
+            else:
+                self.throughput[self.size] = previous + self.SMOOTHING * (sample - previous)
+
+        # Bigger blocks stopped paying off, go back to the smaller one for a while
+        smaller = self.size // 2
+        if smaller in self.throughput and self.throughput[smaller] > self.throughput[self.size] * self.MARGIN:
+            self.cap = smaller
+            self.capped = 0
+            self._setsize(smaller)
+            return
+
+        # That could have been a few slow round trips, so give the bigger size another go later
+        if self.cap < self.ceiling:
+            self.capped += 1
+            if self.capped >= self.REPROBE_AFTER:
+                self.cap *= 2
+                self.capped = 0
+                self.throughput.pop(self.cap, None)
+
+        if self.size * 2 <= min(self.cap, self.ceiling):
+            self._setsize(self.size * 2)
+
+    def _shrink(self, reason):
+        self.streak = 0
+
+        if self.size <= READ_BLOCK_SIZE_MIN:
+            return
+
+        logger.info(f'Read block size {self.size} gave {reason}, shrinking')
+
+        # A size that never worked is probably more than the firmware takes, don't go back to it.
+        # A hiccup at a size that has worked before is just a hiccup.
+        if self.size > self.good:
+            self.ceiling = self.size // 2
+
+        self._setsize(max(READ_BLOCK_SIZE_MIN, self.size // 2))
+
+    def _setsize(self, size):
+        if size == self.size:
+            return
+
+        self.size = size
+        self._save()
+
+    ############################################
+    # PERSISTENCE
+    def _path(self):
+        return os.path.join(config.DATA_DIR, self.FILENAME)
+
+    def _load(self):
+        try:
+            with open(self._path()) as f:
+                saved = json.load(f).get(self.device)
+        except Exception:
+            return
+
+        if not saved:
+            return
+
+        self.ceiling = min(READ_BLOCK_SIZE_MAX, saved.get('ceiling', READ_BLOCK_SIZE_MAX))
+        self.size = max(READ_BLOCK_SIZE_MIN, min(self.ceiling, saved.get('size', READ_BLOCK_SIZE)))
+
+    def _save(self):
+        with self._lock:
+            try:
+                with open(self._path()) as f:
+                    saved = json.load(f)
+            except Exception:
+                saved = {}
+
+            saved[self.device] = { 'size': self.size, 'ceiling': self.ceiling }
+
+            try:
+                os.makedirs(config.DATA_DIR, exist_ok = True)
+                with open(self._path(), 'w') as f:
+                    json.dump(saved, f)
+            except Exception as e:
+                logger.info(f'Could not save block size: {e}')
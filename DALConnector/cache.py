@@ -0,0 +1,322 @@
+from . import config
+from .config import SONG_CACHE_MAX_BYTES, SERIES_CACHE_SIZE, PARTIAL_CACHE_SIZE, PARTIAL_MAX_AGE
+
+import logging
+import collections
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class SongCache(object):
+    """Fetched song XML and its converted songhsh, kept on disk between Live sessions.
+
+    Objects are stored by the SHA-1 of the XML, so the same content saved under two names is
+    only kept once.  Each song path points at an object together with the size and
+    date the Deluge reported when it was fetched.  A lookup only hits if those still match.
+    Least recently used objects are dropped once the cache grows past its byte limit.
+    """
+
+    INDEX = 'index.json'
+    VERSION = 2          # Bump whenever the layout of songhsh changes, older caches are ignored
+
+    def __init__(self, root = None, maxbytes = SONG_CACHE_MAX_BYTES):
+        self.root = root or os.path.join(config.DATA_DIR, 'cache')
+        self.maxbytes = maxbytes
+
+        self.lock = threading.RLock()
+
+        self.paths = {}      # song path -> { size, date, time, hash }
+        self.objects = {}    # hash -> { bytes, used }
+
+        self._load()
+
+    @staticmethod
+    def hash(xml):
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+
+        return hashlib.sha1(xml).hexdigest()
+
+    ############################################
+    # LOOKUPS
+    def get(self, path, stat):
+        """songhsh for path if the cached copy still matches stat, otherwise None"""
+        with self.lock:
+            key = self._lookup(path, stat)
+            if key is None:
+                return None
+
+            return self._readsong(key)
+
+    def has(self, path, stat):
+        """True if get() would hit, without reading the song"""
+        with self.lock:
+            return self._lookup(path, stat) is not None
+
+    def _lookup(self, path, stat):
+        entry = self.paths.get(path)
+        if entry is None or not stat:
+            return None
+
+        # Without a date the size alone can't tell an edited song from the old one
+        if stat.get('date') is None:
+            return None
+
+        if any(entry.get(k) != stat.get(k) for k in ('size', 'date', 'time')):
+            del self.paths[path]
+            self._save()
+            return None
+
+        if entry['hash'] not in self.objects:
+            del self.paths[path]
+            return None
+
+        return entry['hash']
+
+    def _readsong(self, key):
+        try:
+            with open(self._file(key, 'song'), 'rb') as f:
+                songhsh = pickle.loads(zlib.decompress(f.read()))
+        except Exception as e:
+            logger.info(f'Cache read failed for {key}: {e}')
+            self._drop(key)
+            return None
+
+        # Written out with the next put, a hit alone isn't worth rewriting the index
+        self.objects[key]['used'] = time.time()
+
+        return songhsh
+
+    ############################################
+    # STORING
+    def put(self, path, stat, xml, songhsh):
+        """Store a song.  xml can be the raw bytes from the Deluge or already decoded text."""
+        with self.lock:
+            key = self.hash(xml)
+
+            try:
+                os.makedirs(self.root, exist_ok = True)
+
+                if key not in self.objects:
+                    xmlbytes = xml.encode('utf-8') if isinstance(xml, str) else bytes(xml)
+                    songbytes = zlib.compress(pickle.dumps(songhsh, protocol = pickle.HIGHEST_PROTOCOL))
+
+                    with open(self._file(key, 'xml'), 'wb') as f:
+                        f.write(xmlbytes)
+
+                    with open(self._file(key, 'song'), 'wb') as f:
+                        f.write(songbytes)
+
+                    self.objects[key] = { 'bytes': len(xmlbytes) + len(songbytes), 'used': time.time() }
+                else:
+                    self.objects[key]['used'] = time.time()
+
+            except Exception as e:
+                logger.info(f'Cache write failed for {path}: {e}')
+                self._drop(key)
+                return
+
+            if stat:
+                self.paths[path] = {
+                    'size': stat.get('size'),
+                    'date': stat.get('date'),
+                    'time': stat.get('time'),
+                    'hash': key,
+                    }
+
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        total = sum(o['bytes'] for o in self.objects.values())
+
+        for key in sorted(self.objects, key = lambda k: self.objects[k]['used']):
+            if total <= self.maxbytes:
+                break
+
+            total -= self.objects[key]['bytes']
+            self._drop(key)
+
+    def _drop(self, key):
+        self.objects.pop(key, None)
+
+        for path in [p for p, e in self.paths.items() if e['hash'] == key]:
+            del self.paths[path]
+
+        for kind in ('xml', 'song'):
+            try:
+                os.remove(self._file(key, kind))
+            except OSError:
+                pass
+
+    ############################################
+    # PERSISTENCE
+    def _file(self, key, kind):
+        return os.path.join(self.root, f'{key}.{kind}')
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.root, self.INDEX)) as f:
+                index = json.load(f)
+
+            if index.get('version') != self.VERSION:
+                raise ValueError('old cache format')
+
+            self.paths = index.get('paths', {})
+            self.objects = index.get('objects', {})
+        except Exception:
+            self.paths = {}
+            self.objects = {}
+
+    def _save(self):
+        try:
+            os.makedirs(self.root, exist_ok = True)
+
+            tmp = os.path.join(self.root, self.INDEX + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({ 'version': self.VERSION, 'paths': self.paths, 'objects': self.objects }, f)
+
+            os.replace(tmp, os.path.join(self.root, self.INDEX))
+        except Exception as e:
+            logger.info(f'Could not save song cache index: {e}')
+
+
+class PartialCache(object):
+    """The start of songs whose read broke off, so the next try carries on where it stopped.
+
+    Kept in memory only, for at most maxage seconds.  A piece is only handed back while the size
+    and date the Deluge reports for the file still match what it said when the piece was read.
+    """
+
+    def __init__(self, maxentries = PARTIAL_CACHE_SIZE, maxage = PARTIAL_MAX_AGE):
+        self.maxentries = maxentries
+        self.maxage = maxage
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()     # path -> (stat, bytes, time stored)
+
+    def get(self, path, stat):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+
+            known, data, stored = entry
+            if time.time() - stored > self.maxage or any(known.get(k) != stat.get(k) for k in ('size', 'date', 'time')):
+                del self.entries[path]
+                return None
+
+            return data
+
+    def put(self, path, stat, data):
+        if not data:
+            return
+
+        with self.lock:
+            known = self.entries.get(path)
+
+            # Keep whichever got further, as long as it is the same file
+            if known is not None and known[0] == stat and len(known[1]) > len(data):
+                return
+
+            self.entries[path] = (dict(stat), bytes(data), time.time())
+            self.entries.move_to_end(path)
+
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last = False)
+
+    def discard(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+
+class SeriesCache(object):
+    """Last known save in each song series (2 -> 2C), kept between Live sessions.
+
+    Holds at most maxentries series, dropping the least recently used.  Safe to read from any
+    thread.  Loaded from disk on first use.
+    """
+
+    FILENAME = 'series.json'
+
+    def __init__(self, maxentries = SERIES_CACHE_SIZE, path = None):
+        self.maxentries = maxentries
+        self.path = path
+
+        self.lock = threading.RLock()
+        self.entries = None        # base -> last known save, least recently used first
+
+    def get(self, base):
+        with self.lock:
+            self._load()
+
+            head = self.entries.get(base)
+            if head is not None:
+                self.entries.move_to_end(base)
+
+            return head
+
+    def set(self, base, head):
+        with self.lock:
+            self._load()
+
+            changed = self.entries.get(base) != head
+
+            self.entries[base] = head
+            self.entries.move_to_end(base)
+
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last = False)
+
+            if changed:
+                self._save()
+
+    def discard(self, base):
+        with self.lock:
+            self._load()
+
+            if self.entries.pop(base, None) is not None:
+                self._save()
+
+    def validate(self, base, existing):
+        """Forget the head for base if it is no longer among the existing song names"""
+        with self.lock:
+            head = self.get(base)
+            if head is not None and head != base and head not in existing:
+                logger.info(f'Series head {head} for {base} is gone, rescanning from the start')
+                self.discard(base)
+
+    def _file(self):
+        return self.path or os.path.join(config.DATA_DIR, self.FILENAME)
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = collections.OrderedDict()
+
+        try:
+            with open(self._file()) as f:
+                for base, head in json.load(f):
+                    self.entries[base] = head
+        except Exception:
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self._file()), exist_ok = True)
+
+            tmp = self._file() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(list(self.entries.items()), f)
+
+            os.replace(tmp, self._file())
+        except Exception as e:
+            logger.info(f'Could not save series cache: {e}')
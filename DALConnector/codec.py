@@ -0,0 +1,102 @@
+# 7-bit <-> 8-bit packing for binary data carried in SysEx (same layout as DelugeWeb)
+#
+# Every 7 bytes of 8-bit data travel as 8 MIDI data bytes: first a byte holding the top bit of each
+# of the 7 bytes (bit j for byte j), then the 7 bytes with their top bit cleared.  The last packet
+# may be short.
+#
+# Everything here works on whole buffers at once using slicing, bytes.translate and big integer
+# arithmetic, so the per-byte work happens in C rather than in Python loops.
+
+# HIGHBIT[j] maps a packed high bit byte to 0x80 if bit j is set, otherwise 0
+HIGHBIT = [bytes((0x80 if b & (1 << j) else 0) for b in range(256)) for j in range(7)]
+
+# TOPBIT[j] maps a data byte to 1 << j if its top bit is set, otherwise 0
+TOPBIT = [bytes(((1 << j) if b & 0x80 else 0) for b in range(256)) for j in range(7)]
+
+LOW7 = bytes(b & 0x7F for b in range(256))
+
+
+def _or(a, b):
+    """Bytewise OR of two equal length byte strings"""
+    if not a:
+        return bytes(a)
+
+    return (int.from_bytes(a, 'big') | int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def unpackedlength(src_len):
+    """How many 8-bit bytes src_len packed bytes turn into"""
+    packets = (src_len + 7) // 8
+    missing = 8 * packets - src_len
+    if missing == 7:    # A lone high bit byte with nothing after it
+        packets -= 1
+        missing = 0
+
+    return max(0, 7 * packets - missing)
+
+
+def packedlength(length):
+    """How many 7-bit bytes packing length bytes turns into"""
+    return length + (length + 6) // 7
+
+
+def unpack7to8(src, offset = 0, length = None):
+    """Unpack 7-bit MIDI data to 8-bit data.  src can be bytes, bytearray, memoryview or a list of ints."""
+    if length is None:
+        length = len(src) - offset
+
+    src = bytes(src[offset:offset + length])
+
+    out_len = unpackedlength(len(src))
+    dst = bytearray(out_len)
+    if out_len == 0:
+        return dst
+
+    highbits = src[0::8]
+
+    for j in range(7):
+        column = src[1 + j::8]
+        count = len(range(j, out_len, 7))
+
+        column = column[:count]
+        high = highbits[:count].translate(HIGHBIT[j])
+
+        dst[j::7] = _or(column, high)
+
+    return dst
+
+
+def pack8to7(src):
+    """Pack 8-bit data into 7-bit MIDI data bytes.  The inverse of unpack7to8."""
+    src = bytes(src)
+
+    length = len(src)
+    if length == 0:
+        return b''
+
+    packets = (length + 6) // 7
+    dst = bytearray(packedlength(length))
+
+    highbits = 0
+    for j in range(7):
+        column = src[j::7]
+        if not column:
+            break
+
+        # Columns past the end of a short last packet are one byte shorter, pad them to line up
+        top = column.translate(TOPBIT[j]).ljust(packets, b'\x00')
+        highbits |= int.from_bytes(top, 'big')
+
+        dst[1 + j::8] = column.translate(LOW7)
+
+    dst[0::8] = highbits.to_bytes(packets, 'big')
+
+    return bytes(dst)
+
+
+def findseparator(data, start = 0):
+    """Index of the 0x00 byte that ends the JSON part of a reply, or -1 if there isn't one"""
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+
+    return data.find(b'\x00', start)
@@ -1,5 +1,7 @@
 
 
+import os
+
 # DALConnector USB MIDI Configuration
 # ====================================
 # This version uses the DelugeWeb SysEx protocol to read song XML files
@@ -25,12 +27,81 @@ WATCH_FOR_NEW_SAVES =  True   # True or False
 NEW_SAVE_SLEEP_TIMER = 600  # Integer seconds
 
 
+# Once a song is loaded, quietly fetch the songs you're likely to ask for next (the newest save in
+# its series, the next letter, the next number) into the cache, so switching to them is instant.
+# Anything you ask for always goes first.
+PREFETCH_NEXT_SONGS = True   # True or False
+
+
+# Read songs straight from a folder instead of over USB MIDI, e.g. the Deluge's card in a card
+# reader or a synced copy of it.  Set this to the folder that holds SONGS, or None to use USB.
+CARD_FOLDER = None
+
+
 # MIDI Communication Settings
 # ===========================
 
 # MIDI connection timeout in seconds
 MIDI_TIMEOUT = 5
 
+# The MIDI ports and Deluge session are kept open between fetches.  If nothing has been heard
+# from the Deluge for this many seconds, the session is checked again before it is reused.
+CONNECTION_HEALTH_INTERVAL = 10  # Integer seconds
+
+# The Deluge's MIDI ports are looked up once and remembered until they stop working.  While no
+# Deluge is connected, look again at most this often to notice it being plugged in.
+PORT_RESCAN_INTERVAL = 2  # Integer seconds
+
+# How many file read requests to keep in flight at once.  Replies can arrive in any order and are
+# put back together by address.  Set to 1 to wait for each block before asking for the next one.
+READ_WINDOW_SIZE = 8
+
+# File reads start at READ_BLOCK_SIZE bytes per request.  The size grows while bigger blocks come back
+# quicker and shrinks on errors or short reads, and is remembered per device between Live sessions.
+READ_BLOCK_SIZE = 512
+READ_BLOCK_SIZE_MIN = 256
+READ_BLOCK_SIZE_MAX = 4096
+
+# A block that doesn't come back within READ_BLOCK_TIMEOUT seconds, or comes back with an error, is
+# asked for again up to READ_RETRIES times, waiting READ_RETRY_BACKOFF seconds before the first retry
+# and twice as long before each one after that.  If it still fails, what was read so far is kept and
+# the read carries on from there once the connection is back.
+READ_BLOCK_TIMEOUT = 2
+READ_RETRIES = 4
+READ_RETRY_BACKOFF = 0.05
+
+# How many broken off reads to keep, and for how many seconds, so the next try can carry on from them
+PARTIAL_CACHE_SIZE = 4
+PARTIAL_MAX_AGE = 300  # Integer seconds
+
+# Where DAL Connector keeps what it learns between Live sessions.  Looked up each time it is used,
+# so setting config.DATA_DIR after import (as the tests do) takes effect.
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.dalconnector')
+
+# Songs that were fetched before are kept on disk, with their conversion, so reloading a song
+# that hasn't changed on the Deluge skips both the transfer and the parsing.
+# The least recently used songs are dropped once the cache grows past this many bytes.
+SONG_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# How many song series (8, 8A, 8B...) to remember the latest save of, so a rescan can start there
+SERIES_CACHE_SIZE = 256
+
+# Loading a song into Live is spread over several UI ticks so Live keeps running smoothly.
+# This is how much time, in milliseconds, each tick may spend creating clips and notes.
+LOAD_TIME_PER_TICK = 30  # Integer milliseconds
+
+# In the background DAL Connector keeps an index of every song on the card, built by reading just the
+# first INDEX_HEAD_BYTES of each new or changed file (enough for the BPM and a rough clip count), which
+# the track name shows while a song that isn't cached is fetched.  While the index has been checked against the card within INDEX_MAX_AGE seconds, song names
+# are checked against it instead of asking the Deluge.
+INDEX_HEAD_BYTES = 4096
+INDEX_MAX_AGE = 60  # Integer seconds
+
+# Every load writes a summary of where its time went (port discovery, handshake, block round trips,
+# unpacking, conversion, Live API calls) to the Live log.  Set this to a file path to also append
+# each summary to it as a line of JSON, or None for the log only.
+STATS_FILE = None
+
 # SysEx Protocol for Deluge Communication
 # ======================================
 # Based on the DelugeWeb project implementation, the actual SysEx protocol is:
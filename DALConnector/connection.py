@@ -0,0 +1,295 @@
+from .config import DELUGE_MIDI_PORT_NAME, MIDI_TIMEOUT, CONNECTION_HEALTH_INTERVAL
+from .config import DELUGE_MANUFACTURER_ID, DELUGE_DEVICE_ID, SYSEX_START, SYSEX_EOX
+from .config import SYSEX_CMD_JSON, SYSEX_CMD_JSON_REPLY, create_session_request
+
+from .codec import findseparator
+from .ports import PortRegistry
+from .stats import timed
+
+import logging
+import json
+import threading
+import time
+import uuid
+import mido
+
+logger = logging.getLogger(__name__)
+
+
+# mido wants sysex data without the 0xF0 / 0xF7 framing bytes and hands it back the same way
+def unframe(data):
+    data = bytes(data)
+
+    if data and data[0] == SYSEX_START:
+        data = data[1:]
+
+    if data and data[-1] == SYSEX_EOX:
+        data = data[:-1]
+
+    return data
+
+
+class DelugeConnection(object):
+    """Ports and JSON session with the Deluge, kept open across fetches"""
+
+    HEADER = DELUGE_MANUFACTURER_ID + [DELUGE_DEVICE_ID]
+    MANUFACTURER = bytes(DELUGE_MANUFACTURER_ID)
+    PAYLOAD_START = 6   # [00 21 7B 01 cmd seq] json...
+
+    def __init__(self, portname = DELUGE_MIDI_PORT_NAME, ports = mido, registry = None):
+        self.portname = portname
+        self.ports = ports          # Where ports come from: mido, or anything that looks like it such as the emulator
+        self.registry = registry or PortRegistry(portname, ports)
+        self.device = portname      # The full name of the port we actually opened
+
+        self.outport = None
+        self.inport = None
+
+        self.session = None
+        self.seqmin = 1
+        self.seqmax = 127
+        self.seq = None
+
+        # Replies are decoded on the MIDI input thread as they arrive and parked here until the
+        # request with that sequence number picks them up
+        self.replies = {}       # seq -> (response, data)
+        self.arrived = threading.Condition()
+        self.lastactivity = 0
+
+    ############################################
+    # LIFECYCLE
+    def isopen(self):
+        if self.outport is None or self.inport is None:
+            return False
+
+        if self.outport.closed or self.inport.closed:
+            return False
+
+        return self.session is not None
+
+    def ensure(self):
+        """Make sure there is a live session, reconnecting if needed.  Cheap when nothing is wrong."""
+        if self.isopen():
+            if time.time() - self.lastactivity < CONNECTION_HEALTH_INTERVAL:
+                return True
+
+            # Been quiet for a while, make sure the Deluge still knows us
+            if self._handshake():
+                return True
+
+            logger.info(f'Deluge session went stale, reconnecting')
+            self.close()
+
+        return self.open()
+
+    def open(self):
+        self.close()
+
+        with timed('ports'):
+            if not self._openports():
+                return False
+
+        if not self._handshake():
+            logger.info(f'ERROR: Could not establish session with Deluge')
+
+            # Nobody answered on those ports, whatever is there now may not be our Deluge
+            self.registry.invalidate()
+            self.close()
+            return False
+
+        return True
+
+    def _openports(self):
+        found = self.registry.resolve()
+
+        # The remembered ports have gone, look again in case the Deluge came back under another name
+        if found is not None and not self._tryopen(*found):
+            found = self.registry.rescan()
+
+            if found is not None and not self._tryopen(*found):
+                self.registry.invalidate()
+                return False
+
+        if found is None:
+            logger.info(f'ERROR: Deluge MIDI port "{self.portname}" not found')
+            logger.info(f'Available ports: {self.registry.available}')
+            self.registry.invalidate()
+            return False
+
+        return True
+
+    def _tryopen(self, output, input):
+        self.device = output
+
+        try:
+            self.outport = self.ports.open_output(output)
+            self.inport = self.ports.open_input(input, callback = self._onmessage)
+        except Exception as e:
+            logger.info(f'ERROR: Could not open Deluge MIDI port {output}: {e}')
+            self.close()
+            return False
+
+        return True
+
+    def close(self):
+        for port in (self.outport, self.inport):
+            if port is None:
+                continue
+
+            try:
+                port.close()
+            except Exception as e:
+                logger.info(f'Error closing MIDI port: {e}')
+
+        self.outport = None
+        self.inport = None
+        self.session = None
+        self.lastactivity = 0
+
+        with self.arrived:
+            self.replies = {}
+
+    def _handshake(self):
+        session_uuid = str(uuid.uuid4())
+
+        def issession(seq, response):
+            session_data = response.get('^session')
+            return session_data is not None and session_data.get('tag') == session_uuid
+
+        logger.info(f'Establishing session with Deluge...')
+
+        with timed('handshake'):
+            self._send(create_session_request(session_uuid))
+            got = self._take(issession, MIDI_TIMEOUT)
+
+        if got is None:
+            self.session = None
+            return False
+
+        seq, (response, data) = got
+
+        self.session = response['^session']
+        self.seqmin = self.session.get('midMin', 1)
+        self.seqmax = self.session.get('midMax', 127)
+        self.seq = None
+
+        logger.info(f'Session established successfully')
+        return True
+
+    ############################################
+    # MESSAGES
+    def nextseq(self):
+        if self.seq is None or self.seq >= self.seqmax:
+            self.seq = self.seqmin
+        else:
+            self.seq += 1
+
+        return self.seq
+
+    def send(self, command):
+        """Send a JSON command and return the sequence number its reply will carry"""
+        seq = self.nextseq()
+
+        # Anything still parked under this number is a late reply to an old request
+        with self.arrived:
+            self.replies.pop(seq, None)
+
+        cmd_json = json.dumps(command).encode('utf-8')
+
+        self._send([SYSEX_START] + self.HEADER + [SYSEX_CMD_JSON, seq] + list(cmd_json) + [SYSEX_EOX])
+
+        return seq
+
+    def wait(self, seq, timeout = MIDI_TIMEOUT):
+        """Wait for the reply to seq.  Returns (response, data) or None on timeout."""
+        got = self.waitany((seq, ), timeout)
+        if got is None:
+            return None
+
+        return got[1]
+
+    def waitany(self, seqs, timeout = MIDI_TIMEOUT):
+        """Wait for whichever of seqs is answered first.  Returns (seq, (response, data)) or None on timeout."""
+        seqs = set(seqs)
+
+        got = self._take(lambda seq, response: seq in seqs, timeout)
+        if got is None:
+            # Force a health check before the next fetch trusts this session again
+            self.lastactivity = 0
+
+        return got
+
+    def _take(self, accept, timeout):
+        """Block until a reply accept(seq, response) likes has arrived, then hand it over"""
+        timeout_time = time.time() + timeout
+
+        with self.arrived:
+            while True:
+                for seq, reply in self.replies.items():
+                    if accept(seq, reply[0]):
+                        del self.replies[seq]
+                        return seq, reply
+
+                remaining = timeout_time - time.time()
+                if remaining <= 0:
+                    return None
+
+                self.arrived.wait(remaining)
+
+    def seqcount(self):
+        """How many requests can be in flight before sequence numbers repeat"""
+        return self.seqmax - self.seqmin + 1
+
+    def command(self, command):
+        """Send a JSON command and return the decoded reply body, e.g. the contents of ^open"""
+        cmd_type = list(command.keys())[0]
+
+        reply = self.wait(self.send(command))
+        if reply is None:
+            logger.info(f'Timeout waiting for response to {cmd_type} command')
+            return None
+
+        response, data = reply
+        return response.get(f'^{cmd_type}')
+
+    def _send(self, sysex_data):
+        self.outport.send(mido.Message('sysex', data = unframe(sysex_data)))
+
+    def _onmessage(self, msg):
+        """Called on the MIDI input thread for every incoming message"""
+        if msg.type != 'sysex':
+            return
+
+        reply = self._decode(msg.data)
+        if reply is None:
+            return
+
+        seq, response, data = reply
+
+        with self.arrived:
+            self.replies[seq] = (response, data)
+            self.lastactivity = time.time()
+            self.arrived.notify_all()
+
+    def _decode(self, data):
+        """Split a Deluge JSON reply into its sequence number and parsed JSON.  data keeps any attachment."""
+        data = unframe(data)
+
+        if (len(data) <= self.PAYLOAD_START or
+            data[0:3] != self.MANUFACTURER or
+            data[3] != DELUGE_DEVICE_ID or
+            data[4] != SYSEX_CMD_JSON_REPLY):
+            return None
+
+        # JSON runs up to the 0x00 separator in front of attached binary data, or to the end
+        json_end = findseparator(data, self.PAYLOAD_START)
+        if json_end < 0:
+            json_end = len(data)
+
+        try:
+            response = json.loads(data[self.PAYLOAD_START:json_end].decode('utf-8'))
+        except Exception as e:
+            logger.info(f'Error parsing JSON response: {e}')
+            return None
+
+        return data[5], response, data
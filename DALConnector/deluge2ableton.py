@@ -1,7 +1,113 @@
+import codecs
 import json
 import re
 import sys
 
+from array import array
+
+# Every name="value" pair in a tag, and the start tag of every note row in a clip body.
+# Each clip header and each note row is run through ATTRIBUTE exactly once.
+ATTRIBUTE = re.compile(r'([\w:.-]+)="([^"]*)"')
+NOTE_ROW = re.compile(r'<noteRow\b([^>]*)>')
+
+
+def attributes(tag):
+    return dict(ATTRIBUTE.findall(tag))
+
+
+def digits(value, default = 0):
+    if value is None or not value.isdigit():
+        return default
+
+    return int(value)
+
+
+# array typecode for unsigned 32 bit values on this platform
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+LOW7 = bytes(b & 0x7F for b in range(256))
+
+
+class NoteBlock(object):
+    """The notes of one note row, held as one array per field rather than a dict per note.
+
+    Times stay in Deluge ticks and probability as the raw 0-20 step until the notes are read
+    back by iterating, which yields (pitch, starttime, duration, velocity, probability) in
+    Ableton units.
+    """
+
+    __slots__ = ('pitch', 'start', 'duration', 'velocity', 'probability')
+
+    NOTE_BYTES = 10    # start(4) duration(4) velocity(1) probability(1), big endian
+
+    def __init__(self):
+        self.pitch = array('B')
+        self.start = array(UINT32)
+        self.duration = array(UINT32)
+        self.velocity = array('B')
+        self.probability = array('B')
+
+    @classmethod
+    def decode(self, pitch, notedata):
+        """Build from a noteData attribute, "0x" then 20 hex digits per note"""
+        block = NoteBlock()
+
+        raw = bytes.fromhex(notedata[2:2 + (len(notedata) - 2) // 20 * 20])
+        count = len(raw) // self.NOTE_BYTES
+        if count == 0:
+            return block
+
+        block.pitch = array('B', bytes([pitch]) * count)
+        block.start = self._column32(raw, 0, count)
+        block.duration = self._column32(raw, 4, count)
+        block.velocity = array('B', raw[8::self.NOTE_BYTES])
+        block.probability = array('B', raw[9::self.NOTE_BYTES].translate(LOW7))
+
+        return block
+
+    @classmethod
+    def _column32(self, raw, offset, count):
+        # Gather the four bytes of the field from every note, then read them in one go
+        buf = bytearray(4 * count)
+        for i in range(4):
+            buf[i::4] = raw[offset + i::self.NOTE_BYTES]
+
+        column = array(UINT32, bytes(buf))
+        if sys.byteorder == 'little':
+            column.byteswap()
+
+        return column
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        ppqn = Instrument.PPQN
+
+        for pitch, start, duration, velocity, probability in zip(self.pitch, self.start, self.duration, self.velocity, self.probability):
+            yield pitch, start / ppqn, duration / ppqn, velocity, (probability * 5) / 100
+
+    def __eq__(self, other):
+        if not isinstance(other, NoteBlock):
+            return NotImplemented
+
+        return all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state):
+        for f, value in zip(self.__slots__, state):
+            setattr(self, f, value)
+
+
 class Instrument(object):
     PPQN = 24 * 4
 
@@ -10,68 +116,61 @@ class Instrument(object):
         self.body = body
         self.instrumentname = instrumentname
 
+        self.attrs = attributes(header)
+
     ################################################################
     # Section aka scene
     ################################################################
     def section(self):
-        section = re.search(r'section="(\d+)"', self.header)
-        if not section:
-            return 0
-        else:
-            return int(section.groups()[0])
+        return digits(self.attrs.get('section'))
 
     def length(self):
-        length = re.search(r'length="(\d+)"', self.header)
-
-        if not length:
-            return 0
-        else:
-            return int(length.groups()[0]) / self.PPQN
+        return digits(self.attrs.get('length')) / self.PPQN
 
 
     def _decodenotes(self, pitch, notedata):
-        notes = []
-
-        pos = 2
-        while pos < len(notedata):
-            notehex = notedata[pos:pos+20]
-            starttime = int(notehex[0:8], 16)
-            duration = int(notehex[8:16], 16)
-            velocity = int(notehex[16:18], 16)
-            probability = int(notehex[18:20], 16) & 0x7F
-
-            hsh = {}
-            hsh['pitch'] = pitch
-            hsh['duration'] = duration / self.PPQN
-            hsh['velocity'] = velocity
-            hsh['probability'] = (probability * 5) / 100
-            hsh['starttime'] = starttime / self.PPQN
-
-            notes.append(hsh)
-
-            pos += 20
-
-        return notes
+        return NoteBlock.decode(pitch, notedata)
 
 
     def identifier(self):
-        identifier = re.search(r'instrumentPresetSlot="(.+?)"', self.header)
+        identifier = self.attrs.get('instrumentPresetSlot')
         if not identifier:
             return None
 
-        identifier = int(identifier.groups()[0])
+        identifier = int(identifier)
 
         #############################
 
-        subidentifier = re.search(r'instrumentPresetSubSlot="(.+?)"', self.header)
+        subidentifier = self.attrs.get('instrumentPresetSubSlot')
         if not subidentifier:
             return None
 
-        subidentifier = int(subidentifier.groups()[0])
+        subidentifier = int(subidentifier)
 
         return f'{self.instrumentname} {identifier}.{subidentifier}'
 
 
+    def noterows(self):
+        """Attribute map of every note row in the clip"""
+        return [attributes(m.group(1)) for m in NOTE_ROW.finditer(self.body)]
+
+    def pitch(self, row):
+        return digits(row.get('y'), None)
+
+    def notes(self):
+        arr = []
+        for row in self.noterows():
+            notedata = row.get('noteData')
+            pitch = self.pitch(row)
+
+            if not notedata or pitch is None:
+                continue
+
+            arr.append(self._decodenotes(pitch = pitch, notedata = notedata))
+
+        return arr
+
+
     @classmethod
     def build(self, header, body):
         if '<kitParams' in body:
@@ -90,63 +189,105 @@ class Midi(Instrument):
 
 
     def midichannel(self):
-        midichannel = re.search(r'midiChannel="(\d+)"', self.header)
-        if not midichannel:
-            return 0
-        else:
-            return int(midichannel.groups()[0])
+        return digits(self.attrs.get('midiChannel'))
 
     def identifier(self):
         return f'{self.instrumentname} {self.midichannel()}'
 
 
-    def notes(self):
-        arr = []
-        for n in re.findall(r'<noteRow.+?y="(\d+)".+?noteData="(.+?)"', self.body, re.DOTALL):
-            notes = self._decodenotes(pitch = int(n[0]), notedata = n[1])
-            arr.append(notes)
-
-        return arr
-
-
 
 class Synth(Instrument):
     def __init__(self, header, body):
         super().__init__(header = header, body = body, instrumentname = 'synth')
 
 
-    def notes(self):
-        arr = []
-        for n in re.findall(r'<noteRow.+?y="(\d+)".+?noteData="(.+?)"', self.body, re.DOTALL):
-            notes = self._decodenotes(pitch = int(n[0]), notedata = n[1])
-            arr.append(notes)
-
-        return arr
-
 class Kit(Instrument):
     def __init__(self, header, body):
         super().__init__(header = header, body = body, instrumentname = 'kit')
 
 
-    def notes(self):
-        arr = []
+    def pitch(self, row):
+        drumindex = digits(row.get('drumIndex'), None)
+        if drumindex is None:
+            return None
 
-        for n in re.findall(r'<noteRow.+?noteData="(.+?)".+?drumIndex="(\d+)"', self.body, re.DOTALL):
-            notes = self._decodenotes(pitch = 36 + int(n[1]), notedata = n[0])
+        return 36 + drumindex
 
-            arr.append(notes)
 
-        return arr
+class StreamConverter(object):
+    """Converts song XML while it is still arriving.
 
+    feed() takes the file a block at a time (bytes or str).  Every instrumentClip is converted as
+    soon as its closing tag comes in and then thrown away, so only the unfinished clip is ever held
+    as text.  finish() puts the clips in Ableton order and returns the songhsh.
+    """
 
-class Deluge2Ableton(object):
-    DEFAULT_BPM = 120
+    CLIP_START = '<instrumentClip'
+    CLIP_END = '</instrumentClip>'
+    CLIP_HEADER = re.compile(r'<instrumentClip(\s[^>]*)>')
+    LAST_TAG_END = re.compile(r'>[^>]*$')
 
-    def init(self, xml):
-        self.xml = xml
+    BPM_ATTRIBUTES = {
+        'tptt': re.compile(r'timePerTimerTick="(\d+)"'),
+        'ttf': re.compile(r'timerTickFraction="(-*\d+)"'),
+        'itm': re.compile(r'inputTickMagnitude="(\d+)"'),
+        }
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors = 'ignore')
+        self.buffer = ''
+
+        self.clips = []          # Converted clips in file order
+        self.bpmvalues = {}      # Whatever BPM attributes have turned up so far
+
+    def feed(self, data):
+        """Add the next piece of the file.  Returns the clips it completed."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = self.decoder.decode(bytes(data))
+
+        self.buffer += data
+
+        completed = []
+        while True:
+            start = self.buffer.find(self.CLIP_START)
+            if start < 0:
+                self._skip(self.buffer, final = False)
+                break
+
+            header = self.CLIP_HEADER.match(self.buffer, start)
+            if header is None:
+                # Either the header isn't all here yet, or it's some other tag such as <instrumentClips>
+                if self.buffer.find('>', start) < 0:
+                    self._skip(self.buffer[:start], final = True)
+                    self.buffer = self.buffer[start:]
+                    break
+
+                self._skip(self.buffer[:start + len(self.CLIP_START)], final = True)
+                self.buffer = self.buffer[start + len(self.CLIP_START):]
+                continue
+
+            end = self.buffer.find(self.CLIP_END, header.end())
+            if end < 0:
+                self._skip(self.buffer[:start], final = True)
+                self.buffer = self.buffer[start:]
+                break
+
+            self._skip(self.buffer[:start], final = True)
+
+            clip = self._convertclip(header.group(1), self.buffer[header.end():end])
+            if clip is not None:
+                self.clips.append(clip)
+                completed.append(clip)
+
+            self.buffer = self.buffer[end + len(self.CLIP_END):]
+
+        return completed
+
+    def finish(self):
+        self.buffer += self.decoder.decode(b'', final = True)
+        self._skip(self.buffer, final = True)
+        self.buffer = ''
 
-    @classmethod
-    def convert(self, xml):
         maxsceneid = 0
         clipmap = {}   # Order doesn't matter.  Each clip is a bucket of notes with key of identifier/sceneid
 
@@ -155,15 +296,10 @@ class Deluge2Ableton(object):
         ordering = []  # Maintain the order in which tracks appeared via their identifier
 
         # The instruments are in reverse order that you'd expect them in Ableton
-        for m in reversed(re.findall(r'<instrumentClip(.+?)>(.+?)</instrumentClip>', xml, re.DOTALL)):
-            o = Instrument.build(m[0], m[1])
-
-            if not o:
-                continue
-
-            sceneid = o.section()
+        for clip in reversed(self.clips):
+            identifier = clip['identifier']
+            sceneid = clip['sceneidx']
             maxsceneid = max(maxsceneid, sceneid)
-            identifier = o.identifier()
 
             if not identifier:
                 continue
@@ -176,9 +312,9 @@ class Deluge2Ableton(object):
                 trackmap[identifier] = len(ordering)
                 ordering.append(identifier)
 
-            for notedata in o.notes():
+            for notedata in clip['notes']:
                 clipmap[key].append({
-                    'length': o.length(),
+                    'length': clip['length'],
                     'trackidx': trackmap[identifier],
                     'sceneidx': sceneid,
                     'notes': notedata,
@@ -188,13 +324,64 @@ class Deluge2Ableton(object):
         for value in clipmap.values():
             result += value
 
-        bpm = self._extractbpm(xml)
+        bpm = Deluge2Ableton._tempo(self.bpmvalues.get('tptt'), self.bpmvalues.get('ttf'), self.bpmvalues.get('itm'))
 
         songhsh = { 'bpm': bpm, 'numscenes': maxsceneid, 'clipmap': list(reversed(result)), 'maxtrackid': len(ordering) }
 
-
         return songhsh
 
+    def _convertclip(self, header, body):
+        o = Instrument.build(header, body)
+
+        if not o:
+            return None
+
+        # Clips without an identifier still count towards the number of scenes
+        clip = { 'identifier': o.identifier(), 'sceneidx': o.section(), 'length': o.length(), 'notes': [] }
+
+        if clip['identifier']:
+            clip['notes'] = o.notes()
+
+        return clip
+
+    def _skip(self, text, final):
+        """Text outside of any clip.  Only the song level BPM attributes are wanted from it."""
+
+        # A tag can be split across two blocks, so unless this text is known to be complete
+        # only look at (and let go of) the whole tags in it
+        if not final:
+            lastend = self.LAST_TAG_END.search(text)
+            if lastend is None:
+                return
+
+            self.buffer = text[lastend.start() + 1:]
+            text = text[:lastend.start() + 1]
+
+        if len(self.bpmvalues) == len(self.BPM_ATTRIBUTES):
+            return
+
+        for name, pattern in self.BPM_ATTRIBUTES.items():
+            if name in self.bpmvalues:
+                continue
+
+            found = pattern.search(text)
+            if found:
+                self.bpmvalues[name] = int(found.groups()[0])
+
+
+class Deluge2Ableton(object):
+    DEFAULT_BPM = 120
+
+    def init(self, xml):
+        self.xml = xml
+
+    @classmethod
+    def convert(self, xml):
+        converter = StreamConverter()
+        converter.feed(xml)
+
+        return converter.finish()
+
 
 
     @classmethod
@@ -217,6 +404,13 @@ class Deluge2Ableton(object):
         else:
             itm = int(itm.groups()[0])
 
+        return self._tempo(tptt, ttf, itm)
+
+    @classmethod
+    def _tempo(self, tptt, ttf, itm):
+        if tptt is None or ttf is None or itm is None:
+            return self.DEFAULT_BPM
+
         ttf /= 0x100000000
 
         tempo = (551250 / (ttf + tptt)) / (10 * itm)
@@ -235,7 +429,7 @@ if __name__ == "__main__":
 
     result = Deluge2Ableton.convert(readdata)
 
-    print(json.dumps(result, indent = 4, sort_keys = True))
+    print(json.dumps(result, indent = 4, sort_keys = True, default = list))
 
 
 
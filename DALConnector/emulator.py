@@ -0,0 +1,272 @@
+from .config import DELUGE_MIDI_PORT_NAME, DELUGE_DEVICE_ID, SYSEX_CMD_JSON, SYSEX_CMD_JSON_REPLY
+from .connection import DelugeConnection, unframe
+from .codec import pack8to7, findseparator
+from .transport import fatdatetime, findpath
+
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import mido
+
+logger = logging.getLogger(__name__)
+
+
+class DelugeEmulator(object):
+    """The DelugeWeb SysEx protocol served from a local folder, for testing without a Deluge.
+
+    Stands in for mido: get_output_names(), open_output() and open_input() hand out ports that
+    behave like mido's, so a DelugeConnection(ports = emulator) talks to it the way it talks to the
+    real thing.  Replies go out one after another over a simulated wire, so latency and bandwidth
+    add up the way they do over USB.
+
+    latency    seconds from a request arriving to its reply starting to go out
+    bandwidth  bytes per second on the wire, None for no limit
+    maxblock   the most bytes a single read returns, bigger reads come back short
+    drop       chance a reply never comes
+    error      chance a read or dir reply comes back with an error
+    short      chance a read comes back with only part of what was asked for
+    reorder    chance a reply is held back behind later ones
+    dates      put date and time in open replies too, which the firmware doesn't
+    """
+
+    ERR_NO_FILE = 4            # FatFS FR_NO_FILE
+    ERR_INVALID = 9            # FatFS FR_INVALID_OBJECT
+
+    def __init__(self, folder, portname = DELUGE_MIDI_PORT_NAME + ' (emulated)', latency = 0, bandwidth = None,
+                 maxblock = 4096, drop = 0, error = 0, short = 0, reorder = 0, dates = False, seed = None):
+        self.folder = folder
+        self.portname = portname
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.maxblock = maxblock
+        self.drop = drop
+        self.error = error
+        self.short = short
+        self.reorder = reorder
+        self.dates = dates             # Include date and time in open replies, the Deluge only gives them in dir
+
+        self.random = random.Random(seed)
+
+        self.callback = None
+        self.files = {}                # fid -> bytes of the open file
+        self.fids = itertools.count(1)
+        self.counts = collections.Counter()
+        self.bytessent = 0
+
+        self.lock = threading.Condition()
+        self.outbox = []               # (deliver at, order, sysex data)
+        self.order = itertools.count()
+        self.wireclock = 0             # When the wire is next free
+        self.running = False
+
+    ############################################
+    # MIDO STAND-INS
+    def get_output_names(self):
+        return [self.portname]
+
+    def get_input_names(self):
+        return [self.portname]
+
+    def open_output(self, name, **k):
+        return EmulatorPort(self, name)
+
+    def open_input(self, name, callback = None, **k):
+        self.callback = callback
+        self._start()
+
+        return EmulatorPort(self, name)
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.outbox = []
+            self.lock.notify_all()
+
+    ############################################
+    # REQUESTS
+    def receive(self, data):
+        """Handle one SysEx message from the host"""
+        data = unframe(data)
+        if len(data) <= DelugeConnection.PAYLOAD_START or data[4] != SYSEX_CMD_JSON:
+            return
+
+        seq = data[5]
+
+        end = findseparator(data, DelugeConnection.PAYLOAD_START)
+        try:
+            command = json.loads(data[DelugeConnection.PAYLOAD_START:end if end >= 0 else len(data)].decode('utf-8'))
+            name, args = next(iter(command.items()))
+        except Exception as e:
+            logger.info(f'Emulator could not parse request: {e}')
+            return
+
+        self.counts[name] += 1
+
+        handler = getattr(self, f'_{name}', None)
+        if handler is None:
+            self._reply(seq, name, { 'err': self.ERR_INVALID })
+            return
+
+        handler(seq, args)
+
+    def _session(self, seq, args):
+        self._reply(seq, 'session', { 'tag': args.get('tag'), 'sid': 1, 'midMin': 16, 'midMax': 127 })
+
+    def _open(self, seq, args):
+        path = self._path(args.get('path', ''))
+        if path is None or args.get('write'):
+            self._reply(seq, 'open', { 'err': self.ERR_NO_FILE })
+            return
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        fid = next(self.fids)
+        self.files[fid] = content
+
+        result = { 'fid': fid, 'size': len(content), 'err': 0 }
+        if self.dates:
+            result['date'], result['time'] = fatdatetime(os.path.getmtime(path))
+
+        self._reply(seq, 'open', result)
+
+    def _read(self, seq, args):
+        fid = args.get('fid')
+        addr = args.get('addr', 0)
+        size = min(args.get('size', 0), self.maxblock)
+
+        if fid not in self.files or self._chance(self.error):
+            self._reply(seq, 'read', { 'fid': fid, 'addr': addr, 'err': self.ERR_INVALID })
+            return
+
+        if size > 1 and self._chance(self.short):
+            size = self.random.randrange(1, size)
+
+        block = self.files[fid][addr:addr + size]
+        self._reply(seq, 'read', { 'fid': fid, 'addr': addr, 'size': len(block), 'err': 0 }, block)
+
+    def _close(self, seq, args):
+        fid = args.get('fid')
+        err = 0 if self.files.pop(fid, None) is not None else self.ERR_INVALID
+
+        self._reply(seq, 'close', { 'fid': fid, 'err': err })
+
+    def _dir(self, seq, args):
+        folder = self._path(args.get('path', ''), directory = True)
+        if folder is None or self._chance(self.error):
+            self._reply(seq, 'dir', { 'err': self.ERR_NO_FILE })
+            return
+
+        offset = args.get('offset', 0)
+        lines = args.get('lines', 20)
+
+        entries = []
+        for name in sorted(os.listdir(folder))[offset:offset + lines]:
+            full = os.path.join(folder, name)
+            date, clock = fatdatetime(os.path.getmtime(full))
+
+            entries.append({
+                'name': name,
+                'size': os.path.getsize(full) if os.path.isfile(full) else 0,
+                'date': date,
+                'time': clock,
+                'attr': 0x10 if os.path.isdir(full) else 0x20,
+                })
+
+        self._reply(seq, 'dir', { 'list': entries, 'err': 0 })
+
+    def _path(self, path, directory = False):
+        return findpath(self.folder, path, directory)
+
+    def _chance(self, probability):
+        return probability > 0 and self.random.random() < probability
+
+    ############################################
+    # REPLIES
+    def _reply(self, seq, name, body, attachment = None):
+        if self._chance(self.drop):
+            return
+
+        data = bytes([0x00, 0x21, 0x7B, DELUGE_DEVICE_ID, SYSEX_CMD_JSON_REPLY, seq]) + json.dumps({ f'^{name}': body }).encode('utf-8')
+        if attachment is not None:
+            data += b'\x00' + pack8to7(attachment)
+
+        with self.lock:
+            now = time.time()
+
+            # Replies share one wire, each waits for the one in front of it to finish
+            start = max(now + self.latency, self.wireclock)
+            if self.bandwidth:
+                self.wireclock = start + (len(data) + 2) / self.bandwidth
+            else:
+                self.wireclock = start
+
+            deliver = self.wireclock
+            if self._chance(self.reorder):
+                deliver += self.latency + 0.01
+
+            self.bytessent += len(data) + 2
+            heapq.heappush(self.outbox, (deliver, next(self.order), data))
+            self.lock.notify_all()
+
+    def _start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.running = True
+
+        thread = threading.Thread(target = self._deliver, name = 'DelugeEmulator', daemon = True)
+        thread.start()
+
+    def _deliver(self):
+        """Hands replies to the input callback once their time comes, like the MIDI input thread would"""
+        while True:
+            with self.lock:
+                while self.running and (not self.outbox or self.outbox[0][0] > time.time()):
+                    wait = self.outbox[0][0] - time.time() if self.outbox else None
+                    self.lock.wait(wait)
+
+                if not self.running:
+                    return
+
+                data = heapq.heappop(self.outbox)[2]
+                callback = self.callback
+
+            # Made here rather than in _reply so the host's thread doesn't pay for it
+            if callback:
+                callback(sysex(data))
+
+
+def sysex(data):
+    """mido sysex message of data, which we built ourselves so mido needn't check every byte"""
+    try:
+        return mido.Message('sysex', data = data, skip_checks = True)
+    except TypeError:
+        # mido before 1.3 always checks
+        return mido.Message('sysex', data = data)
+
+
+class EmulatorPort(object):
+    """Enough of a mido port for DelugeConnection"""
+
+    def __init__(self, emulator, name):
+        self.emulator = emulator
+        self.name = name
+        self.closed = False
+
+    def send(self, message):
+        if self.closed:
+            raise IOError(f'{self.name} is closed')
+
+        self.emulator.receive(message.data)
+
+    def close(self):
+        self.closed = True
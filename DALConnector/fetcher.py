@@ -1,19 +1,19 @@
-from .config import DELUGE_MIDI_PORT_NAME, MIDI_TIMEOUT
-from .config import DELUGE_MANUFACTURER_ID, DELUGE_DEVICE_ID, SYSEX_START, SYSEX_EOX
-from .config import SYSEX_CMD_JSON, SYSEX_CMD_JSON_REPLY, SYSEX_DEBUG_START, create_session_request
-from .config import WATCH_FOR_NEW_SAVES, NEW_SAVE_SLEEP_TIMER
-from .deluge2ableton import Deluge2Ableton
-from .local import propername, displayname
+from .config import WATCH_FOR_NEW_SAVES, PREFETCH_NEXT_SONGS, NEW_SAVE_SLEEP_TIMER
+from .transport import opentransport
+from .deluge2ableton import StreamConverter
+from .local import propername, displayname, nextnumber, songfilename, songpath, SONGS_DIR
+from .cache import SongCache, SeriesCache
+from .jobs import JobQueue, Cancelled, LOAD, WATCH, SCAN, PREFETCH, INDEX
+from .indexer import SongIndex, Indexer, describe
+from .stats import LoadStats, recording, timed, tally
 
 import _thread
+import collections
+import itertools
 import logging
+import queue
 import re
 import time
-import mido
-import json
-import uuid
-
-from time import sleep
 
 logger = logging.getLogger(__name__)
 
@@ -23,545 +23,457 @@ class Fetcher(object):
 
     SLEEPTIME = 1.0
 
-    KNOWN_CACHE = {}           # What's the last known song in a series...  2, 2a, 2b, 2c...
+    KNOWN_CACHE = SeriesCache()  # What's the last known song in a series...  2, 2a, 2b, 2c...
+
+    def __init__(self, transport = None):
+        self.transport = transport or opentransport()     # USB ports and session survive between fetches
+        self.songcache = SongCache()
+        self.index = SongIndex()
+
+        self.job = None            # What the thread is working on, None when used directly
+        self.stats = None          # Where the time goes in that job, handed to Live with any song it finds
+        self.targets = {}          # target -> Watch, what is being watched for each dc: track
 
     def start(self, ts):
         self.ts = ts
-        self.nextsong = None
-        self.scanstarttime = None
+
+        self.songnames = None      # Every song on the card as of the last scan, None if it couldn't be listed
 
         # logger.info(f' FETCHER THREAD STARTING')
 
+        self.ts.jobs.put(INDEX, None)
+
         try:
             self.loop()
         except Exception as e:
             logger.info(f'MAJOR THREAD EXCEPTION!  {e}')
 
+    @property
+    def requestid(self):
+        """The Live request everything we send back answers"""
+        return self.job.requestid if self.job else None
+
+    @property
+    def watch(self):
+        """Watch state of the target the current job is for"""
+        target = self.job.target if self.job else None
+        return self.targets.setdefault(target, Watch())
+
     def loop(self):
         while True:
             if self.ts.isfinished():
                 logger.info(u'THREAD EXIT')
+                self.transport.close()
                 return
 
-            delugesong = self.ts.targetsong()
-            if delugesong is not None:
-                self.nextsong = None
-                self._mainfetch(delugesong)
+            # Wakes up as soon as Live asks for a song or a watch poll falls due
+            job = self.ts.jobs.get(self.SLEEPTIME)
+            if job is None:
+                continue
 
-            if self.nextsong is not None:
-                self._nextsongfetch()
+            self.job = job
+            self.stats = LoadStats()
 
-            sleep(self.SLEEPTIME)
+            try:
+                with recording(self.stats):
+                    self._runjob(job)
+            except Cancelled as e:
+                logger.info(f'Cancelled {e}')
+
+                # Indexing picks up where it left off once the load is done
+                if job.kind == INDEX:
+                    self.ts.jobs.put(INDEX, None)
+            except Exception as e:
+                # One bad song or a full disk shouldn't stop the thread for good
+                logger.info(f'ERROR!  {job} failed - {e}')
+
+                if job.kind == LOAD and not job.answered:
+                    self.ts.setresult(self._answer(), delugesong = job.delugesong, songhsh = None, error = True)
+            finally:
+                self.job = None
+                self.stats = None
+
+    def _runjob(self, job):
+        watch = self.watch
+
+        if job.kind == LOAD:
+            watch.nextsong = None
+            if self._mainfetch(job.delugesong):
+                self.ts.jobs.follow(job, SCAN, job.delugesong)
+
+        elif job.kind == SCAN:
+            watch.nextsong = self._findunusedname(job.delugesong)
+            if watch.nextsong is not None and WATCH_FOR_NEW_SAVES:
+                self.ts.jobs.follow(job, WATCH, watch.nextsong, self.SLEEPTIME)
+
+            if PREFETCH_NEXT_SONGS:
+                for name in self._prefetchnames(job.delugesong):
+                    self.ts.jobs.follow(job, PREFETCH, name)
+
+        elif job.kind == WATCH:
+            watch.nextsong = job.delugesong
+            self._nextsongfetch()
+            if watch.nextsong is not None:
+                self.ts.jobs.follow(job, WATCH, watch.nextsong, self.SLEEPTIME)
+
+        elif job.kind == PREFETCH:
+            self._prefetch(job.delugesong)
+
+            # Asked for while we were prefetching it, the load now comes straight from the cache.
+            # A request that comes in after this gets a load of its own.
+            self.ts.jobs.answer(job)
+            if job.kind == LOAD:
+                self._runjob(job)
+
+        elif job.kind == INDEX:
+            Indexer(self, self.index).refresh()
+
+    # Stop between blocks once the job has been replaced by something more important
+    def _checkcancel(self):
+        if self.job is not None:
+            self.ts.jobs.check(self.job)
+
+    def _answer(self):
+        """Request id for the result of the current job, no new request merges into it after this"""
+        return self.ts.jobs.answer(self.job) if self.job else None
 
     def _mainfetch(self, delugesong):
         # logger.info(f'Expected song fetch: {delugesong}')
 
-        for i in range(0, 5):
-            try:
-                xml = self.fetch(delugesong)
+        stat = self.songstat(delugesong)
+        songhsh = self._cachedsong(delugesong, stat)
 
-                if xml is None:
-                    continue
+        if songhsh is None:
+            # Fetching the whole song takes a while over USB, meanwhile show what the index knows
+            info = self.index.get(propername(delugesong))
+            if info and info.get('bpm'):
+                self.ts.setwatchmsg(self.requestid, f'fetching {describe(info)}...')
 
-                break
+            try:
+                songhsh = self._fetchsong(delugesong, stat, tries = 5)
+            except Cancelled:
+                raise
             except Exception as e:
-                self.ts.setresult(delugesong = delugesong, xml = None, error = True)
+                self.ts.setresult(self._answer(), delugesong = delugesong, songhsh = None, error = True)
                 logger.info(f'DAL Connector - wait for song - ERROR! - {e}')
-                return
+                return False
 
-        if not xml:
-            self.ts.setresult(delugesong = None, xml = None, error = True)
-            return
+            if not songhsh:
+                self.ts.setresult(self._answer(), delugesong = None, songhsh = None, error = True)
+                return False
+
+        self.ts.setresult(self._answer(), delugesong = delugesong, songhsh = songhsh, error = False, stats = self.stats)
+        self.index.add(delugesong)
 
-        self.ts.setresult(delugesong = delugesong, xml = xml, error = False)
-        self.nextsong = self._findunusedname(delugesong)
+        self.watch.currentsong = delugesong
+        self.watch.currentstat = stat
 
         # logger.info(f'Fetcher complete')
+        return True
 
 
     def _nextsongfetch(self):
-        if self.scanstarttime and time.time() - self.scanstarttime > NEW_SAVE_SLEEP_TIMER:
-            self.nextsong = None
-            self.ts.setwatchmsg('sleep')
+        watch = self.watch
+
+        if watch.scanstarttime and time.time() - watch.scanstarttime > NEW_SAVE_SLEEP_TIMER:
+            watch.nextsong = None
+            self.ts.setwatchmsg(self.requestid, 'sleep')
             logger.info(f'! Going to sleep !')
             return
 
-        # logger.info(f'Checking for next song: {self.nextsong}')
+        # logger.info(f'Checking for next song: {watch.nextsong}')
 
         try:
-            xml = self.fetch(self.nextsong)
+            # A stat of a song that isn't there has no blocks to check in between
+            self._checkcancel()
 
-            if not xml:
+            # Only ask for the size until the file is actually there
+            stat = self.stat(watch.nextsong)
+
+            if stat is None:
                 # logger.info(f'Next song isnt there yet...')
+                self._currentsongfetch()
+                return
+
+            stat = self.songstat(watch.nextsong) or stat
+            songhsh = self._loadsong(watch.nextsong, stat)
+
+            if songhsh is None:
                 return
 
+        except Cancelled:
+            raise
         except Exception as e:
             logger.info(f'DAL Connector - next song - ERROR! - {e}')
             return
 
         # logger.info(f'NEXT SONG IS THERE!!!')
 
-        self.ts.setnextsongdata(delugesong = self.nextsong, xml = xml, error = False)
+        self.ts.setnextsongdata(self.requestid, delugesong = watch.nextsong, songhsh = songhsh, error = False, stats = self.stats)
+        self.index.add(watch.nextsong)
+
+        watch.currentsong = watch.nextsong
+        watch.currentstat = stat
+
+        watch.nextsong = self._nextsongname(watch.nextsong)
+        self.ts.setwatchmsg(self.requestid, displayname(watch.nextsong))
+
+
+    # The song they loaded can be saved over too.  Reload it if its size or date moves.
+    def _currentsongfetch(self):
+        watch = self.watch
+
+        if watch.currentsong is None or watch.currentstat is None:
+            return
+
+        self._checkcancel()
+
+        stat = self.stat(watch.currentsong)
+        if stat is None or not watch.changed(stat):
+            return
 
-        self.nextsong = self._nextsongname(self.nextsong)
-        self.ts.setwatchmsg(displayname(self.nextsong))
+        logger.info(f'{watch.currentsong} changed on the Deluge, reloading')
+
+        stat = self.songstat(watch.currentsong) or stat
+        songhsh = self._loadsong(watch.currentsong, stat)
+        if songhsh is None:
+            return
+
+        watch.currentstat = stat
+        self.ts.setnextsongdata(self.requestid, delugesong = watch.currentsong, songhsh = songhsh, error = False, stats = self.stats)
+
+
+    ######################################################
+    # PREFETCH
+    def _prefetchnames(self, delugesong):
+        """Songs worth having in the cache once delugesong is loaded, most likely first"""
+        names = []
+
+        head = self.KNOWN_CACHE.get(delugesong)        # Newest save in this series
+        nextsong = nextnumber(delugesong)
+
+        for name in (head, self._nextsongname(delugesong), nextsong, self.KNOWN_CACHE.get(nextsong or '')):
+            if name and name != delugesong and name not in names:
+                names.append(name)
+
+        # Skip what we already know isn't there
+        if self.songnames is not None:
+            names = [name for name in names if name in self.songnames]
+
+        return names
+
+    def _prefetch(self, delugesong):
+        # A listing from the scan that queued this will do.  If the song has been saved since, the
+        # copy is cached under the old date and the next load just doesn't find it.
+        stat = self.songstat(delugesong, recent = True)
+        if stat is None:
+            return
+
+        if self.songcache.has(songpath(delugesong), stat):
+            return
+
+        logger.info(f'Prefetching {delugesong}')
+        self._fetchsong(delugesong, stat)
+
+
+    ######################################################
+    # SONG CACHE
+    def _loadsong(self, delugesong, stat):
+        """songhsh from the cache if the song hasn't changed, otherwise fetched and converted.  None if it can't be read."""
+        songhsh = self._cachedsong(delugesong, stat)
+        if songhsh is not None:
+            return songhsh
+
+        return self._fetchsong(delugesong, stat) or None
+
+    def _cachedsong(self, delugesong, stat):
+        songhsh = self.songcache.get(songpath(delugesong), stat)
+
+        if songhsh is not None:
+            logger.info(f'{delugesong} unchanged since last fetch, using cached copy')
+            tally('cache_hits')
+
+        return songhsh
+
+    def _fetchsong(self, delugesong, stat, tries = 1):
+        """Fetch and convert in one pass, each clip is converted as soon as its blocks are in.
+        Returns songhsh, '' if the song isn't on the Deluge or None if it couldn't be read."""
+        for i in range(0, tries):
+            self._checkcancel()
+
+            converter = StreamConverter()
+
+            def feed(block):
+                with timed('convert'):
+                    converter.feed(block)
+
+            data = self.fetchbytes(delugesong, sink = feed)
+
+            if data is None:
+                continue
+
+            if not data:
+                return ''
+
+            with timed('convert'):
+                songhsh = converter.finish()
+            self.songcache.put(songpath(delugesong), stat, data, songhsh)
+
+            return songhsh
+
+        return None
 
 
     # If they load 017 but have 017A and 017B and 017C we need to find the first one which isn't there
     def _findunusedname(self, delugesong):
-        self.scanstarttime = time.time()
+        self.watch.scanstarttime = time.time()
 
-        self.ts.setwatchmsg('scanning...')
+        self.ts.setwatchmsg(self.requestid, 'scanning...')
+
+        # One directory listing answers the whole question.  Only fall back to trying every name
+        # in turn if the Deluge won't list the directory.
+        existing = self._songnames()
+        self.songnames = existing
 
         ######################################################
         # CACHE LOOKUP
-        if delugesong in self.KNOWN_CACHE:
-            blankname = self.KNOWN_CACHE[delugesong]
-        else:
-            blankname = delugesong
+        if existing is not None:
+            self.KNOWN_CACHE.validate(delugesong, existing)
+
+        blankname = self.KNOWN_CACHE.get(delugesong) or delugesong
         ######################################################
 
-        for i in range(0, self.MAX_RECURSION):
-            self.KNOWN_CACHE[delugesong] = blankname
+        if existing is not None:
+            for i in range(0, self.MAX_RECURSION):
+                prev = blankname
+                blankname = self._nextsongname(blankname)
 
-            prev = blankname
-            blankname = self._nextsongname(blankname)
+                if blankname not in existing:
+                    self.KNOWN_CACHE.set(delugesong, prev)
+                    self.ts.setwatchmsg(self.requestid, displayname(blankname))
+                    return blankname
 
-            # logger.info(f'TRYING: {blankname}')
-            xml = self.fetch(blankname)
+        else:
+            for i in range(0, self.MAX_RECURSION):
+                # Every round waits on the Deluge, and a load must not have to wait for all of them
+                self._checkcancel()
 
-            if xml is None:
-                # logger.info(f'RETRY SOCKET')
-                blankname = prev
-                continue
+                prev = blankname
+                blankname = self._nextsongname(blankname)
 
-            if len(xml) > 0:
-                logger.info(f'{len(xml)}')
-                continue
+                # logger.info(f'TRYING: {blankname}')
+                # Only whether it is there matters, which open answers without reading the file
+                if self.stat(blankname) is not None:
+                    continue
+
+                # Not there, or the Deluge didn't answer.  Trying to read it tells the two apart,
+                # and a file that isn't there costs no more than the open.
+                xml = self.fetch(blankname)
+
+                if xml is None:
+                    # logger.info(f'RETRY SOCKET')
+                    blankname = prev
+                    continue
+
+                if len(xml) > 0:
+                    logger.info(f'{len(xml)}')
+                    continue
 
-            # logger.info(f'FOUND BLANK NAME!  {blankname}')
-            self.ts.setwatchmsg(displayname(blankname))
-            return blankname
+                # logger.info(f'FOUND BLANK NAME!  {blankname}')
+                self.KNOWN_CACHE.set(delugesong, prev)
+                self.ts.setwatchmsg(self.requestid, displayname(blankname))
+                return blankname
 
         logger.info(f'ERROR!  MAX RECURSION')
-        self.ts.setwatchmsg('error')
+        self.ts.setwatchmsg(self.requestid, 'error')
         return None
 
+    def _songnames(self):
+        """Proper names (017, 017A...) of every song in /SONGS/, or None if it can't be listed"""
+        if not self._listsongs(recent = True):
+            return None
 
-    def fetch(self, delugesong):
-        if not delugesong:
-            return ''
+        return self.index.names()
 
-        # Use DelugeWeb file reading protocol to fetch song XML files from SONGS directory
-        try:
-            # Find the Deluge MIDI port
-            deluge_port = None
-            available_ports = mido.get_output_names()
-            
-            for port_name in available_ports:
-                if DELUGE_MIDI_PORT_NAME in port_name:
-                    deluge_port = port_name
-                    break
-            
-            if not deluge_port:
-                logger.info(f'ERROR: Deluge MIDI port "{DELUGE_MIDI_PORT_NAME}" not found')
-                logger.info(f'Available ports: {available_ports}')
-                return None
-
-            # Open MIDI connection
-            with mido.open_output(deluge_port) as outport, mido.open_input(deluge_port) as inport:
-                # First, establish a session with the Deluge
-                session_uuid = str(uuid.uuid4())
-                session_request = create_session_request(session_uuid)
-                
-                logger.info(f'Establishing session with Deluge for song {delugesong}...')
-                sysex_msg = mido.Message('sysex', data=session_request)
-                outport.send(sysex_msg)
-                
-                # Wait for session response
-                session_established = False
-                session_data = None
-                timeout_time = time.time() + MIDI_TIMEOUT
-                
-                while time.time() < timeout_time:
-                    for msg in inport.iter_pending():
-                        if msg.type == 'sysex':
-                            session_data = self._handle_session_response(msg.data, session_uuid)
-                            if session_data:
-                                session_established = True
-                                break
-                    if session_established:
-                        break
-                    time.sleep(0.01)
-                
-                if not session_established:
-                    logger.info(f'ERROR: Could not establish session with Deluge')
-                    return None
-                
-                # Get sequence number range from session
-                seq_min = session_data.get('midMin', 1)
-                seq_max = session_data.get('midMax', 254)
-                current_seq = seq_min
-                
-                # Construct song file path (SONG001.XML format)
-                song_filename = f"SONG{delugesong.upper().zfill(3)}.XML"
-                song_path = f"/SONGS/{song_filename}"
-                
-                logger.info(f'Requesting song file: {song_path}')
-                
-                # Open the song file
-                file_data = self._read_file_from_deluge(outport, inport, song_path, current_seq, seq_max)
-                
-                if file_data:
-                    # Convert bytes to string (XML)
-                    xml_content = file_data.decode('utf-8', errors='ignore')
-                    logger.info(f'Successfully read song file {song_filename} ({len(xml_content)} characters)')
-                    return xml_content
-                else:
-                    logger.info(f'Song file {song_filename} not found or could not be read')
-                    return None
+    def _listsongs(self, recent = False):
+        """Bring the song index in line with a listing of /SONGS/.  recent settles for the last listing
+        if it is less than INDEX_MAX_AGE old.  False if the card can't be listed."""
+        if recent and self.index.fresh():
+            return True
 
-        except Exception as e:
-            logger.info(f'ERROR: MIDI Exception {e}')
-            return None
-    
-    def _handle_session_response(self, data, expected_uuid):
-        """Handle session establishment response from Deluge"""
-        try:
-            # Check if this is a Deluge JSON response
-            if (len(data) > 7 and 
-                data[1:4] == DELUGE_MANUFACTURER_ID and 
-                data[4] == DELUGE_DEVICE_ID and 
-                data[5] == SYSEX_CMD_JSON_REPLY):  # JSON response command
-                
-                # Extract JSON payload
-                json_start = 7
-                json_end = len(data) - 1  # Remove SYSEX_EOX
-                json_bytes = data[json_start:json_end]
-                json_str = json_bytes.decode('utf-8')
-                
-                response = json.loads(json_str)
-                if '^session' in response:
-                    session_data = response['^session']
-                    if session_data.get('tag') == expected_uuid:
-                        logger.info(f'Session established successfully')
-                        return session_data  # Return the full session data
-        except Exception as e:
-            logger.info(f'Error parsing session response: {e}')
-        
-        return None
-    
-    def _handle_song_response(self, data):
-        """Handle song data response from Deluge (when implemented)"""
-        try:
-            # Check if this is a Deluge JSON response
-            if (len(data) > 7 and 
-                data[1:4] == DELUGE_MANUFACTURER_ID and 
-                data[4] == DELUGE_DEVICE_ID and 
-                data[5] == 0x05):  # JSON response command
-                
-                # Extract JSON payload
-                json_start = 7
-                json_end = len(data) - 1  # Remove SYSEX_EOX
-                json_bytes = data[json_start:json_end]
-                json_str = json_bytes.decode('utf-8')
-                
-                response = json.loads(json_str)
-                if 'songData' in response:
-                    song_data = response['songData']
-                    if 'xml' in song_data:
-                        return song_data['xml']
-        except Exception as e:
-            logger.info(f'Error parsing song response: {e}')
-        
-        return None
-    
-    def _read_file_from_deluge(self, outport, inport, file_path, seq_num, seq_max):
-        """Read a file from Deluge using DelugeWeb protocol"""
-        try:
-            # Step 1: Open the file
-            open_cmd = {
-                "open": {
-                    "path": file_path,
-                    "write": 0  # 0 = read mode
-                }
-            }
-            
-            open_response = self._send_json_command(outport, inport, open_cmd, seq_num)
-            if not open_response or open_response.get('err', -1) != 0:
-                logger.info(f'Could not open file: {file_path}')
-                return None
-            
-            fid = open_response.get('fid')
-            file_size = open_response.get('size', 0)
-            
-            if not fid or fid < 1:
-                logger.info(f'Invalid file descriptor returned: {fid}')
-                return None
-            
-            seq_num = (seq_num + 1) if seq_num < seq_max else 1
-            
-            # Step 2: Read data in blocks
-            file_data = bytearray()
-            block_size = 512
-            current_addr = 0
-            
-            logger.info(f'Reading file {file_path} (size: {file_size} bytes)')
-            
-            while current_addr < file_size:
-                read_cmd = {
-                    "read": {
-                        "fid": fid,
-                        "addr": current_addr,
-                        "size": min(block_size, file_size - current_addr)
-                    }
-                }
-                
-                block_data = self._send_json_command_with_data(outport, inport, read_cmd, seq_num)
-                if not block_data:
-                    logger.info(f'No data received at offset {current_addr}')
-                    break
-                
-                file_data.extend(block_data)
-                current_addr += len(block_data)
-                
-                # If we got less than requested, we've reached the end
-                if len(block_data) < min(block_size, file_size - current_addr + len(block_data)):
-                    break
-                
-                seq_num = (seq_num + 1) if seq_num < seq_max else 1
-            
-            # Step 3: Close the file
-            close_cmd = {
-                "close": {
-                    "fid": fid
-                }
-            }
-            self._send_json_command(outport, inport, close_cmd, seq_num)
-            
-            logger.info(f'Successfully read {len(file_data)} bytes from {file_path}')
-            return bytes(file_data)
-            
-        except Exception as e:
-            logger.info(f'Error reading file {file_path}: {e}')
-            return None
-    
-    def _send_json_command(self, outport, inport, command, seq_num):
-        """Send a JSON command and wait for response"""
-        try:
-            # Encode JSON command
-            cmd_json = json.dumps(command).encode('utf-8')
-            
-            # Build SysEx message
-            sysex_data = ([SYSEX_START] + DELUGE_MANUFACTURER_ID + 
-                         [DELUGE_DEVICE_ID, SYSEX_CMD_JSON, seq_num] + 
-                         list(cmd_json) + [SYSEX_EOX])
-            
-            # Send command
-            sysex_msg = mido.Message('sysex', data=sysex_data)
-            outport.send(sysex_msg)
-            
-            # Wait for response
-            timeout_time = time.time() + MIDI_TIMEOUT
-            
-            while time.time() < timeout_time:
-                for msg in inport.iter_pending():
-                    if msg.type == 'sysex':
-                        response = self._parse_json_response(msg.data)
-                        if response:
-                            return self._extract_response_data(response, command)
-                time.sleep(0.01)
-            
-            logger.info(f'Timeout waiting for response to {list(command.keys())[0]} command')
-            return None
-            
-        except Exception as e:
-            logger.info(f'Error sending JSON command: {e}')
-            return None
-    
-    def _parse_json_response(self, data):
-        """Parse JSON response from SysEx data"""
-        try:
-            # Check if this is a Deluge JSON response
-            if (len(data) > 7 and 
-                data[1:4] == DELUGE_MANUFACTURER_ID and 
-                data[4] == DELUGE_DEVICE_ID and 
-                data[5] == SYSEX_CMD_JSON_REPLY):  # JSON response command
-                
-                # Extract JSON payload
-                json_start = 7
-                json_end = len(data) - 1  # Remove SYSEX_EOX
-                json_bytes = data[json_start:json_end]
-                json_str = json_bytes.decode('utf-8')
-                
-                return json.loads(json_str)
-        except Exception as e:
-            logger.info(f'Error parsing JSON response: {e}')
-        
-        return None
-    
-    def _extract_response_data(self, response, original_command):
-        """Extract relevant data from JSON response based on original command"""
-        try:
-            cmd_type = list(original_command.keys())[0]
-            response_key = f"^{cmd_type}"
-            
-            if response_key in response:
-                resp_data = response[response_key]
-                
-                if cmd_type == "open":
-                    # Return the full response data for open command
-                    return resp_data
-                
-                elif cmd_type == "read":
-                    # Return the response data - binary data handled separately
-                    return resp_data
-                
-                elif cmd_type == "close":
-                    # Return success status
-                    return resp_data.get("err", -1) == 0
-        
-        except Exception as e:
-            logger.info(f'Error extracting response data: {e}')
-        
-        return None
-    
-    def _send_json_command_with_data(self, outport, inport, command, seq_num):
-        """Send a JSON command and wait for response with binary data extraction"""
-        try:
-            # Encode JSON command
-            cmd_json = json.dumps(command).encode('utf-8')
-            
-            # Build SysEx message
-            sysex_data = ([SYSEX_START] + DELUGE_MANUFACTURER_ID + 
-                         [DELUGE_DEVICE_ID, SYSEX_CMD_JSON, seq_num] + 
-                         list(cmd_json) + [SYSEX_EOX])
-            
-            # Send command
-            sysex_msg = mido.Message('sysex', data=sysex_data)
-            outport.send(sysex_msg)
-            
-            # Wait for response
-            timeout_time = time.time() + MIDI_TIMEOUT
-            
-            while time.time() < timeout_time:
-                for msg in inport.iter_pending():
-                    if msg.type == 'sysex':
-                        # For read commands, we need to extract binary data from full SysEx
-                        cmd_type = list(command.keys())[0]
-                        if cmd_type == "read":
-                            return self._extract_read_data(msg.data)
-                        else:
-                            response = self._parse_json_response(msg.data)
-                            if response:
-                                return self._extract_response_data(response, command)
-                time.sleep(0.01)
-            
-            logger.info(f'Timeout waiting for response to {list(command.keys())[0]} command')
+        entries = self.listdir(SONGS_DIR)
+        if entries is None:
+            return False
+
+        # Songs that are new or changed since the index last saw them get indexed in the background
+        if self.index.apply(entries):
+            self.ts.jobs.put(INDEX, None)
+
+        return True
+
+    def listdir(self, path):
+        """List a directory on the card.  Returns a list of entries (name, size, date, time, attr) or None."""
+        return self.transport.listdir(path)
+
+    def stat(self, delugesong):
+        """Size (and date, where the card gives one) of a song without reading it.  None if it isn't there."""
+        if not delugesong:
             return None
-            
-        except Exception as e:
-            logger.info(f'Error sending JSON command with data: {e}')
+
+        return self.transport.stat(songpath(delugesong))
+
+    def songstat(self, delugesong, recent = False):
+        """Size, date and time of a song as the listing of /SONGS/ gives them.  Over USB the Deluge
+        only reports dates in directory listings, and the song cache needs the date to tell a song
+        from a later save of the same size.  Falls back on stat() if the card can't be listed."""
+        if not delugesong:
             return None
-    
-    def _extract_read_data(self, sysex_data):
-        """Extract binary data from read command response"""
-        try:
-            # First parse the JSON response to check for errors
-            response = self._parse_json_response(sysex_data)
-            if not response or "^read" not in response:
-                return None
-            
-            read_resp = response["^read"]
-            if read_resp.get("err") != 0:
-                return None
-            
-            # Find the zero separator between JSON and binary data
-            # Start searching after the SysEx header and sequence number
-            payload_start = 7  # After [F0 00 21 7B 01 07 seq]
-            zero_x = len(sysex_data) - 1  # Default to end if no separator found
-            
-            # Search for null separator (0x00) that marks end of JSON
-            for i in range(payload_start, len(sysex_data) - 1):
-                if sysex_data[i] == 0x00:
-                    zero_x = i
-                    break
-            
-            # If binary data exists, extract and unpack it
-            if zero_x < len(sysex_data) - 2:  # Must have at least separator + 1 byte + F7
-                binary_data = self._extract_attached_data(sysex_data, zero_x)
-                return bytes(binary_data)
-            
-            return b""  # No binary data found
-            
-        except Exception as e:
-            logger.info(f'Error extracting read data: {e}')
+
+        if self._listsongs(recent):
+            entry = self.index.get(propername(delugesong))
+            if entry and entry.get('date') is not None:
+                return { 'size': entry.get('size'), 'date': entry.get('date'), 'time': entry.get('time') }
+
+        return self.stat(delugesong)
+
+    def exists(self, delugesong):
+        return self.stat(delugesong) is not None
+
+    def fetch(self, delugesong):
+        """Song XML as text, '' if it isn't on the Deluge, None if it couldn't be read"""
+        file_data = self.fetchbytes(delugesong)
+
+        if file_data is None:
             return None
 
-    def _unpack_7bit_to_8bit(self, src_data, src_offset, src_len):
-        """Unpack 7-bit MIDI data to 8-bit binary data (from DelugeWeb)"""
-        try:
-            packets = (src_len + 7) // 8  # Ceiling division
-            missing = (8 * packets - src_len)
-            if missing == 7:  # This would be weird
-                packets -= 1
-                missing = 0
-            
-            out_len = 7 * packets - missing
-            if out_len <= 0:
-                return bytearray()
-            
-            dst = bytearray(out_len)
-            
-            for i in range(packets):
-                ipos = 8 * i
-                opos = 7 * i
-                
-                # Fill output section with zeros
-                for j in range(7):
-                    if opos + j >= out_len:
-                        break
-                    dst[opos + j] = 0
-                
-                # Unpack data
-                for j in range(7):
-                    if j + 1 + ipos >= src_len:
-                        break
-                    if opos + j >= out_len:
-                        break
-                    
-                    dst[opos + j] = src_data[src_offset + ipos + 1 + j] & 0x7f
-                    if src_data[src_offset + ipos] & (1 << j):
-                        dst[opos + j] |= 0x80
-            
-            return dst
-        except Exception as e:
-            logger.info(f'Error unpacking 7-bit data: {e}')
-            return bytearray()
-    
-    def _extract_attached_data(self, data, zero_x_pos):
-        """Extract attached binary data from SysEx message"""
-        try:
-            tot_len = len(data)
-            att_len = tot_len - zero_x_pos - 2  # Ignore 0 separator & ending 0xF7
-            
-            if att_len <= 0:
-                return bytearray()
-            
-            # Calculate expected output size
-            packets = (att_len + 7) // 8
-            missing = (8 * packets - att_len)
-            if missing == 7:
-                packets -= 1
-                missing = 0
-            out_len = 7 * packets - missing
-            
-            # Unpack the data
-            return self._unpack_7bit_to_8bit(data, zero_x_pos + 1, att_len)
-            
-        except Exception as e:
-            logger.info(f'Error extracting attached data: {e}')
-            return bytearray()
+        return file_data.decode('utf-8', errors='ignore')
+
+    def fetchbytes(self, delugesong, sink = None, limit = None):
+        """Raw song file, b'' if it isn't on the Deluge, None if it couldn't be read.
+        sink, if given, is handed each piece of the file in order as soon as it has arrived.
+        limit, if given, stops after that many bytes from the start of the file."""
+        if not delugesong:
+            return b''
+
+        # Construct song file path (SONG001.XML format)
+        song_filename = songfilename(delugesong)
+        song_path = songpath(delugesong)
+
+        logger.info(f'Requesting song file: {song_path}')
+
+        with timed('read'):
+            file_data = self.transport.read(song_path, sink, limit, self._checkcancel)
+
+        if file_data:
+            logger.info(f'Successfully read song file {song_filename} ({len(file_data)} bytes)')
+            tally('bytes', len(file_data))
+            return file_data
+        elif file_data is not None:
+            logger.info(f'Song file {song_filename} not found')
+            return b''
+        else:
+            logger.info(f'Song file {song_filename} could not be read')
+            return None
 
     def _nextsongname(self, name):
         def nextletter(letter):
@@ -583,84 +495,99 @@ class Fetcher(object):
 
 
 
-class ThreadShare(object):
-    def __init__(self):
-        self.watchmsg = None
-        self.finished = False
-        self.reset()
+class Watch(object):
+    """What the fetcher is watching for on behalf of one dc: track"""
 
-        try:
-            self.fetcher = Fetcher()
-            _thread.start_new_thread(self.fetcher.start, (self, ) )
-        except Exception as e:
-            logger.info(f'Error: unable to start thread {e}')
+    def __init__(self):
+        self.nextsong = None       # Next save to look out for
+        self.scanstarttime = None  # When watching started, it stops after NEW_SAVE_SLEEP_TIMER
 
-    def reset(self):
-        self.delugesong = None
-        self.currentsongdata = None
-        self.nextsongdata = None
+        self.currentsong = None    # Last song handed to Live and what songstat() said about it then
+        self.currentstat = None
 
+    def changed(self, stat):
+        """True if stat, from stat(), shows the current song has been saved over.  Over USB stat()
+        only has the size, so only what it does have is compared."""
+        return any(stat.get(k) is not None and stat.get(k) != self.currentstat.get(k) for k in ('size', 'date', 'time'))
 
-    ############################################
-    # CURRENT SONG
-    def targetsong(self):
-        return self.delugesong
 
-    def fetchsong(self, delugesong):
-        self.currentsongdata = None
+Event = collections.namedtuple('Event', 'kind requestid delugesong songhsh error message stats')
 
-        self.delugesong = delugesong
 
-    def setresult(self, delugesong, xml, error):
-        self.delugesong = None
+class ThreadShare(object):
+    """Passes requests from Live to the fetcher thread and events back, through thread safe queues.
 
-        if not xml:
-            self.currentsongdata = { 'songhsh': None, 'error': True }
-        else:
-            songhsh = Deluge2Ableton.convert(xml)
-            self.currentsongdata = { 'songhsh': songhsh, 'error': error }
+    Every event carries the id of the request it belongs to, so Live can tell the answer it is
+    waiting for from one that a newer request has made stale.
+    """
 
-    def getresult(self, delugesong):
-        # delugesong should never be None
-        if delugesong is None:
-            return { 'xml': None, 'error': True }
+    RESULT = 'result'          # The song asked for with fetchsong()
+    NEXTSONG = 'nextsong'      # A new save, or the loaded song saved over, found while watching
+    WATCH = 'watch'            # Status for the track name
 
-        if self.currentsongdata is None:
-            return None
+    def __init__(self):
+        self.finished = False
+        self.ids = itertools.count(1)
 
-        value = self.currentsongdata
-        self.currentsongdata = None
+        self.jobs = JobQueue()          # Live -> fetcher
+        self.events = queue.Queue()     # fetcher -> Live
 
-        return value
+        try:
+            self.fetcher = Fetcher()
+            _thread.start_new_thread(self.fetcher.start, (self, ) )
+        except Exception as e:
+            logger.info(f'Error: unable to start thread {e}')
 
+    def reset(self):
+        self.jobs.clear()
 
-    ############################################
-    # NEXT SONG
-    def getnextsongdata(self):
-        if not self.nextsongdata:
-            return None
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
 
-        value = self.nextsongdata
-        self.nextsongdata = None
-        return value
 
-    def setnextsongdata(self, delugesong, xml, error):
-        songhsh = Deluge2Ableton.convert(xml)
+    ############################################
+    # LIVE SIDE
+    def fetchsong(self, delugesong, target = None):
+        """Ask for a song for target, returns the request id its events will carry"""
+        requestid = next(self.ids)
+        self.jobs.put(LOAD, delugesong, requestid, target = target)
+
+        return requestid
+
+    def drop(self, target):
+        """Stop all work for target, its dc: track has gone"""
+        self.jobs.clear(target)
+        self.fetcher.targets.pop(target, None)
+
+    def getevents(self):
+        """Everything the fetcher has sent since the last call, oldest first"""
+        result = []
+        while True:
+            try:
+                result.append(self.events.get_nowait())
+            except queue.Empty:
+                return result
 
-        self.nextsongdata = { 'songhsh': songhsh, 'error': error, 'delugesong': delugesong }
 
     ############################################
-    # SCANNING
-    def setwatchmsg(self, msg):
-        self.watchmsg = msg
+    # FETCHER SIDE
+    def setresult(self, requestid, delugesong, songhsh, error, stats = None):
+        self._handover(stats)
+        self.events.put(Event(self.RESULT, requestid, delugesong, songhsh, error or not songhsh, None, stats))
+
+    def setnextsongdata(self, requestid, delugesong, songhsh, error, stats = None):
+        self._handover(stats)
+        self.events.put(Event(self.NEXTSONG, requestid, delugesong, songhsh, error, None, stats))
 
-    def getwatchmsg(self):
-        if self.watchmsg is None:
-            return self.watchmsg
+    def setwatchmsg(self, requestid, msg):
+        self.events.put(Event(self.WATCH, requestid, None, None, False, msg, None))
 
-        value = self.watchmsg
-        self.watchmsg = None
-        return value
+    def _handover(self, stats):
+        if stats is not None:
+            stats.handover()
 
     ############################################
 
@@ -671,5 +598,3 @@ class ThreadShare(object):
         self.reset()
         # logger.info(u'Tracker knows we are done....')
         self.finished = True
-
-
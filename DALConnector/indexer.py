@@ -0,0 +1,193 @@
+from . import config
+from .config import INDEX_HEAD_BYTES, INDEX_MAX_AGE
+from .deluge2ableton import Deluge2Ableton, StreamConverter
+from .local import songname, SONGS_DIR
+
+import logging
+import json
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def headerinfo(head, size):
+    """BPM and a rough clip count from the first bytes of a song file.  clips is None if the head
+    doesn't say, which is usual: the instruments, sounds and kits come before the first clip."""
+    exact = size <= len(head)
+
+    if isinstance(head, (bytes, bytearray)):
+        head = head.decode('utf-8', errors = 'ignore')
+
+    clips = [m.start() for m in StreamConverter.CLIP_HEADER.finditer(head)]
+
+    # Only part of the clips are in the head.  Going by how far apart they are, assume the rest of
+    # the file is packed as densely.
+    if exact:
+        estimate = len(clips)
+    elif len(clips) > 1:
+        estimate = int((len(clips) - 1) * (size - clips[0]) / (clips[-1] - clips[0]))
+    else:
+        estimate = None
+
+    return { 'bpm': Deluge2Ableton._extractbpm(head), 'clips': estimate, 'exact': exact }
+
+
+def describe(info):
+    """'120 bpm, ~14 clips' for an index entry, leaving out the clip count while it isn't known"""
+    text = f"{info['bpm']} bpm"
+
+    if info.get('clips') is not None:
+        text += f", {'' if info.get('exact') else '~'}{info['clips']} clip{'' if info['clips'] == 1 else 's'}"
+
+    return text
+
+
+class SongIndex(object):
+    """What is on the card: size, date, BPM and rough clip count of every song in /SONGS/.
+
+    Kept on disk between Live sessions.  Entries are refreshed from directory listings and only
+    songs whose size or date moved need their head read again.  What a head says is shown on the
+    track while the whole song is fetched.  Safe to use from any thread.
+    """
+
+    FILENAME = 'songindex.json'
+    VERSION = 2          # Bump whenever what a head read gives changes, older indexes are read again
+
+    def __init__(self, path = None):
+        self.path = path
+        self.lock = threading.RLock()
+
+        self.entries = None        # name -> { size, date, time, bpm, clips, exact }
+        self.listed = None         # time.time() of the last full listing applied this session
+
+    def get(self, name):
+        with self.lock:
+            self._load()
+
+            entry = self.entries.get(name)
+            return dict(entry) if entry is not None else None
+
+    def fresh(self):
+        """True if the index matched a listing of the card recently enough to answer for it"""
+        with self.lock:
+            return self.listed is not None and time.time() - self.listed < INDEX_MAX_AGE
+
+    def names(self):
+        """Every song on the card, or None if the index isn't fresh"""
+        with self.lock:
+            if not self.fresh():
+                return None
+
+            return set(self.entries)
+
+    def apply(self, entries):
+        """Bring the index in line with a listing of /SONGS/.  Returns the names that need their head read."""
+        with self.lock:
+            self._load()
+
+            listed = {}
+            for entry in entries:
+                name = songname(entry.get('name', ''))
+                if name:
+                    listed[name] = entry
+
+            changed = False
+            for name in [n for n in self.entries if n not in listed]:
+                del self.entries[name]
+                changed = True
+
+            for name, entry in listed.items():
+                known = self.entries.get(name)
+                if known is None or any(known.get(k) != entry.get(k) for k in ('size', 'date', 'time')):
+                    self.entries[name] = { 'size': entry.get('size'), 'date': entry.get('date'), 'time': entry.get('time') }
+                    changed = True
+
+            self.listed = time.time()
+
+            if changed:
+                self._save()
+
+            return sorted(name for name, entry in self.entries.items() if 'bpm' not in entry)
+
+    def add(self, name):
+        """A song we've just seen appear, its details come with the next listing"""
+        with self.lock:
+            self._load()
+
+            if name not in self.entries:
+                self.entries[name] = {}
+                self._save()
+
+    def update(self, name, info):
+        with self.lock:
+            self._load()
+
+            if name in self.entries:
+                self.entries[name].update(info)
+                self._save()
+
+    ############################################
+    # PERSISTENCE
+    def _file(self):
+        return self.path or os.path.join(config.DATA_DIR, self.FILENAME)
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        try:
+            with open(self._file()) as f:
+                index = json.load(f)
+
+            if index.get('version') != self.VERSION:
+                raise ValueError('old index format')
+
+            self.entries = index.get('entries', {})
+        except Exception:
+            self.entries = {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self._file()), exist_ok = True)
+
+            tmp = self._file() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({ 'version': self.VERSION, 'entries': self.entries }, f)
+
+            os.replace(tmp, self._file())
+        except Exception as e:
+            logger.info(f'Could not save song index: {e}')
+
+
+class Indexer(object):
+    """Walks /SONGS/ through a Fetcher, reading just the head of each new or changed song"""
+
+    def __init__(self, fetcher, index):
+        self.fetcher = fetcher
+        self.index = index
+
+    def refresh(self, entries = None):
+        """Index the card.  entries is a listing of /SONGS/ if the caller already has one.
+        Stops at the next block if the fetcher's job is cancelled, what was read so far is kept."""
+        if entries is None:
+            entries = self.fetcher.listdir(SONGS_DIR)
+            if entries is None:
+                return False
+
+        pending = self.index.apply(entries)
+        if pending:
+            logger.info(f'Indexing {len(pending)} songs')
+
+        for name in pending:
+            self.fetcher._checkcancel()
+
+            head = self.fetcher.fetchbytes(name, limit = INDEX_HEAD_BYTES)
+            if not head:
+                continue
+
+            size = (self.index.get(name) or {}).get('size') or len(head)
+            self.index.update(name, headerinfo(head, size))
+
+        return True
@@ -0,0 +1,159 @@
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Kinds of work for the fetcher thread.  Lower runs first.
+LOAD = 0        # The user asked for a song
+WATCH = 1       # Check whether the next save has shown up, or the loaded song was saved over
+SCAN = 2        # Find the first unused name after the loaded song
+PREFETCH = 3    # Pull a song the user will probably ask for next into the cache
+INDEX = 4       # Bring the card index up to date
+
+KINDS = { LOAD: 'load', WATCH: 'watch', SCAN: 'scan', PREFETCH: 'prefetch', INDEX: 'index' }
+
+
+class Cancelled(Exception):
+    """Raised inside a job once something more important has replaced it"""
+
+
+class Job(object):
+    def __init__(self, kind, delugesong, requestid, due, target = None):
+        self.kind = kind
+        self.delugesong = delugesong
+        self.requestid = requestid      # The Live request this job answers to
+        self.target = target            # The dc: track it is for, None for work about the whole card
+        self.due = due                  # Don't start before this time.time()
+        self.order = 0
+        self.cancelled = False
+        self.answered = False           # Its result has gone to Live, nothing more merges into it
+
+    def __repr__(self):
+        return f'{KINDS.get(self.kind, self.kind)} {self.delugesong} (request {self.requestid}, target {self.target})'
+
+
+class JobQueue(object):
+    """Work for the fetcher thread, most important first.  Safe to use from any thread.
+
+    Every job belongs to a target, the dc: track it is for.  A new load replaces everything queued
+    for its target except indexing, since watching, scanning and prefetching only make sense for
+    the song that is loaded there.  It cancels the running job if that was for the same target or
+    only background work, unless it is already fetching that same song and hasn't answered yet, in
+    which case that job becomes the load.  Asking again for something already queued merges into
+    the queued job.
+    Targets take turns: of the jobs of the same kind that are due, the target that last had a turn
+    longest ago goes first.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.RLock())
+        self.jobs = []
+        self.order = itertools.count()
+        self.running = None
+
+        self.turns = itertools.count()
+        self.served = {}            # target -> turn it last had a job started
+
+    def put(self, kind, delugesong, requestid = None, delay = 0, target = None):
+        with self.cond:
+            due = time.time() + delay
+
+            if kind == LOAD:
+                self._clear(target)
+
+                # Already fetching it, whatever it finds answers the new request too
+                running = self.running
+                if (running is not None and running.delugesong == delugesong and not running.cancelled and
+                    not running.answered and (running.kind == PREFETCH or (running.kind == LOAD and running.target == target))):
+                    running.kind = LOAD
+                    running.requestid = requestid
+                    running.target = target
+                    return running
+
+                if running is not None and not running.cancelled and (running.target == target or running.kind in (PREFETCH, INDEX)):
+                    logger.info(f'Cancelling {running}, {delugesong} was asked for')
+                    running.cancelled = True
+
+            for job in self.jobs:
+                if job.kind == kind and job.delugesong == delugesong and job.target == target:
+                    job.requestid = requestid
+                    job.due = min(job.due, due)
+                    self.cond.notify()
+                    return job
+
+            job = Job(kind, delugesong, requestid, due, target)
+            job.order = next(self.order)
+
+            self.jobs.append(job)
+            self.cond.notify()
+
+            return job
+
+    def follow(self, job, kind, delugesong, delay = 0):
+        """Queue the work that comes after job, unless job was cancelled in the meantime"""
+        with self.cond:
+            if job.cancelled:
+                return None
+
+            return self.put(kind, delugesong, job.requestid, delay, job.target)
+
+    def get(self, timeout):
+        """Next job that is due, waiting up to timeout seconds.  None if there isn't one by then."""
+        deadline = time.time() + timeout
+
+        with self.cond:
+            self.running = None
+
+            while True:
+                now = time.time()
+
+                ready = [job for job in self.jobs if job.due <= now]
+                if ready:
+                    self.running = min(ready, key = self._rank)
+                    self.jobs.remove(self.running)
+
+                    self.served[self.running.target] = next(self.turns)
+                    return self.running
+
+                if now >= deadline:
+                    return None
+
+                # Sleep until the next job falls due, or until something new is put
+                wait = deadline - now
+                if self.jobs:
+                    wait = min(wait, min(job.due for job in self.jobs) - now)
+
+                self.cond.wait(max(wait, 0.001))
+
+    def answer(self, job):
+        """The fetcher is about to answer job.  From here on a request for its song gets a job of its
+        own instead of merging into this one.  Returns the request id the answer must carry."""
+        with self.cond:
+            job.answered = True
+            return job.requestid
+
+    def check(self, job):
+        """Raise Cancelled if job has been replaced.  The fetcher calls this between blocks."""
+        if job is not None and job.cancelled:
+            raise Cancelled(repr(job))
+
+    def clear(self, target = None):
+        """Drop the work for target and cancel its running job.  None for every target."""
+        with self.cond:
+            self._clear(target)
+
+            if target is not None:
+                self.served.pop(target, None)
+
+            if self.running is not None and (target is None or self.running.target == target):
+                self.running.cancelled = True
+
+    def _clear(self, target = None):
+        # Indexing is about the whole card, not the song that was loaded
+        self.jobs = [job for job in self.jobs if job.kind == INDEX or (target is not None and job.target != target)]
+
+    def _rank(self, job):
+        return (job.kind, self.served.get(job.target, -1), job.due, job.order)
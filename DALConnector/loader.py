@@ -0,0 +1,193 @@
+# Works out what has to change in Live to go from the last loaded song to the next one.
+# Nothing in here talks to Live, DALConnector applies the result.
+
+from .stats import timed
+
+import collections
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+NOTES_PER_OP = 512          # Notes handed to Live in one add_new_notes call during a load
+
+
+def clipsbyslot(songhsh):
+    """Gather a songhsh's note rows into clips: (trackidx, sceneidx) -> { length, notes: [NoteBlock...] }"""
+    slots = {}
+
+    for cliphsh in songhsh['clipmap']:
+        key = (cliphsh['trackidx'], cliphsh['sceneidx'])
+
+        if key not in slots:
+            slots[key] = { 'length': cliphsh['length'], 'notes': [] }
+
+        # Same as loading row by row, the last row decides the clip length
+        slots[key]['length'] = cliphsh['length']
+        slots[key]['notes'].append(cliphsh['notes'])
+
+    return slots
+
+
+def notetuples(clip):
+    result = []
+    for block in clip['notes']:
+        result.extend(block)
+
+    return result
+
+
+def addednotes(old, new):
+    """Notes to add to go from clip old to clip new, or None if notes also have to go"""
+    if old is None or old['length'] != new['length']:
+        return None
+
+    oldnotes = set(notetuples(old))
+    newnotes = notetuples(new)
+
+    if not oldnotes.issubset(newnotes):
+        return None
+
+    return [n for n in newnotes if n not in oldnotes]
+
+
+class LoadState(object):
+    """What the last load put into Live under one dc: track, clip by clip"""
+
+    def __init__(self, track, existing = ()):
+        self.track = track
+        self.slots = {}               # (trackidx, sceneidx) -> clip as returned by clipsbyslot
+        self.stale = set(existing)    # Slots holding a clip we know nothing about
+
+    def diff(self, slots):
+        """Split the clips of the next song into changed and unchanged, and list the slots to clear"""
+        changed = {}
+        unchanged = []
+
+        for key, clip in slots.items():
+            if key not in self.stale and self.slots.get(key) == clip:
+                unchanged.append(key)
+            else:
+                changed[key] = clip
+
+        removed = sorted(key for key in set(self.slots) | self.stale if key not in slots)
+
+        return changed, unchanged, removed
+
+    # A load can be cancelled half way, so the state follows it one clip at a time
+    def starting(self, key):
+        self.slots.pop(key, None)
+        self.stale.add(key)
+
+    def loaded(self, key, clip):
+        self.stale.discard(key)
+        self.slots[key] = clip
+
+    def cleared(self, key):
+        self.stale.discard(key)
+        self.slots.pop(key, None)
+
+
+class LoadScheduler(object):
+    """Applies a queue of Live operations a few at a time, so a big song doesn't freeze Live.
+
+    An operation is any callable.  If it returns a list of operations they run next, ahead of
+    the rest of the queue, which lets an operation look at Live before deciding what comes after it.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget          # Seconds of work per run()
+        self.queue = collections.deque()
+        self.done = 0
+        self.ondone = None
+        self.onfail = None
+
+    @property
+    def busy(self):
+        return len(self.queue) > 0
+
+    def start(self, ops, ondone = None, onfail = None):
+        """Replace whatever is queued with ops.  ondone is called once they have all run, or
+        onfail with the exception if one of them raises, which drops the rest."""
+        self.cancel()
+
+        self.queue.extend(ops)
+        self.done = 0
+        self.ondone = ondone
+        self.onfail = onfail
+
+    def cancel(self):
+        if self.queue:
+            logger.info(f'Load cancelled with {len(self.queue)} operations left')
+
+        self.queue.clear()
+        self.ondone = None
+        self.onfail = None
+
+    def progress(self):
+        total = self.done + len(self.queue)
+        return self.done / total if total else 1.0
+
+    def run(self):
+        """Apply operations until this tick's budget is used up.  True once nothing is left to do."""
+        deadline = time.perf_counter() + self.budget
+
+        while self.queue:
+            op = self.queue.popleft()
+
+            try:
+                with timed('live'):
+                    more = op()
+            except Exception as e:
+                logger.info(f'Load failed: {e}')
+
+                onfail = self.onfail
+                self.cancel()
+
+                if onfail:
+                    onfail(e)
+                return True
+
+            self.done += 1
+            if more:
+                self.queue.extendleft(reversed(more))
+
+            if time.perf_counter() >= deadline:
+                break
+
+        if self.queue:
+            return False
+
+        ondone, self.ondone = self.ondone, None
+        self.onfail = None
+        if ondone:
+            ondone()
+
+        return True
+
+
+class Target(object):
+    """A dc: track and the block of MIDI tracks under it, down to the next dc: track.
+
+    Each has its own song, requests to the fetcher, load state and scheduler, so several can be
+    loading and watching at the same time.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, track, budget):
+        self.id = next(self.ids)       # What the fetcher knows it by
+        self.track = track
+        self.delugesong = None         # SONG000.XML
+
+        self.requestid = None          # Our latest request to the fetcher thread
+        self.expectid = None           # Set while waiting for the answer to it
+        self.expectsince = None
+        self.watchmsg = None
+
+        self.loadstate = None          # What the last load put under track
+        self.loadstats = None          # Where the time went in the load being applied, see stats.py
+        self.loadskipped = 0
+        self.loadchanged = 0
+        self.scheduler = LoadScheduler(budget)
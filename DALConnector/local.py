@@ -1,5 +1,7 @@
 import re
 
+SONGS_DIR = '/SONGS'
+
 def propername(name):
     name = name.upper()
 
@@ -18,3 +20,24 @@ def displayname(name):
 
     return re.sub(r'^0{1,2}', '', name)
 
+def nextnumber(name):
+    # 008B -> 009
+    nums = re.search(r'^(\d+)', name)
+    if not nums:
+        return None
+
+    return propername(str(int(nums[1]) + 1))
+
+def songfilename(name):
+    return f'SONG{name.upper().zfill(3)}.XML'
+
+def songpath(name):
+    return f'{SONGS_DIR}/{songfilename(name)}'
+
+def songname(filename):
+    # SONG017A.XML -> 017A
+    nums = re.search(r'^SONG(\d+[A-Z]*)\.XML$', filename, re.IGNORECASE)
+    if not nums:
+        return None
+
+    return propername(nums[1])
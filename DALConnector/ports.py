@@ -0,0 +1,82 @@
+from .config import DELUGE_MIDI_PORT_NAME, PORT_RESCAN_INTERVAL
+
+import logging
+import threading
+import time
+import mido
+
+logger = logging.getLogger(__name__)
+
+
+class PortRegistry(object):
+    """Which MIDI ports are the Deluge's, worked out once and remembered.
+
+    Listing ports is slow with the rtmidi backend, so it only happens again once the ports are
+    known to have changed: an open failed or the session died (the Deluge was unplugged), or the
+    Deluge's ports weren't both found last time and PORT_RESCAN_INTERVAL seconds have passed (it
+    may have been plugged in since, or been halfway through showing up).  rescan() lists them again right away.  Safe to use from any thread.
+    """
+
+    def __init__(self, portname = DELUGE_MIDI_PORT_NAME, ports = mido):
+        self.portname = portname
+        self.ports = ports          # mido, or anything that looks like it such as the emulator
+
+        self.lock = threading.Lock()
+        self.output = None          # Full names of the Deluge's ports as of the last scan
+        self.input = None
+        self.available = []         # Every output port seen then, for the log
+        self.scanned = None         # time.time() of the last scan, None if the ports need listing again
+
+    def resolve(self):
+        """(output name, input name) of the Deluge's ports, or None if it isn't connected"""
+        with self.lock:
+            if self.scanned is None or (self._found() is None and time.time() - self.scanned >= PORT_RESCAN_INTERVAL):
+                self._scan()
+
+            return self._found()
+
+    def rescan(self):
+        """List the ports again now, whatever is remembered"""
+        with self.lock:
+            self._scan()
+            return self._found()
+
+    def invalidate(self):
+        """The remembered ports didn't work, list them again next time"""
+        with self.lock:
+            # With nothing found last time either, resolve() already looks again every PORT_RESCAN_INTERVAL
+            if self._found() is not None:
+                self.scanned = None
+
+            self.output = None
+            self.input = None
+
+    def _found(self):
+        if self.output is None or self.input is None:
+            return None
+
+        return self.output, self.input
+
+    def _scan(self):
+        self.scanned = time.time()
+
+        try:
+            self.available = self.ports.get_output_names()
+            inputs = self.ports.get_input_names()
+        except Exception as e:
+            logger.info(f'Could not list MIDI ports: {e}')
+            self.available = []
+            inputs = []
+
+        self.output = self._match(self.available)
+        self.input = self._match(inputs)
+
+        if self._found():
+            logger.info(f'Deluge ports: {self.output} / {self.input}')
+
+    def _match(self, names):
+        for name in names:
+            if self.portname in name:
+                return name
+
+        return None
@@ -0,0 +1,151 @@
+from .config import STATS_FILE
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+RTT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)   # Upper bounds in milliseconds, anything slower goes in the last bucket
+
+_local = threading.local()
+
+
+class LoadStats(object):
+    """Where the time went in one load, from the fetch on the fetcher thread to the last note in Live.
+
+    Phases add up the seconds spent in each step.  Some happen inside others: unpack, convert and
+    wait are all part of read.  counts has the Live API calls made and anything else worth counting.
+    Only one thread records into it at a time, the fetcher until it hands the song over, then Live.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.sent = None               # When the fetcher handed the song to Live
+
+        self.phases = collections.OrderedDict()     # name -> seconds
+        self.counts = collections.Counter()
+
+        self.rtts = [0] * (len(RTT_BUCKETS) + 1)
+        self.rtttotal = 0
+        self.rttmax = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def block(self, seconds):
+        """Round trip of one read block"""
+        ms = seconds * 1000
+
+        bucket = 0
+        while bucket < len(RTT_BUCKETS) and ms > RTT_BUCKETS[bucket]:
+            bucket += 1
+
+        self.rtts[bucket] += 1
+        self.rtttotal += seconds
+        self.rttmax = max(self.rttmax, seconds)
+
+    def handover(self):
+        self.sent = time.time()
+
+    def summary(self, **extra):
+        blocks = sum(self.rtts)
+        read = self.phases.get('read', 0)
+
+        result = collections.OrderedDict()
+        result['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))
+        result.update(extra)
+        result['total_ms'] = round((time.time() - self.started) * 1000, 1)
+        result['phases_ms'] = { phase: round(seconds * 1000, 1) for phase, seconds in self.phases.items() }
+        result['bytes'] = self.counts.get('bytes', 0)
+        result['bytes_per_second'] = int(result['bytes'] / read) if read else None
+        result['blocks'] = blocks
+
+        if blocks:
+            labels = [f'<={ms}' for ms in RTT_BUCKETS] + [f'>{RTT_BUCKETS[-1]}']
+            result['rtt_ms'] = {
+                'mean': round(self.rtttotal / blocks * 1000, 2),
+                'max': round(self.rttmax * 1000, 2),
+                'histogram': { label: n for label, n in zip(labels, self.rtts) if n },
+                }
+
+        result['counts'] = { name: n for name, n in self.counts.items() if name != 'bytes' }
+        return result
+
+    def report(self, **extra):
+        """Summary to the Live log and, if STATS_FILE is set, a line of it to that file"""
+        summary = self.summary(**extra)
+        line = json.dumps(summary)
+
+        logger.info(f'Load stats: {line}')
+
+        if not STATS_FILE:
+            return summary
+
+        try:
+            folder = os.path.dirname(STATS_FILE)
+            if folder:
+                os.makedirs(folder, exist_ok = True)
+
+            with open(STATS_FILE, 'a') as f:
+                f.write(line + '\n')
+        except Exception as e:
+            logger.info(f'Could not write load stats: {e}')
+
+        return summary
+
+
+############################################
+# RECORDING
+# Code deep in the fetch doesn't know which load it is working for.  Whoever starts the work
+# makes its LoadStats current for the thread, and everything below records into that.  With
+# nothing current these do nothing.
+def current():
+    return getattr(_local, 'stats', None)
+
+
+class recording(object):
+    """with recording(stats): makes stats current on this thread for the duration"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.previous = current()
+        _local.stats = self.stats
+        return self.stats
+
+    def __exit__(self, *exc):
+        _local.stats = self.previous
+
+
+class timed(object):
+    """with timed('open'): adds the time spent inside to that phase of the current load"""
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.stats = current()
+        if self.stats is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.stats is not None:
+            self.stats.add(self.phase, time.perf_counter() - self.start)
+
+
+def tally(name, n = 1):
+    stats = current()
+    if stats is not None:
+        stats.counts[name] += n
+
+
+def blockrtt(seconds):
+    stats = current()
+    if stats is not None:
+        stats.block(seconds)
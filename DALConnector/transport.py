@@ -0,0 +1,736 @@
+from .config import CARD_FOLDER, READ_WINDOW_SIZE, READ_BLOCK_TIMEOUT, READ_RETRIES, READ_RETRY_BACKOFF
+from .connection import DelugeConnection
+from .blocksize import BlockSizer
+from .cache import PartialCache
+from .codec import unpack7to8, findseparator
+from .jobs import Cancelled
+from .stats import timed, tally, blockrtt
+
+import collections
+import logging
+import mmap
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def opentransport():
+    """The transport the settings ask for: the card folder if one is set, otherwise USB MIDI"""
+    if CARD_FOLDER:
+        return FileTransport(CARD_FOLDER)
+
+    return SysExTransport()
+
+
+def fatdatetime(mtime):
+    """FAT date and time words for a file modification time, as the Deluge reports them"""
+    t = time.localtime(mtime)
+
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    clock = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+    return date, clock
+
+
+def findpath(root, path, directory = False):
+    """Local file for a card path, matching names without regard to case like FAT does.  None if it isn't there."""
+    current = root
+
+    for part in [p for p in path.split('/') if p]:
+        try:
+            names = os.listdir(current)
+        except OSError:
+            return None
+
+        match = [n for n in names if n.lower() == part.lower()]
+        if not match:
+            return None
+
+        current = os.path.join(current, match[0])
+
+    if directory:
+        return current if os.path.isdir(current) else None
+
+    return current if os.path.isfile(current) else None
+
+
+class SinkError(Exception):
+    """What a read's sink raised, carried past the handlers that are there for transfer errors"""
+
+    def __init__(self, error):
+        super(SinkError, self).__init__(error)
+        self.error = error
+
+
+def guarded(sink):
+    """sink, with anything it raises wrapped in a SinkError"""
+    def feed(block):
+        try:
+            sink(block)
+        except Exception as e:
+            raise SinkError(e)
+
+    return feed
+
+
+class Transport(object):
+    """How the fetcher gets at the card.  Paths are card paths such as /SONGS/SONG001.XML.
+
+    Every backend answers the same way: stat() and listdir() return None when they can't, and
+    read() returns the bytes, b'' if the file isn't there or None if it couldn't be read.  read()
+    calls check() between blocks, which may raise Cancelled to stop it.  Whatever the sink raises
+    comes straight out of read(), it says nothing about the card or the link.
+    """
+
+    device = None              # Name to remember per device settings under
+
+    def listdir(self, path):
+        """Entries (name, size, date, time, attr) in a directory, or None"""
+        raise NotImplementedError
+
+    def stat(self, path):
+        """{ size, date, time } of a file, or None if it isn't there"""
+        raise NotImplementedError
+
+    def read(self, path, sink = None, limit = None, check = None):
+        """Whole file, or its first limit bytes.  sink is handed each piece in order as it arrives."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SysExTransport(Transport):
+    """The card over USB MIDI, using the DelugeWeb SysEx protocol"""
+
+    DIR_PAGE = 20              # Directory entries per dir request
+    DIR_PAGES_MAX = 500        # Give up on a listing after this many requests
+
+    def __init__(self, connection = None):
+        self.connection = connection or DelugeConnection()
+        self.blocksizer = None
+        self.partials = PartialCache()     # Reads that broke off, to carry on from
+
+    @property
+    def device(self):
+        return self.connection.device
+
+    def close(self):
+        self.connection.close()
+
+    def listdir(self, path):
+        """List a directory on the card.  Returns a list of entries (name, size, date, time, attr) or None."""
+        try:
+            if not self.connection.ensure():
+                return None
+
+            entries = []
+            names = set()
+            for i in range(0, self.DIR_PAGES_MAX):
+                dir_cmd = {
+                    "dir": {
+                        "path": path,
+                        "offset": len(entries),
+                        "lines": self.DIR_PAGE
+                    }
+                }
+
+                dir_response = self.connection.command(dir_cmd)
+                if dir_response is None or dir_response.get('err', -1) != 0:
+                    logger.info(f'Could not list directory: {path}')
+                    return None
+
+                page = dir_response.get('list', [])
+                new = [entry for entry in page if entry.get('name') not in names]
+
+                entries += new
+                names.update(entry.get('name') for entry in new)
+
+                # A firmware that ignores offset hands back the same page again
+                if len(page) < self.DIR_PAGE or not new:
+                    break
+            else:
+                logger.info(f'Stopped listing {path} after {len(entries)} entries')
+
+            logger.info(f'Listed {len(entries)} entries in {path}')
+            return entries
+
+        except Exception as e:
+            logger.info(f'Error listing directory {path}: {e}')
+            return None
+
+    def stat(self, path):
+        """Size (and date, where the firmware gives one) of a file without reading it.  None if it isn't there."""
+        try:
+            if not self.connection.ensure():
+                return None
+
+            open_cmd = {
+                "open": {
+                    "path": path,
+                    "write": 0  # 0 = read mode
+                }
+            }
+
+            open_response = self.connection.command(open_cmd)
+            if not open_response or open_response.get('err', -1) != 0:
+                return None
+
+            fid = open_response.get('fid')
+            if fid:
+                close_cmd = {
+                    "close": {
+                        "fid": fid
+                    }
+                }
+                self.connection.command(close_cmd)
+
+            return {
+                'size': open_response.get('size', 0),
+                'date': open_response.get('date'),
+                'time': open_response.get('time'),
+                }
+
+        except Exception as e:
+            logger.info(f'ERROR: stat {path} - {e}')
+            return None
+
+    def read(self, path, sink = None, limit = None, check = None):
+        sink = guarded(sink) if sink else None
+
+        seen = [0]             # Bytes of the file the sink has had
+        position = [0]         # How far into the file this attempt has handed over
+
+        # Every attempt hands over the file from its start, the sink only gets what it hasn't had yet
+        def passon(block):
+            start = position[0]
+            position[0] += len(block)
+
+            if position[0] > seen[0]:
+                sink(block[max(0, seen[0] - start):])
+                seen[0] = position[0]
+
+        # Use DelugeWeb file reading protocol
+        try:
+            # The ports and session stay open between fetches.  If the session turns out to be dead
+            # part way through, reconnect once and carry on from the last block that came in.
+            for attempt in range(0, 2):
+                if not self.connection.ensure():
+                    return None
+
+                position[0] = 0
+                file_data = self._read_file_from_deluge(path, passon if sink else None, limit, check)
+
+                if file_data is not None:
+                    return file_data
+
+                # Nothing more came back, the session is probably gone.  Start a fresh one.
+                self.connection.close()
+
+            return None
+
+        except Cancelled:
+            raise
+        except SinkError as e:
+            # The session is fine, reading the file again would only feed the sink the same bytes
+            raise e.error
+        except Exception as e:
+            logger.info(f'ERROR: MIDI Exception {e}')
+            self.connection.close()
+            return None
+
+    def _read_file_from_deluge(self, file_path, sink = None, limit = None, check = None):
+        """Read a file from Deluge using DelugeWeb protocol.  Returns b'' if the Deluge can't open it,
+        None if it couldn't all be read.  A read that broke off carries on from where it stopped."""
+        try:
+            # Step 1: Open the file
+            open_cmd = {
+                "open": {
+                    "path": file_path,
+                    "write": 0  # 0 = read mode
+                }
+            }
+
+            with timed('open'):
+                open_response = self.connection.command(open_cmd)
+
+            if open_response is None:
+                logger.info(f'No response opening file: {file_path}')
+                return None
+
+            if open_response.get('err', -1) != 0:
+                logger.info(f'Could not open file: {file_path}')
+                return b''
+
+            fid = open_response.get('fid')
+            file_size = open_response.get('size', 0)
+
+            if not fid or fid < 1:
+                logger.info(f'Invalid file descriptor returned: {fid}')
+                return b''
+
+            stat = { 'size': file_size, 'date': open_response.get('date'), 'time': open_response.get('time') }
+            want = file_size if limit is None else min(file_size, limit)
+
+            close_cmd = {
+                "close": {
+                    "fid": fid
+                }
+            }
+
+            # Pick up from whatever an earlier attempt got before it broke off
+            file_data = bytearray(self.partials.get(file_path, stat) or b'')
+            del file_data[want:]
+
+            if file_data:
+                logger.info(f'Resuming {file_path} at {len(file_data)} bytes')
+                tally('resumed_bytes', len(file_data))
+
+            # Step 2: Read data in blocks
+            sizer = self._blocksizer()
+
+            logger.info(f'Reading file {file_path} (size: {want} bytes, blocks of {sizer.size})')
+
+            try:
+                if file_data and sink:
+                    sink(bytes(file_data))
+
+                if READ_WINDOW_SIZE > 1:
+                    self._read_blocks_windowed(fid, want, sizer, READ_WINDOW_SIZE, file_data, sink, check)
+                else:
+                    self._read_blocks(fid, want, sizer, file_data, sink, check)
+            except (Cancelled, SinkError):
+                self.partials.put(file_path, stat, file_data)
+                self.connection.command(close_cmd)
+                raise
+
+            # Step 3: Close the file
+            self.connection.command(close_cmd)
+
+            # Anything short of what open said is there gets finished off by the next try
+            if len(file_data) != want:
+                logger.info(f'Read {len(file_data)} of {want} bytes from {file_path}, keeping them for the next try')
+                self.partials.put(file_path, stat, file_data)
+                return None
+
+            if want == file_size:
+                self.partials.discard(file_path)
+
+            logger.info(f'Successfully read {len(file_data)} bytes from {file_path}')
+            return bytes(file_data)
+
+        except (Cancelled, SinkError):
+            raise
+        except Exception as e:
+            logger.info(f'Error reading file {file_path}: {e}')
+            return None
+
+    def _read_blocks(self, fid, file_size, sizer, file_data, sink = None, check = None):
+        """Stop-and-wait: one read in flight at a time.  Carries on from the end of file_data."""
+        failures = 0
+
+        while len(file_data) < file_size:
+            if check:
+                check()
+
+            addr = len(file_data)
+            size = min(sizer.size, file_size - addr)
+
+            read_cmd = {
+                "read": {
+                    "fid": fid,
+                    "addr": addr,
+                    "size": size
+                }
+            }
+
+            sent = time.time()
+            with timed('wait'):
+                reply = self.connection.wait(self.connection.send(read_cmd), READ_BLOCK_TIMEOUT)
+
+            if reply is not None:
+                blockrtt(time.time() - sent)
+            else:
+                tally('timeouts')
+
+            block_data = self._extract_read_data(reply)
+
+            sizer.record(size, len(block_data or b''), time.time() - sent)
+
+            # Lost, failed, or a late answer to an earlier request that had the same sequence number
+            if not block_data or self._replyaddr(reply, fid, addr) != addr:
+                failures += 1
+                if not self._backoff(addr, failures):
+                    return
+
+                continue
+
+            failures = 0
+
+            # A short read just means the block was bigger than the Deluge wanted to send, carry on from there
+            file_data.extend(block_data)
+
+            if sink:
+                sink(block_data)
+
+    def _read_blocks_windowed(self, fid, file_size, sizer, window, file_data, sink = None, check = None):
+        """Sliding window: keep several reads in flight, each with its own sequence number.
+        Carries on from the end of file_data."""
+
+        # Never have two requests in flight with the same sequence number
+        window = max(1, min(window, self.connection.seqcount() - 1))
+
+        retry = collections.deque()    # (addr, size) that came back short or not at all and need asking again
+        nextaddr = len(file_data)      # Everything below this has been asked for at least once
+
+        inflight = {}                  # seq -> (addr, size, time sent)
+        blocks = {}                    # addr -> bytes that arrived ahead of a gap
+        failures = collections.Counter()   # addr -> times the block asked for there failed
+
+        while retry or nextaddr < file_size or inflight:
+            if check:
+                check()
+
+            while (retry or nextaddr < file_size) and len(inflight) < window:
+                if retry:
+                    addr, size = retry.popleft()
+                else:
+                    # Block size can change between requests as the sizer learns
+                    addr, size = nextaddr, min(sizer.size, file_size - nextaddr)
+                    nextaddr += size
+
+                read_cmd = {
+                    "read": {
+                        "fid": fid,
+                        "addr": addr,
+                        "size": size
+                    }
+                }
+
+                seq = self.connection.send(read_cmd)
+
+                # Its sequence number has come round again without an answer, so it never will have one
+                if seq in inflight:
+                    retry.append(inflight[seq][:2])
+
+                inflight[seq] = (addr, size, time.time())
+
+            # Each block gets READ_BLOCK_TIMEOUT to come back, however many others arrive in the meantime
+            oldest = min(sent for addr, size, sent in inflight.values())
+
+            with timed('wait'):
+                got = self.connection.waitany(list(inflight), max(0, oldest + READ_BLOCK_TIMEOUT - time.time()))
+
+            if got is None:
+                now = time.time()
+                lost = sorted((seq, addr, size) for seq, (addr, size, sent) in inflight.items() if now - sent >= READ_BLOCK_TIMEOUT)
+
+                logger.info(f'Timeout waiting for {len(lost)} blocks')
+                tally('timeouts', len(lost))
+
+                for seq, addr, size in lost:
+                    del inflight[seq]
+                    failures[addr] += 1
+
+                # However many blocks a stall took with it, it is one timeout
+                if lost:
+                    sizer.record(max(size for seq, addr, size in lost), 0, 0)
+
+                if lost and not self._backoff(lost[0][1], max(failures[addr] for seq, addr, size in lost)):
+                    return
+
+                retry.extendleft(reversed([(addr, size) for seq, addr, size in sorted(lost, key = lambda l: l[1])]))
+                continue
+
+            seq, reply = got
+            addr, size, sent = inflight.pop(seq)
+            blockrtt(time.time() - sent)
+
+            block_data = self._extract_read_data(reply)
+            received = len(block_data or b'')
+
+            sizer.record(size, received, time.time() - sent)
+
+            # Trust the address the Deluge says it read from, replies can come back in any order
+            replyaddr = self._replyaddr(reply, fid, addr)
+            if replyaddr is None:
+                block_data = None
+
+            elif block_data and replyaddr != addr:
+                # A late answer to an earlier request with the same sequence number.  The data is
+                # still good, but the block we asked for is yet to come.
+                blocks.setdefault(replyaddr, block_data)
+                block_data = None
+
+            if not block_data:
+                failures[addr] += 1
+                if not self._backoff(addr, failures[addr]):
+                    return
+
+                retry.appendleft((addr, size))
+
+            else:
+                blocks[addr] = block_data
+
+                # Short read in the middle of the file, ask for the rest of that block again
+                if received < size:
+                    tally('short_reads')
+                    retry.append((addr + received, size - received))
+
+            # Pass on whatever now lines up with the end of the file so far
+            self._assemble(blocks, file_data, sink)
+
+    @staticmethod
+    def _assemble(blocks, file_data, sink = None):
+        """Move blocks that continue file_data onto its end.  Blocks can overlap after retries."""
+        while blocks:
+            addr = min(blocks)
+            if addr > len(file_data):
+                return
+
+            block_data = blocks.pop(addr)[len(file_data) - addr:]
+            if not block_data:
+                continue
+
+            file_data.extend(block_data)
+
+            if sink:
+                sink(block_data)
+
+    def _backoff(self, addr, failures):
+        """Wait a little longer after each failure of the same block.  False once it is time to give up."""
+        if failures > READ_RETRIES:
+            logger.info(f'Giving up on block at {addr} after {READ_RETRIES} retries')
+            return False
+
+        logger.info(f'Retrying block at {addr} ({failures} of {READ_RETRIES})')
+        tally('retries')
+
+        time.sleep(READ_RETRY_BACKOFF * 2 ** (failures - 1))
+        return True
+
+    @staticmethod
+    def _replyaddr(reply, fid, addr):
+        """Address a read reply says it is from, addr if it doesn't say.  None if it isn't about fid."""
+        if reply is None:
+            return None
+
+        read_resp = reply[0].get('^read') or {}
+        if read_resp.get('fid', fid) != fid:
+            return None
+
+        return read_resp.get('addr', addr)
+
+    def _blocksizer(self):
+        """The block sizer for whichever device the connection is talking to"""
+        device = self.connection.device
+        if self.blocksizer is None or self.blocksizer.device != device:
+            self.blocksizer = BlockSizer(device)
+
+        return self.blocksizer
+
+    def _extract_read_data(self, reply):
+        """Extract binary data from read command response"""
+        try:
+            if reply is None:
+                return None
+
+            response, sysex_data = reply
+            if "^read" not in response:
+                return None
+
+            read_resp = response["^read"]
+            if read_resp.get("err") != 0:
+                return None
+
+            # Find the zero separator between JSON and binary data
+            # Start searching after the SysEx header and sequence number
+            zero_x = findseparator(sysex_data, DelugeConnection.PAYLOAD_START)  # After [00 21 7B 01 05 seq]
+
+            # If binary data exists, extract and unpack it
+            if 0 <= zero_x < len(sysex_data) - 1:  # Must have at least separator + 1 byte
+                binary_data = self._extract_attached_data(sysex_data, zero_x)
+                return bytes(binary_data)
+
+            return b""  # No binary data found
+
+        except Exception as e:
+            logger.info(f'Error extracting read data: {e}')
+            return None
+
+    def _unpack_7bit_to_8bit(self, src_data, src_offset, src_len):
+        """Unpack 7-bit MIDI data to 8-bit binary data (from DelugeWeb)"""
+        try:
+            return unpack7to8(src_data, src_offset, src_len)
+        except Exception as e:
+            logger.info(f'Error unpacking 7-bit data: {e}')
+            return bytearray()
+
+    def _extract_attached_data(self, data, zero_x_pos):
+        """Extract attached binary data from SysEx message"""
+        att_len = len(data) - zero_x_pos - 1  # Ignore 0 separator, mido already dropped the ending 0xF7
+
+        if att_len <= 0:
+            return bytearray()
+
+        with timed('unpack'):
+            return self._unpack_7bit_to_8bit(data, zero_x_pos + 1, att_len)
+
+
+class FileTransport(Transport):
+    """The card mounted in a reader, or any folder laid out like one (SONGS/SONG001.XML...).
+    Files are memory mapped, so a read is as fast as the disk."""
+
+    CHUNK = 64 * 1024          # Bytes handed to the sink at a time
+
+    def __init__(self, root):
+        self.root = root
+        self.device = root
+
+    def listdir(self, path):
+        folder = findpath(self.root, path, directory = True)
+        if folder is None:
+            logger.info(f'Could not list directory: {path}')
+            return None
+
+        try:
+            entries = []
+            for entry in sorted(os.scandir(folder), key = lambda e: e.name):
+                st = entry.stat()
+                date, clock = fatdatetime(st.st_mtime)
+
+                entries.append({
+                    'name': entry.name,
+                    'size': st.st_size if entry.is_file() else 0,
+                    'date': date,
+                    'time': clock,
+                    'attr': 0x10 if entry.is_dir() else 0x20,
+                    })
+
+            return entries
+
+        except OSError as e:
+            logger.info(f'Error listing directory {path}: {e}')
+            return None
+
+    def stat(self, path):
+        local = findpath(self.root, path)
+        if local is None:
+            return None
+
+        try:
+            st = os.stat(local)
+        except OSError:
+            return None
+
+        date, clock = fatdatetime(st.st_mtime)
+        return { 'size': st.st_size, 'date': date, 'time': clock }
+
+    def read(self, path, sink = None, limit = None, check = None):
+        local = findpath(self.root, path)
+        if local is None:
+            return b''
+
+        sink = guarded(sink) if sink else None
+
+        try:
+            with open(local, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                    size = len(mm) if limit is None else min(len(mm), limit)
+
+                    if sink:
+                        for offset in range(0, size, self.CHUNK):
+                            if check:
+                                check()
+
+                            sink(mm[offset:min(size, offset + self.CHUNK)])
+
+                    return mm[:size]
+
+        except Cancelled:
+            raise
+        except SinkError as e:
+            raise e.error
+        except Exception as e:
+            logger.info(f'Error reading file {path}: {e}')
+            return None
+
+
+class MemoryTransport(Transport):
+    """Files held in memory, for tests.  Add and change them with put() and remove()."""
+
+    CHUNK = 4096
+
+    def __init__(self, files = None):
+        self.device = 'memory'
+        self.lock = threading.Lock()
+
+        self.files = {}        # normalised card path -> (name as given, bytes, mtime)
+        for path, data in (files or {}).items():
+            self.put(path, data)
+
+    @staticmethod
+    def _key(path):
+        return '/' + '/'.join(p.upper() for p in path.split('/') if p)
+
+    def put(self, path, data, mtime = None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        with self.lock:
+            self.files[self._key(path)] = (path.rstrip('/').split('/')[-1], bytes(data), mtime or time.time())
+
+    def remove(self, path):
+        with self.lock:
+            self.files.pop(self._key(path), None)
+
+    def listdir(self, path):
+        folder = self._key(path)
+        if folder != '/':
+            folder += '/'
+
+        with self.lock:
+            entries = []
+            for key, (name, data, mtime) in sorted(self.files.items()):
+                if not key.startswith(folder) or '/' in key[len(folder):]:
+                    continue
+
+                date, clock = fatdatetime(mtime)
+                entries.append({ 'name': name, 'size': len(data), 'date': date, 'time': clock, 'attr': 0x20 })
+
+        return entries
+
+    def stat(self, path):
+        with self.lock:
+            found = self.files.get(self._key(path))
+
+        if found is None:
+            return None
+
+        name, data, mtime = found
+        date, clock = fatdatetime(mtime)
+
+        return { 'size': len(data), 'date': date, 'time': clock }
+
+    def read(self, path, sink = None, limit = None, check = None):
+        with self.lock:
+            found = self.files.get(self._key(path))
+
+        if found is None:
+            return b''
+
+        data = found[1][:limit]
+
+        if sink:
+            for offset in range(0, len(data), self.CHUNK):
+                if check:
+                    check()
+
+                sink(data[offset:offset + self.CHUNK])
+
+        return data
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+DALConnector Benchmark
+======================
+
+This script times the hot paths between the Deluge and Live on synthetic songs:
+song conversion, note decoding, SysEx read reply unpacking and a whole fetch
+through the DelugeWeb protocol emulator. No Deluge is needed. Results (time
+per call, throughput and peak memory) are printed and written as JSON so two
+releases can be compared.
+
+Usage: python3 benchmark.py [--clips 40] [--rows 8] [--notes 16] [--mix 1:1:1]
+                            [--latency 0] [--bandwidth 0]
+                            [--output benchmark.json] [--compare old.json]
+Example: python3 benchmark.py --clips 200 --mix 2:1:0 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import DALConnector.config
+
+# What the fetcher learns (block sizes, cached songs) goes in a folder of its own, not ~/.dalconnector,
+# so every run starts out the same and runs can be compared
+WORKDIR = tempfile.mkdtemp(prefix = 'dalconnector-benchmark-')
+DALConnector.config.DATA_DIR = os.path.join(WORKDIR, 'data')
+
+from DALConnector.codec import pack8to7
+from DALConnector.connection import DelugeConnection
+from DALConnector.deluge2ableton import Deluge2Ableton, Synth
+from DALConnector.emulator import DelugeEmulator
+from DALConnector.fetcher import Fetcher
+from DALConnector.local import songfilename
+from DALConnector.transport import SysExTransport
+
+SEED = 1234
+MIN_RUN_TIME = 0.2      # Seconds each timed run should last at least
+REPEAT = 5              # Timed runs per benchmark, the best one is reported
+
+SONG_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<song firmwareVersion="4.1.0" timePerTimerTick="23" timerTickFraction="-1207959552" '
+               'inputTickMagnitude="1" swingAmount="0">\n<instruments>\n</instruments>\n<sessionClips>\n')
+SONG_FOOTER = '</sessionClips>\n</song>\n'
+
+
+def gensong(clips = 40, rows = 8, notes = 16, mix = (1, 1, 1), seed = SEED):
+    """Synthetic song XML with clips instrument clips of rows note rows of notes notes each.
+    mix weights how many of the clips are (kit, synth, midi)."""
+    rng = random.Random(seed)
+
+    parts = [SONG_HEADER]
+    for i in range(clips):
+        kind = rng.choices(('kit', 'synth', 'midi'), weights = mix)[0]
+        section = rng.randrange(8)
+        length = rng.choice((96, 192, 384, 768))
+
+        if kind == 'midi':
+            parts.append(f'<instrumentClip inKeyMode="0" section="{section}" length="{length}" midiChannel="{rng.randrange(16)}" colourOffset="0">\n')
+        else:
+            parts.append(f'<instrumentClip inKeyMode="0" section="{section}" length="{length}" '
+                         f'instrumentPresetSlot="{rng.randrange(16)}" instrumentPresetSubSlot="{rng.choice((-1, 0, 1))}" colourOffset="-3">\n')
+
+        if kind == 'kit':
+            parts.append('<kitParams reverbAmount="0x80000000" />\n')
+        elif kind == 'synth':
+            parts.append('<soundParams oscAVolume="0x7FFFFFFF" />\n')
+
+        parts.append('<noteRows>\n')
+        for r in range(rows):
+            notedata = '0x' + ''.join(
+                f'{rng.randrange(length):08X}{rng.randrange(1, 48):08X}{rng.randrange(1, 128):02X}{rng.randrange(21):02X}'
+                for _ in range(notes))
+
+            if kind == 'kit':
+                parts.append(f'<noteRow muted="0" colourOffset="0" noteData="{notedata}" drumIndex="{r}">\n<soundParams />\n</noteRow>\n')
+            else:
+                parts.append(f'<noteRow y="{rng.randrange(30, 90)}" muted="0" colourOffset="0" noteData="{notedata}" />\n')
+
+        parts.append('</noteRows>\n</instrumentClip>\n')
+
+    parts.append(SONG_FOOTER)
+    return ''.join(parts)
+
+
+def readreply(block, seq = 0x10):
+    """A read reply as the connection hands it over: (response, sysex data) with block attached"""
+    response = { '^read': { 'fid': 1, 'addr': 0, 'size': len(block), 'err': 0 } }
+    data = bytes([0x00, 0x21, 0x7B, 0x01, 0x05, seq]) + json.dumps(response).encode() + b'\x00' + pack8to7(block)
+
+    assert len(data) > DelugeConnection.PAYLOAD_START
+    return response, data
+
+
+def measure(func, size, items):
+    """Time func() and trace its peak memory.  size is bytes processed per call, items whatever it counts."""
+    func()     # Warm up
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= MIN_RUN_TIME:
+            break
+
+        number *= 2 if elapsed == 0 else max(2, int(MIN_RUN_TIME / elapsed) + 1)
+
+    runs = [elapsed / number]
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(runs)
+    return {
+        'seconds': best,
+        'mean_seconds': sum(runs) / len(runs),
+        'calls': number * REPEAT,
+        'bytes': size,
+        'items': items,
+        'bytes_per_second': size / best if best else None,
+        'items_per_second': items / best if best else None,
+        'peak_bytes': peak,
+        }
+
+
+def benchmarks(args):
+    mix = tuple(float(w) for w in args.mix.split(':'))
+    xml = gensong(args.clips, args.rows, args.notes, mix, args.seed)
+
+    notedata = re.findall(r'noteData="(0x[0-9A-F]*)"', xml)
+    notecount = sum((len(n) - 2) // 20 for n in notedata)
+
+    instrument = Synth('', '')
+    transport = SysExTransport()
+
+    rng = random.Random(args.seed)
+    block = bytes(rng.randrange(256) for _ in range(args.block))
+    reply = readreply(block)
+
+    packed = pack8to7(bytes(rng.randrange(256) for _ in range(args.unpack_bytes)))
+
+    def convert():
+        Deluge2Ableton.convert(xml)
+
+    def decodenotes():
+        for n in notedata:
+            instrument._decodenotes(60, n)
+
+    def extractreaddata():
+        transport._extract_read_data(reply)
+
+    def unpack():
+        transport._unpack_7bit_to_8bit(packed, 0, len(packed))
+
+    # The whole song fetched end to end from the emulator
+    folder = os.path.join(WORKDIR, 'card')
+    os.makedirs(os.path.join(folder, 'SONGS'))
+    with open(os.path.join(folder, 'SONGS', songfilename('001')), 'w') as f:
+        f.write(xml)
+
+    emulator = DelugeEmulator(folder, latency = args.latency / 1000, bandwidth = args.bandwidth or None, seed = args.seed)
+    emulated = Fetcher(SysExTransport(DelugeConnection(ports = emulator)))
+
+    def fetch():
+        if not emulated.fetchbytes('001'):
+            raise RuntimeError('emulated fetch failed')
+
+    return {
+        'convert': (convert, len(xml.encode()), args.clips),
+        'decodenotes': (decodenotes, sum(len(n) for n in notedata), notecount),
+        'extract_read_data': (extractreaddata, len(block), 1),
+        'unpack_7bit_to_8bit': (unpack, args.unpack_bytes, 1),
+        'fetch': (fetch, len(xml.encode()), 1),
+        }
+
+
+def compare(results, previous):
+    print()
+    print("Compared with previous run:")
+    for name, result in results.items():
+        old = previous.get('results', {}).get(name)
+        if not old or not result['seconds']:
+            continue
+
+        print(f"  {name:22} {old['seconds'] / result['seconds']:6.2f}x speed  "
+              f"{result['peak_bytes'] / max(1, old['peak_bytes']):6.2f}x memory")
+
+
+def main():
+    """Main benchmark function"""
+    parser = argparse.ArgumentParser(description = 'Benchmark the DALConnector conversion and codec hot paths')
+    parser.add_argument('--clips', type = int, default = 40, help = 'clips in the synthetic song')
+    parser.add_argument('--rows', type = int, default = 8, help = 'note rows per clip')
+    parser.add_argument('--notes', type = int, default = 16, help = 'notes per note row')
+    parser.add_argument('--mix', default = '1:1:1', help = 'kit:synth:midi weights of the clips')
+    parser.add_argument('--block', type = int, default = 1024, help = 'bytes attached to each read reply')
+    parser.add_argument('--unpack-bytes', type = int, default = 64 * 1024, help = 'bytes to unpack per call')
+    parser.add_argument('--latency', type = float, default = 0, help = 'emulated reply latency in milliseconds')
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'emulated wire speed in bytes/sec, 0 for no limit')
+    parser.add_argument('--seed', type = int, default = SEED)
+    parser.add_argument('--output', default = 'benchmark.json', help = 'where to write the results')
+    parser.add_argument('--compare', help = 'results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    print("DALConnector Benchmark")
+    print("======================")
+    print(f"{args.clips} clips x {args.rows} rows x {args.notes} notes, mix {args.mix}")
+    print()
+
+    results = {}
+    for name, (func, size, items) in benchmarks(args).items():
+        result = measure(func, size, items)
+        results[name] = result
+
+        print(f"  {name:22} {result['seconds'] * 1000:10.3f} ms  "
+              f"{result['bytes_per_second'] / 1e6:8.2f} MB/s  "
+              f"{result['peak_bytes'] / 1024:8.1f} KB peak")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': results,
+        }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    print()
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors = True)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+DALConnector SysEx Codec Test
+=============================
+
+This script checks the 7-bit/8-bit SysEx codec against the original byte by
+byte DelugeWeb unpacker, and that packing and unpacking round trip for
+random data of every length. No Deluge is needed.
+
+Usage: python3 test_codec.py
+"""
+
+import random
+import sys
+
+from DALConnector.codec import pack8to7, unpack7to8, findseparator, packedlength, unpackedlength
+
+SEED = 1234
+ROUNDS = 20
+
+
+def reference_unpack(src_data, src_offset, src_len):
+    """The original pure Python unpacker, kept here as the definition of correct"""
+    packets = (src_len + 7) // 8
+    missing = (8 * packets - src_len)
+    if missing == 7:
+        packets -= 1
+        missing = 0
+
+    out_len = 7 * packets - missing
+    if out_len <= 0:
+        return bytearray()
+
+    dst = bytearray(out_len)
+
+    for i in range(packets):
+        ipos = 8 * i
+        opos = 7 * i
+
+        for j in range(7):
+            if j + 1 + ipos >= src_len:
+                break
+            if opos + j >= out_len:
+                break
+
+            dst[opos + j] = src_data[src_offset + ipos + 1 + j] & 0x7f
+            if src_data[src_offset + ipos] & (1 << j):
+                dst[opos + j] |= 0x80
+
+    return dst
+
+
+def test_roundtrip():
+    """pack then unpack gives back the original data"""
+    rng = random.Random(SEED)
+
+    for length in range(0, 300):
+        for _ in range(ROUNDS if length < 40 else 2):
+            data = bytes(rng.randrange(256) for _ in range(length))
+
+            packed = pack8to7(data)
+            assert len(packed) == packedlength(length)
+            assert all(b < 0x80 for b in packed), 'packed data must be valid MIDI data bytes'
+            assert unpack7to8(packed) == data
+
+
+def test_matches_reference():
+    """unpack agrees with the original unpacker for any 7-bit input, offset and length"""
+    rng = random.Random(SEED)
+
+    for length in range(0, 200):
+        src = [rng.randrange(128) for _ in range(length + 10)]
+        offset = rng.randrange(10)
+
+        expected = reference_unpack(src, offset, length)
+
+        assert unpack7to8(src, offset, length) == expected
+        assert unpack7to8(bytes(src), offset, length) == expected
+        assert unpackedlength(length) == len(expected)
+
+
+def test_findseparator():
+    """The separator search finds the first 0x00 at or after start"""
+    reply = bytes([0x00, 0x21, 0x7B, 0x01, 0x05, 0x10]) + b'{"^read":{"err":0}}' + b'\x00' + pack8to7(b'\x00abc')
+
+    assert findseparator(reply, 6) == 6 + len(b'{"^read":{"err":0}}')
+    assert findseparator(list(reply), 6) == 6 + len(b'{"^read":{"err":0}}')
+    assert findseparator(b'{"^open":{"err":0}}', 0) == -1
+
+
+def main():
+    """Main test function"""
+    print("DALConnector SysEx Codec Test")
+    print("=============================")
+
+    failed = 0
+    for test in (test_roundtrip, test_matches_reference, test_findseparator):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+DALConnector Song Conversion Test
+=================================
+
+This script checks the song converter against the original regex based
+converter on generated songs, fed all at once and a few bytes at a time with
+multi-byte UTF-8 split across the pieces, and checks kit note rows whatever
+order their attributes come in. No Deluge is needed.
+
+Usage: python3 test_convert.py
+"""
+
+import random
+import re
+import sys
+
+from DALConnector.deluge2ableton import Deluge2Ableton, StreamConverter
+
+SEED = 1234
+SONGS = 30
+CHUNK_SIZES = (1, 7, 512, 4096)
+
+SONG_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<song firmwareVersion="4.1.0" timePerTimerTick="{tptt}" timerTickFraction="{ttf}" '
+               'inputTickMagnitude="1" swingAmount="0">\n<instruments>\n<sound name="Bäss ♫ 低音" />\n</instruments>\n<sessionClips>\n')
+SONG_FOOTER = '</sessionClips>\n</song>\n'
+
+
+############################################
+# The original converter, kept here as the definition of correct
+PPQN = 24 * 4
+
+
+def reference_notes(pitch, notedata):
+    notes = []
+
+    pos = 2
+    while pos < len(notedata):
+        notehex = notedata[pos:pos+20]
+        starttime = int(notehex[0:8], 16)
+        duration = int(notehex[8:16], 16)
+        velocity = int(notehex[16:18], 16)
+        probability = int(notehex[18:20], 16) & 0x7F
+
+        notes.append((pitch, starttime / PPQN, duration / PPQN, velocity, (probability * 5) / 100))
+        pos += 20
+
+    return notes
+
+
+def reference_clip(header, body):
+    """(identifier, section, length, notes of each row) or None"""
+    def number(pattern, text, default):
+        found = re.search(pattern, text)
+        return int(found.groups()[0]) if found else default
+
+    section = number(r'section="(\d+)"', header, 0)
+    length = number(r'length="(\d+)"', header, 0) / PPQN
+
+    if '<kitParams' in body:
+        name, rows = 'kit', [(36 + int(d), n) for n, d in re.findall(r'<noteRow.+?noteData="(.+?)".+?drumIndex="(\d+)"', body, re.DOTALL)]
+    elif 'midiChannel="' in header:
+        name, rows = 'midi', [(int(y), n) for y, n in re.findall(r'<noteRow.+?y="(\d+)".+?noteData="(.+?)"', body, re.DOTALL)]
+    elif 'oscAVolume=' in body:
+        name, rows = 'synth', [(int(y), n) for y, n in re.findall(r'<noteRow.+?y="(\d+)".+?noteData="(.+?)"', body, re.DOTALL)]
+    else:
+        return None
+
+    if name == 'midi':
+        identifier = 'midi %d' % number(r'midiChannel="(\d+)"', header, 0)
+    else:
+        slot = re.search(r'instrumentPresetSlot="(.+?)"', header)
+        subslot = re.search(r'instrumentPresetSubSlot="(.+?)"', header)
+        identifier = f'{name} {int(slot.groups()[0])}.{int(subslot.groups()[0])}' if slot and subslot else None
+
+    return identifier, section, length, [reference_notes(pitch, notedata) for pitch, notedata in rows]
+
+
+def reference_convert(xml):
+    maxsceneid = 0
+    clipmap = {}
+    trackmap = {}
+    ordering = []
+
+    for header, body in reversed(re.findall(r'<instrumentClip(.+?)>(.+?)</instrumentClip>', xml, re.DOTALL)):
+        clip = reference_clip(header, body)
+        if not clip:
+            continue
+
+        identifier, sceneid, length, rows = clip
+        maxsceneid = max(maxsceneid, sceneid)
+
+        if not identifier:
+            continue
+
+        key = f'{identifier}|{sceneid}'
+        clipmap.setdefault(key, [])
+
+        if identifier not in ordering:
+            trackmap[identifier] = len(ordering)
+            ordering.append(identifier)
+
+        for notes in rows:
+            clipmap[key].append({ 'length': length, 'trackidx': trackmap[identifier], 'sceneidx': sceneid, 'notes': notes })
+
+    result = []
+    for value in clipmap.values():
+        result += value
+
+    tptt = int(re.search(r'timePerTimerTick="(\d+)"', xml).groups()[0])
+    ttf = int(re.search(r'timerTickFraction="(-*\d+)"', xml).groups()[0]) / 0x100000000
+    itm = int(re.search(r'inputTickMagnitude="(\d+)"', xml).groups()[0])
+    tempo = (551250 / (ttf + tptt)) / (10 * itm)
+
+    return { 'bpm': int(tempo) if tempo > 0 else 120, 'numscenes': maxsceneid, 'clipmap': list(reversed(result)), 'maxtrackid': len(ordering) }
+
+
+############################################
+def gensong(seed, clips = 20, rows = 6, notes = 12):
+    """Song XML with a random mix of kit, synth and midi clips"""
+    rng = random.Random(seed)
+
+    parts = [SONG_HEADER.format(tptt = rng.randrange(10, 40), ttf = rng.randrange(-2 ** 31, 2 ** 31))]
+    for i in range(clips):
+        kind = rng.choice(('kit', 'synth', 'midi', 'audio'))
+        section = rng.randrange(8)
+        length = rng.choice((96, 192, 384, 768))
+
+        if kind == 'midi':
+            parts.append(f'<instrumentClip inKeyMode="0" section="{section}" length="{length}" midiChannel="{rng.randrange(16)}" colourOffset="0">\n')
+        else:
+            parts.append(f'<instrumentClip inKeyMode="0" section="{section}" length="{length}" '
+                         f'instrumentPresetSlot="{rng.randrange(8)}" instrumentPresetSubSlot="{rng.choice((-1, 0, 1))}" colourOffset="-3">\n')
+
+        if kind == 'kit':
+            parts.append('<kitParams reverbAmount="0x80000000" />\n')
+        elif kind == 'synth':
+            parts.append('<soundParams oscAVolume="0x7FFFFFFF" />\n')
+
+        parts.append(f'<sound name="Pad ♪ {i} — ünïcødé" />\n<noteRows>\n')
+        for r in range(rng.randrange(1, rows)):
+            notedata = '0x' + ''.join(
+                f'{rng.randrange(length):08X}{rng.randrange(1, 48):08X}{rng.randrange(1, 128):02X}{rng.randrange(256):02X}'
+                for _ in range(rng.randrange(1, notes)))
+
+            if kind == 'kit':
+                parts.append(f'<noteRow muted="0" colourOffset="0" noteData="{notedata}" drumIndex="{r}">\n<soundParams />\n</noteRow>\n')
+            else:
+                parts.append(f'<noteRow y="{rng.randrange(30, 90)}" muted="0" colourOffset="0" noteData="{notedata}" />\n')
+
+        parts.append('</noteRows>\n</instrumentClip>\n')
+
+    parts.append(SONG_FOOTER)
+    return ''.join(parts)
+
+
+def plain(songhsh):
+    """songhsh with each clip's notes as a list of tuples, so the two converters can be compared"""
+    result = dict(songhsh)
+    result['clipmap'] = [dict(clip, notes = list(clip['notes'])) for clip in songhsh['clipmap']]
+
+    return result
+
+
+def streamed(data, size):
+    converter = StreamConverter()
+    for i in range(0, len(data), size):
+        converter.feed(data[i:i + size])
+
+    return converter.finish()
+
+
+def test_matches_reference():
+    """Converting a whole song agrees with the original converter"""
+    for seed in range(SONGS):
+        xml = gensong(SEED + seed)
+
+        assert plain(Deluge2Ableton.convert(xml)) == reference_convert(xml), f'song {seed}'
+
+
+def test_streamed():
+    """Converting a song as it arrives, in pieces of any size, gives the same result"""
+    for seed in range(SONGS):
+        xml = gensong(SEED + seed)
+        data = xml.encode('utf-8')
+        expected = reference_convert(xml)
+
+        for size in CHUNK_SIZES:
+            assert plain(streamed(data, size)) == expected, f'song {seed} in pieces of {size}'
+
+
+def test_kit_attribute_order():
+    """Kit note rows get their drum's pitch whether drumIndex comes before or after noteData"""
+    notedata = '0x' + '00000000' + '00000018' + '64' + '14'
+    rows = (f'<noteRow drumIndex="3" muted="0" noteData="{notedata}" />\n'
+            f'<noteRow muted="0" noteData="{notedata}" drumIndex="5">\n<soundParams />\n</noteRow>\n')
+
+    xml = (SONG_HEADER.format(tptt = 23, ttf = 0) +
+           '<instrumentClip inKeyMode="0" section="0" length="96" instrumentPresetSlot="1" instrumentPresetSubSlot="-1" colourOffset="0">\n'
+           f'<kitParams reverbAmount="0x80000000" />\n<noteRows>\n{rows}</noteRows>\n</instrumentClip>\n' + SONG_FOOTER)
+
+    for songhsh in (Deluge2Ableton.convert(xml), streamed(xml.encode('utf-8'), 7)):
+        pitches = [[note[0] for note in clip['notes']] for clip in songhsh['clipmap']]
+        assert sorted(pitches) == [[36 + 3], [36 + 5]]
+
+
+def main():
+    """Main test function"""
+    print("DALConnector Song Conversion Test")
+    print("=================================")
+
+    failed = 0
+    for test in (test_matches_reference, test_streamed, test_kit_attribute_order):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
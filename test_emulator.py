@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+DALConnector Emulator Fetch Test
+================================
+
+This script fetches songs through the DelugeWeb protocol emulator, over a
+clean link and over links that drop, shorten, reorder and fail replies, and
+checks every byte of what comes back. No Deluge is needed.
+
+Usage: python3 test_emulator.py
+"""
+
+import itertools
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+
+import DALConnector.config
+import DALConnector.transport
+from DALConnector.connection import DelugeConnection
+from DALConnector.emulator import DelugeEmulator
+from DALConnector.fetcher import Fetcher, ThreadShare
+from DALConnector.jobs import JobQueue
+from DALConnector.local import songfilename, songpath
+from DALConnector.transport import SysExTransport
+
+SEED = 1234
+SONG_BYTES = 20000
+TRIES = 5               # Like Fetcher._fetchsong, later tries carry on from what earlier ones got
+
+# Lost blocks are asked for again sooner than over USB, to keep the test quick
+DALConnector.transport.READ_BLOCK_TIMEOUT = 0.2
+DALConnector.transport.READ_RETRY_BACKOFF = 0.01
+
+
+SONG = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<song firmwareVersion="4.1.0" timePerTimerTick="23" timerTickFraction="0" inputTickMagnitude="1" swingAmount="0">\n'
+        '<instruments>\n</instruments>\n<sessionClips>\n'
+        '<instrumentClip inKeyMode="0" section="0" length="192" instrumentPresetSlot="3" instrumentPresetSubSlot="-1" colourOffset="0">\n'
+        '<soundParams oscAVolume="0x7FFFFFFF" />\n<noteRows>\n'
+        '<noteRow y="60" muted="0" colourOffset="0" noteData="0x000000000000000C6414" />\n'
+        '</noteRows>\n</instrumentClip>\n</sessionClips>\n</song>\n').encode('utf-8')
+
+
+class Share(ThreadShare):
+    """ThreadShare without a fetcher thread, the tests call the fetcher themselves"""
+
+    def __init__(self):
+        self.finished = False
+        self.ids = itertools.count(1)
+
+        self.jobs = JobQueue()
+        self.events = queue.Queue()
+
+
+def makecard(content):
+    """Card folder with content as song 001"""
+    folder = tempfile.mkdtemp(dir = WORKDIR)
+    os.makedirs(os.path.join(folder, 'SONGS'))
+
+    with open(os.path.join(folder, 'SONGS', songfilename('001')), 'wb') as f:
+        f.write(content)
+
+    return folder
+
+
+def songbytes(seed = SEED):
+    """Every byte value, including the ones SysEx has to pack"""
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for _ in range(SONG_BYTES))
+
+
+def fetch(content, **faults):
+    """content as fetched from an emulator with faults, and what the emulator was asked"""
+    emulator = DelugeEmulator(makecard(content), seed = SEED, **faults)
+    fetcher = Fetcher(SysExTransport(DelugeConnection(ports = emulator)))
+
+    try:
+        for _ in range(TRIES):
+            file_data = fetcher.fetchbytes('001')
+            if file_data is not None:
+                return file_data, emulator.counts
+
+        return None, emulator.counts
+    finally:
+        fetcher.transport.close()
+        emulator.close()
+
+
+def test_clean():
+    """A clean link gives back the file exactly"""
+    content = songbytes()
+    file_data, counts = fetch(content)
+
+    assert file_data == content
+    assert counts['open'] == 1 and counts['close'] == 1
+
+
+def test_drop():
+    """Dropped replies are asked for again"""
+    content = songbytes(1)
+    file_data, counts = fetch(content, drop = 0.05, maxblock = 512)
+
+    assert file_data == content
+    assert counts['read'] > SONG_BYTES // 512, 'some reads should have been lost'
+
+
+def test_short():
+    """Short reads are finished off"""
+    content = songbytes(2)
+    file_data, counts = fetch(content, short = 0.3)
+
+    assert file_data == content
+
+
+def test_reorder():
+    """Replies out of order are put back in order"""
+    content = songbytes(3)
+    file_data, counts = fetch(content, reorder = 0.3, latency = 0.001)
+
+    assert file_data == content
+
+
+def test_error():
+    """Read errors are retried"""
+    content = songbytes(4)
+    file_data, counts = fetch(content, error = 0.1)
+
+    assert file_data == content
+
+
+def test_everything():
+    """All of the above at once"""
+    content = songbytes(5)
+    file_data, counts = fetch(content, drop = 0.03, short = 0.1, reorder = 0.2, error = 0.05, latency = 0.001, maxblock = 1024)
+
+    assert file_data == content
+
+
+def test_missing():
+    """A song that isn't on the card comes back empty, not as an error"""
+    emulator = DelugeEmulator(makecard(b''), seed = SEED)
+    fetcher = Fetcher(SysExTransport(DelugeConnection(ports = emulator)))
+
+    try:
+        assert fetcher.fetchbytes('002') == b''
+    finally:
+        fetcher.transport.close()
+        emulator.close()
+
+
+def test_sink_error():
+    """An error from whatever the file is handed to comes out of the read, with no reconnect or second try"""
+    content = songbytes(6)
+    emulator = DelugeEmulator(makecard(content), seed = SEED)
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    def sink(block):
+        raise ValueError('bad block')
+
+    try:
+        try:
+            transport.read(songpath('001'), sink)
+            assert False, 'the sink error should come out of read()'
+        except ValueError:
+            pass
+
+        file_data = transport.read(songpath('001'))
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert file_data == content
+    assert emulator.counts['session'] == 1
+    assert emulator.counts['open'] == 2 and emulator.counts['close'] == 2
+
+
+def test_cache():
+    """An unchanged song comes from the cache, though open replies carry no date"""
+    emulator = DelugeEmulator(makecard(SONG), seed = SEED)
+    fetcher = Fetcher(SysExTransport(DelugeConnection(ports = emulator)))
+    fetcher.ts = Share()
+
+    try:
+        first = fetcher._loadsong('001', fetcher.songstat('001'))
+        reads = emulator.counts['read']
+
+        second = fetcher._loadsong('001', fetcher.songstat('001'))
+    finally:
+        fetcher.transport.close()
+        emulator.close()
+
+    assert first and first == second
+    assert emulator.counts['read'] == reads, 'the second load should not read the song again'
+
+
+def test_prefetch():
+    """A prefetched song is loaded from the cache"""
+    # A different size from test_cache's song, which may be cached under the same path and date
+    emulator = DelugeEmulator(makecard(SONG.replace(b'"23"', b'"131"')), seed = SEED)
+    fetcher = Fetcher(SysExTransport(DelugeConnection(ports = emulator)))
+    fetcher.ts = Share()
+
+    try:
+        fetcher._prefetch('001')
+        reads = emulator.counts['read']
+
+        songhsh = fetcher._loadsong('001', fetcher.songstat('001'))
+    finally:
+        fetcher.transport.close()
+        emulator.close()
+
+    assert reads > 0, 'the prefetch should have read the song'
+    assert songhsh and emulator.counts['read'] == reads
+
+
+def setup_module(module):
+    global WORKDIR, HOME_DATA_DIR
+
+    # Block sizes and cached songs from these runs stay out of ~/.dalconnector
+    WORKDIR = tempfile.mkdtemp(prefix = 'dalconnector-test-')
+
+    HOME_DATA_DIR = DALConnector.config.DATA_DIR
+    DALConnector.config.DATA_DIR = os.path.join(WORKDIR, 'data')
+
+
+def teardown_module(module):
+    DALConnector.config.DATA_DIR = HOME_DATA_DIR
+    shutil.rmtree(WORKDIR, ignore_errors = True)
+
+
+def main():
+    """Main test function"""
+    print("DALConnector Emulator Fetch Test")
+    print("================================")
+
+    setup_module(None)
+
+    failed = 0
+    for test in (test_clean, test_drop, test_short, test_reorder, test_error, test_everything, test_missing, test_sink_error, test_cache, test_prefetch):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    teardown_module(None)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+DALConnector Fetcher Test
+=========================
+
+This script runs the fetcher against songs held in memory: finding the next
+unused save name, picking up new saves and saves over the loaded song while
+watching, and reusing cached songs until they change on the card. No Deluge
+is needed.
+
+Usage: python3 test_fetcher.py
+"""
+
+import itertools
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+import DALConnector.config
+from DALConnector.cache import SeriesCache
+from DALConnector.fetcher import Fetcher, ThreadShare
+from DALConnector.indexer import headerinfo, describe
+from DALConnector.jobs import JobQueue, Cancelled, LOAD, SCAN, PREFETCH, INDEX
+from DALConnector.local import songpath
+from DALConnector.transport import MemoryTransport
+
+
+def songxml(timepertimertick = 23, notes = 4):
+    """Song with one synth clip, its tempo set by timepertimertick"""
+    notedata = '0x' + ''.join(f'{i * 24:08X}{12:08X}{100:02X}{20:02X}' for i in range(notes))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<song firmwareVersion="4.1.0" timePerTimerTick="{timepertimertick}" timerTickFraction="0" inputTickMagnitude="1" swingAmount="0">\n'
+            '<instruments>\n</instruments>\n<sessionClips>\n'
+            '<instrumentClip inKeyMode="0" section="0" length="192" instrumentPresetSlot="3" instrumentPresetSubSlot="-1" colourOffset="0">\n'
+            '<soundParams oscAVolume="0x7FFFFFFF" />\n<noteRows>\n'
+            f'<noteRow y="60" muted="0" colourOffset="0" noteData="{notedata}" />\n'
+            '</noteRows>\n</instrumentClip>\n</sessionClips>\n</song>\n')
+
+
+class CountingTransport(MemoryTransport):
+    """Remembers every file read"""
+
+    def __init__(self, files = None):
+        super(CountingTransport, self).__init__(files)
+        self.reads = []
+
+    def read(self, path, sink = None, limit = None, check = None):
+        self.reads.append(path)
+        return super(CountingTransport, self).read(path, sink, limit, check)
+
+
+class UnlistedTransport(CountingTransport):
+    """A card that can't be listed, like firmware without dir"""
+
+    def listdir(self, path):
+        return None
+
+
+class Share(ThreadShare):
+    """ThreadShare without a fetcher thread, the tests call the fetcher themselves"""
+
+    def __init__(self):
+        self.finished = False
+        self.ids = itertools.count(1)
+
+        self.jobs = JobQueue()
+        self.events = queue.Queue()
+
+
+def makefetcher(transport):
+    fetcher = Fetcher(transport)
+    fetcher.ts = Share()
+    fetcher.songnames = None
+
+    return fetcher
+
+
+def card(*names):
+    return { songpath(name): songxml() for name in names }
+
+
+def later(seconds = 10):
+    """An mtime the card's two second date resolution can tell from now"""
+    return time.time() + seconds
+
+
+def test_findunusedname():
+    """The first save name that isn't on the card comes after the last one that is"""
+    fetcher = makefetcher(CountingTransport(card('005', '005A', '005B', '006')))
+
+    assert fetcher._findunusedname('005') == '005C'
+    assert fetcher.KNOWN_CACHE.get('005') == '005B'
+
+    fetcher.transport.put(songpath('005C'), songxml())
+    fetcher.index.listed = None
+
+    assert fetcher._findunusedname('005') == '005D'
+    assert not fetcher.transport.reads, 'the listing should answer without reading any song'
+
+
+def test_findunusedname_unlisted():
+    """Without a directory listing the names are tried one by one"""
+    fetcher = makefetcher(UnlistedTransport(card('007', '007A')))
+
+    saves = []
+    save = fetcher.KNOWN_CACHE._save
+    fetcher.KNOWN_CACHE._save = lambda: saves.append(save())
+
+    assert fetcher._findunusedname('007') == '007B'
+    fetcher.KNOWN_CACHE._save = save
+
+    assert fetcher.transport.reads == [songpath('007B')], 'songs that are there should only be stat()ed'
+
+    assert fetcher.KNOWN_CACHE.get('007') == '007A'
+    assert len(saves) == 1, 'the series head should be saved once, when the scan ends'
+
+
+def test_findunusedname_cancel():
+    """A load stops the name by name scan between names"""
+    fetcher = makefetcher(UnlistedTransport(card('011', '011A', '011B', '011C')))
+
+    fetcher.ts.jobs.put(SCAN, '011', 1, target = 'a')
+    fetcher.job = fetcher.ts.jobs.get(0)
+
+    stat = fetcher.stat
+    def loadafterfirst(delugesong):
+        fetcher.ts.jobs.put(LOAD, '012', 2, target = 'a')
+        return stat(delugesong)
+
+    fetcher.stat = loadafterfirst
+    try:
+        fetcher._findunusedname('011')
+        assert False, 'the scan should have been cancelled'
+    except Cancelled:
+        pass
+
+    assert fetcher.transport.reads == []
+
+
+def test_job_error():
+    """A job that fails doesn't stop the fetcher"""
+    fetcher = makefetcher(CountingTransport(card('013')))
+
+    ran = []
+    def runjob(job):
+        ran.append(job.kind)
+        if job.kind == PREFETCH:
+            raise IOError('disk full')
+
+        fetcher.ts.finished = True
+
+    fetcher._runjob = runjob
+    fetcher.ts.jobs.put(INDEX, None)
+    fetcher.ts.jobs.put(PREFETCH, '013')
+    fetcher.loop()
+
+    assert ran == [PREFETCH, INDEX]
+
+
+def test_watch_nextsong():
+    """A new save turns up while watching for it"""
+    transport = CountingTransport(card('008'))
+    fetcher = makefetcher(transport)
+
+    fetcher.watch.nextsong = '008A'
+    fetcher._nextsongfetch()
+
+    assert [e for e in fetcher.ts.getevents() if e.kind == ThreadShare.NEXTSONG] == []
+
+    transport.put(songpath('008A'), songxml(30))
+    fetcher._nextsongfetch()
+
+    found = [e for e in fetcher.ts.getevents() if e.kind == ThreadShare.NEXTSONG]
+    assert [e.delugesong for e in found] == ['008A']
+    assert found[0].songhsh['clipmap']
+    assert fetcher.watch.nextsong == '008B'
+
+
+def test_watch_saved_over():
+    """The loaded song is fetched again once its size or date moves, and only then"""
+    transport = CountingTransport(card('009'))
+    fetcher = makefetcher(transport)
+
+    assert fetcher._mainfetch('009')
+    loaded = fetcher.ts.getevents()[-1].songhsh
+
+    fetcher._currentsongfetch()
+    assert fetcher.ts.getevents() == []
+
+    transport.put(songpath('009'), songxml(30, notes = 6), mtime = later())
+    fetcher._currentsongfetch()
+
+    found = [e for e in fetcher.ts.getevents() if e.kind == ThreadShare.NEXTSONG]
+    assert [e.delugesong for e in found] == ['009']
+    assert found[0].songhsh['bpm'] != loaded['bpm']
+
+
+def test_headerinfo():
+    """The index only gives a clip count when the head of the song shows one"""
+    xml = songxml().encode('utf-8')
+    instruments = b'<instruments>\n' + b'<sound name="Pad" oscAVolume="0x7FFFFFFF" />\n' * 200 + b'</instruments>\n'
+    big = xml.replace(b'<instruments>\n</instruments>\n', instruments)
+
+    info = headerinfo(big[:4096], len(big))
+    assert info['bpm'] and info['clips'] is None
+    assert describe(info) == f"{info['bpm']} bpm"
+
+    info = headerinfo(xml, len(xml))
+    assert info['clips'] == 1 and info['exact']
+    assert describe(info) == f"{info['bpm']} bpm, 1 clip"
+
+
+def test_cache():
+    """A song that hasn't changed comes from the cache, a changed one from the card"""
+    transport = CountingTransport(card('010'))
+    fetcher = makefetcher(transport)
+
+    stat = fetcher.stat('010')
+    first = fetcher._loadsong('010', stat)
+
+    index = os.path.join(fetcher.songcache.root, fetcher.songcache.INDEX)
+    saved = os.stat(index).st_mtime_ns
+    second = fetcher._loadsong('010', fetcher.stat('010'))
+
+    assert first == second
+    assert transport.reads == [songpath('010')]
+    assert os.stat(index).st_mtime_ns == saved, 'a cache hit should not rewrite the index'
+
+    transport.put(songpath('010'), songxml(30), mtime = later())
+    changed = fetcher._loadsong('010', fetcher.stat('010'))
+
+    assert changed['bpm'] != first['bpm']
+    assert len(transport.reads) == 2
+
+
+def setup_module(module):
+    global WORKDIR, HOME_DATA_DIR
+
+    # The song cache, song index and series cache go in a temp folder instead of ~/.dalconnector
+    WORKDIR = tempfile.mkdtemp(prefix = 'dalconnector-test-')
+
+    HOME_DATA_DIR = DALConnector.config.DATA_DIR
+    DALConnector.config.DATA_DIR = os.path.join(WORKDIR, 'data')
+
+    # The series cache is shared by every Fetcher, start from an empty one
+    Fetcher.KNOWN_CACHE = SeriesCache()
+
+
+def teardown_module(module):
+    DALConnector.config.DATA_DIR = HOME_DATA_DIR
+    shutil.rmtree(WORKDIR, ignore_errors = True)
+
+
+def main():
+    """Main test function"""
+    print("DALConnector Fetcher Test")
+    print("=========================")
+
+    setup_module(None)
+
+    failed = 0
+    for test in (test_findunusedname, test_findunusedname_unlisted, test_findunusedname_cancel, test_job_error, test_watch_nextsong, test_watch_saved_over, test_headerinfo, test_cache):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    teardown_module(None)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+DALConnector Job Queue Test
+===========================
+
+This script checks the fetcher's job queue: most important work first,
+merging repeated requests, a load taking over or cancelling the running job,
+indexing surviving a clear, and targets taking turns. No Deluge is needed.
+
+Usage: python3 test_jobs.py
+"""
+
+import sys
+
+from DALConnector.jobs import JobQueue, Cancelled, LOAD, WATCH, SCAN, PREFETCH, INDEX
+
+
+def drain(jobs):
+    """Every job that is due, in the order the fetcher would get them"""
+    result = []
+    while True:
+        job = jobs.get(0)
+        if job is None:
+            return result
+
+        result.append(job)
+
+
+def test_priority():
+    """Loads go before watching, scanning, prefetching and indexing"""
+    jobs = JobQueue()
+    jobs.put(INDEX, None)
+    jobs.put(PREFETCH, '006')
+    jobs.put(SCAN, '005')
+    jobs.put(WATCH, '005A')
+    jobs.put(LOAD, '007', 1)
+
+    # The load cleared the other song's watch, scan and prefetch
+    assert [(job.kind, job.delugesong) for job in drain(jobs)] == [(LOAD, '007'), (INDEX, None)]
+
+
+def test_delay():
+    """A job isn't handed out before it is due"""
+    jobs = JobQueue()
+    jobs.put(WATCH, '005A', 1, delay = 60)
+
+    assert jobs.get(0) is None
+
+
+def test_merge():
+    """Asking again for something already queued merges into the queued job"""
+    jobs = JobQueue()
+    first = jobs.put(PREFETCH, '006', 1)
+    second = jobs.put(PREFETCH, '006', 2)
+
+    assert first is second
+    assert second.requestid == 2
+    assert len(drain(jobs)) == 1
+
+
+def test_no_merge_across_targets():
+    """The same song for two targets is two jobs"""
+    jobs = JobQueue()
+    jobs.put(WATCH, '005A', 1, target = 'a')
+    jobs.put(WATCH, '005A', 2, target = 'b')
+
+    assert sorted(job.target for job in drain(jobs)) == ['a', 'b']
+
+
+def test_takeover():
+    """A load of the song being prefetched takes over the prefetch instead of starting again"""
+    jobs = JobQueue()
+    jobs.put(PREFETCH, '006')
+    running = jobs.get(0)
+
+    load = jobs.put(LOAD, '006', 5)
+
+    assert load is running
+    assert running.kind == LOAD and running.requestid == 5
+    assert not running.cancelled
+    jobs.check(running)
+
+
+def test_no_takeover_after_answer():
+    """Once the running job has answered, a new request for its song gets a job of its own"""
+    jobs = JobQueue()
+    jobs.put(LOAD, '005', 1, target = 'a')
+    running = jobs.get(0)
+
+    assert jobs.answer(running) == 1
+
+    load = jobs.put(LOAD, '005', 2, target = 'a')
+
+    assert load is not running
+    assert running.requestid == 1 and running.cancelled
+    assert [(job.kind, job.requestid) for job in drain(jobs)] == [(LOAD, 2)]
+
+    # The same goes for a prefetch that has looked at whether it became a load
+    jobs.put(PREFETCH, '006')
+    running = jobs.get(0)
+    jobs.answer(running)
+
+    load = jobs.put(LOAD, '006', 3)
+
+    assert load is not running and running.kind == PREFETCH
+    assert [(job.kind, job.requestid) for job in drain(jobs)] == [(LOAD, 3)]
+
+
+def test_cancel():
+    """A load of another song cancels the running job, which stops at its next check"""
+    jobs = JobQueue()
+    jobs.put(LOAD, '005', 1)
+    running = jobs.get(0)
+
+    jobs.put(LOAD, '006', 2)
+
+    assert running.cancelled
+    try:
+        jobs.check(running)
+        assert False, 'check should raise Cancelled'
+    except Cancelled:
+        pass
+
+    # Nothing follows a cancelled job
+    assert jobs.follow(running, SCAN, '005') is None
+    assert [job.delugesong for job in drain(jobs)] == ['006']
+
+
+def test_cancel_other_target():
+    """A load for one target leaves another target's running load alone, but not background work"""
+    jobs = JobQueue()
+    jobs.put(LOAD, '005', 1, target = 'a')
+    running = jobs.get(0)
+
+    jobs.put(LOAD, '006', 2, target = 'b')
+    assert not running.cancelled
+
+    jobs.clear()
+    jobs.put(INDEX, None)
+    indexing = jobs.get(0)
+
+    jobs.put(LOAD, '007', 3, target = 'b')
+    assert indexing.cancelled
+
+    assert [job.delugesong for job in drain(jobs)] == ['007']
+
+
+def test_clear_keeps_index():
+    """Clearing drops song work but indexing survives"""
+    jobs = JobQueue()
+    jobs.put(INDEX, None)
+    jobs.put(WATCH, '005A', 1, target = 'a')
+    jobs.put(SCAN, '006', 2, target = 'b')
+
+    jobs.clear('a')
+    assert sorted((job.kind, job.target) for job in jobs.jobs) == [(SCAN, 'b'), (INDEX, None)]
+
+    jobs.clear()
+    assert [job.kind for job in jobs.jobs] == [INDEX]
+
+
+def test_turns():
+    """Targets with work of the same kind take turns"""
+    jobs = JobQueue()
+    for song in ('005A', '005B', '005C'):
+        jobs.put(WATCH, song, 1, target = 'a')
+    for song in ('006A', '006B'):
+        jobs.put(WATCH, song, 2, target = 'b')
+
+    assert [job.target for job in drain(jobs)] == ['a', 'b', 'a', 'b', 'a']
+
+
+def main():
+    """Main test function"""
+    print("DALConnector Job Queue Test")
+    print("===========================")
+
+    failed = 0
+    for test in (test_priority, test_delay, test_merge, test_no_merge_across_targets, test_takeover, test_no_takeover_after_answer, test_cancel,
+                 test_cancel_other_target, test_clear_keeps_index, test_turns):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -65,24 +65,25 @@ def list_midi_ports():
 def test_deluge_connection():
     """Test if Deluge MIDI port is available."""
     try:
-        import mido
         from DALConnector.config import DELUGE_MIDI_PORT_NAME
+        from DALConnector.ports import PortRegistry
         
         print(f"\nTesting Deluge connection (looking for '{DELUGE_MIDI_PORT_NAME}')...")
         
-        output_ports = mido.get_output_names()
-        input_ports = mido.get_input_names()
+        # The same lookup DALConnector does, listed fresh rather than remembered
+        registry = PortRegistry()
+        registry.rescan()
         
-        deluge_output_found = any(DELUGE_MIDI_PORT_NAME in port for port in output_ports)
-        deluge_input_found = any(DELUGE_MIDI_PORT_NAME in port for port in input_ports)
+        deluge_output_found = registry.output is not None
+        deluge_input_found = registry.input is not None
         
         if deluge_output_found:
-            print("✓ Deluge MIDI output port found")
+            print(f"✓ Deluge MIDI output port found: {registry.output}")
         else:
             print("✗ Deluge MIDI output port not found")
         
         if deluge_input_found:
-            print("✓ Deluge MIDI input port found")
+            print(f"✓ Deluge MIDI input port found: {registry.input}")
         else:
             print("✗ Deluge MIDI input port not found")
         
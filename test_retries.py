@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+DALConnector Read Retry Test
+============================
+
+This script loses chosen read replies from the DelugeWeb protocol emulator and
+checks that the block is asked for again, that a read which gives up carries
+on from where it stopped after reconnecting, and that whatever is handed the
+file as it arrives never gets the same bytes twice. No Deluge is needed.
+
+Usage: python3 test_retries.py
+"""
+
+import collections
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import DALConnector.config
+import DALConnector.transport
+from DALConnector.config import DELUGE_MIDI_PORT_NAME, READ_RETRIES
+from DALConnector.connection import DelugeConnection
+from DALConnector.emulator import DelugeEmulator
+from DALConnector.local import songfilename, songpath
+from DALConnector.transport import SysExTransport
+
+SEED = 1234
+SONG_BYTES = 8000
+LOST = 1024             # Read address whose replies go missing, in the first window at any block size up to 1024
+
+DALConnector.transport.READ_BLOCK_TIMEOUT = 0.2
+DALConnector.transport.READ_RETRY_BACKOFF = 0.01
+
+
+class ScriptedDeluge(DelugeEmulator):
+    """Emulator that loses the replies to reads at chosen addresses, and can stop short of the end of the file"""
+
+    def __init__(self, folder, name, lose = None, end = None):
+        # A port name of its own, so each test starts from the default block size
+        super(ScriptedDeluge, self).__init__(folder, portname = f'{DELUGE_MIDI_PORT_NAME} ({name})', seed = SEED)
+
+        self.lose = collections.Counter(lose or {})    # addr -> how many replies to lose
+        self.end = end                                 # Reads from here on come back empty
+        self.addrs = []                                # Every read address asked for
+        self.opens = []                                # len(addrs) at each open
+
+    def _open(self, seq, args):
+        self.opens.append(len(self.addrs))
+        super(ScriptedDeluge, self)._open(seq, args)
+
+    def _read(self, seq, args):
+        addr = args.get('addr', 0)
+        self.addrs.append(addr)
+
+        if self.lose[addr] > 0:
+            self.lose[addr] -= 1
+            return
+
+        if self.end is not None and addr >= self.end:
+            self._reply(seq, 'read', { 'fid': args.get('fid'), 'addr': addr, 'size': 0, 'err': 0 }, b'')
+            return
+
+        super(ScriptedDeluge, self)._read(seq, args)
+
+    def readsince(self, opened):
+        """Read addresses asked for since the opened-th open"""
+        return self.addrs[self.opens[opened]:]
+
+
+def makecard(content):
+    folder = tempfile.mkdtemp(dir = WORKDIR)
+    os.makedirs(os.path.join(folder, 'SONGS'))
+    writesong(folder, content)
+
+    return folder
+
+
+def writesong(folder, content):
+    with open(os.path.join(folder, 'SONGS', songfilename('001')), 'wb') as f:
+        f.write(content)
+
+
+def songbytes(seed = SEED, length = SONG_BYTES):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for _ in range(length))
+
+
+def read(transport):
+    """The song as read, and every piece the sink was handed"""
+    pieces = []
+    file_data = transport.read(songpath('001'), pieces.append)
+
+    return file_data, pieces
+
+
+def test_retry_block():
+    """A lost block is asked for again and the file comes back whole"""
+    content = songbytes(1)
+    emulator = ScriptedDeluge(makecard(content), 'retry', lose = { LOST: 2 })
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    try:
+        file_data, pieces = read(transport)
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert file_data == content
+    assert b''.join(pieces) == content
+    assert emulator.addrs.count(LOST) == 3
+    assert emulator.counts['session'] == 1
+
+
+def test_reconnect_resume():
+    """A block that keeps getting lost ends the attempt, the reconnect carries on from it"""
+    content = songbytes(2)
+    emulator = ScriptedDeluge(makecard(content), 'reconnect', lose = { LOST: READ_RETRIES + 1 })
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    try:
+        file_data, pieces = read(transport)
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert file_data == content
+    assert b''.join(pieces) == content, 'the sink must get every byte exactly once'
+    assert emulator.counts['session'] == 2
+    assert emulator.counts['open'] == 2
+    assert min(emulator.readsince(1)) == LOST, 'the second attempt should start where the first stopped'
+
+
+def test_resume_next_read():
+    """A read that gives up is finished off by the next read of the same file"""
+    content = songbytes(3)
+    emulator = ScriptedDeluge(makecard(content), 'resume', lose = { LOST: 2 * (READ_RETRIES + 1) })
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    try:
+        first, firstpieces = read(transport)
+        second, secondpieces = read(transport)
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert first is None
+    assert b''.join(firstpieces) == content[:LOST]
+
+    assert second == content
+    assert b''.join(secondpieces) == content
+    assert min(emulator.readsince(2)) == LOST
+
+
+def test_changed_file():
+    """What was read of a file that has since changed is thrown away"""
+    content = songbytes(4)
+    folder = makecard(content)
+    emulator = ScriptedDeluge(folder, 'changed', lose = { LOST: 2 * (READ_RETRIES + 1) })
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    try:
+        first, firstpieces = read(transport)
+
+        content = songbytes(5, SONG_BYTES + 100)
+        writesong(folder, content)
+
+        second, secondpieces = read(transport)
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert first is None
+    assert second == content
+    assert b''.join(secondpieces) == content
+    assert min(emulator.readsince(2)) == 0
+
+
+def test_short_file():
+    """A file that ends before the size open gave is never handed back as if it were whole"""
+    content = songbytes(6)
+    emulator = ScriptedDeluge(makecard(content), 'short', end = LOST)
+    transport = SysExTransport(DelugeConnection(ports = emulator))
+
+    try:
+        file_data, pieces = read(transport)
+    finally:
+        transport.close()
+        emulator.close()
+
+    assert file_data is None
+    assert b''.join(pieces) == content[:LOST]
+    assert transport.partials.entries[songpath('001')][1] == content[:LOST], 'what did arrive is kept for the next try'
+
+
+def setup_module(module):
+    global WORKDIR, HOME_DATA_DIR
+
+    # Block sizes learned in these runs stay out of ~/.dalconnector
+    WORKDIR = tempfile.mkdtemp(prefix = 'dalconnector-test-')
+
+    HOME_DATA_DIR = DALConnector.config.DATA_DIR
+    DALConnector.config.DATA_DIR = os.path.join(WORKDIR, 'data')
+
+
+def teardown_module(module):
+    DALConnector.config.DATA_DIR = HOME_DATA_DIR
+    shutil.rmtree(WORKDIR, ignore_errors = True)
+
+
+def main():
+    """Main test function"""
+    print("DALConnector Read Retry Test")
+    print("============================")
+
+    setup_module(None)
+
+    failed = 0
+    for test in (test_retry_block, test_reconnect_resume, test_resume_next_read, test_changed_file, test_short_file):
+        try:
+            test()
+            print(f"✓ {test.__doc__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} {e}")
+
+    teardown_module(None)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())